@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Импорт анкет в clients (выгрузка CRM, backfill): прежний upsert_client (SELECT, затем UPDATE или
+INSERT, автокоммит на каждую строку) против upsert_client одним оператором ON CONFLICT и
+bulk_upsert_clients (executemany, транзакция на чанк).
+
+Половина анкет — новые клиенты, половина — обновления уже импортированных (часть полей None).
+
+Запуск: python benchmarks/bench_client_upsert.py [--ankets 100000] [--chunk 1000]
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Any
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from robokassa_integration import _CLIENT_FIELDS, _CLIENT_NULLABLE_FIELDS, PaymentsDB  # noqa: E402
+
+
+def make_ankets(count: int, seed: int) -> list[dict[str, Any]]:
+    rng = random.Random(seed)
+    ankets = []
+    for i in range(count):
+        user_id = i if i < count // 2 else rng.randrange(count // 2)
+        anket = {
+            "user_id": user_id,
+            "chat_id": user_id,
+            "username": f"user{user_id}",
+            "first_name": rng.choice(("Анна", "Мария", "Елена", None)),
+            "age_group": rng.choice(("25-34", "35-44", "45+")),
+            "focus": rng.choice(("отношения", "работа", "деньги", None)),
+            "self_value_scale": rng.randint(1, 10),
+            "readiness": rng.choice(("да", "подумаю", None)),
+            "product": rng.choice(("webinar", "group_standard", "pro")),
+        }
+        anket["anket_json"] = json.dumps(anket, ensure_ascii=False)
+        ankets.append(anket)
+    return ankets
+
+
+def legacy_upsert_client(db: PaymentsDB, user_id: int, **fields: Any) -> None:
+    """upsert_client до перехода на ON CONFLICT."""
+    now = int(time.time())
+    conn = db._conn()
+    existing = conn.execute("SELECT user_id FROM clients WHERE user_id = ?", (user_id,)).fetchone()
+    if existing:
+        updates, params = [], []
+        for key in _CLIENT_FIELDS:
+            val = fields.get(key)
+            if val is not None:
+                updates.append(f"{key} = ?")
+                params.append(val)
+        if updates:
+            updates.append("updated_at = ?")
+            params += [now, user_id]
+            conn.execute("UPDATE clients SET " + ", ".join(updates) + " WHERE user_id = ?", params)
+    else:
+        values = [
+            fields.get(c) if c in _CLIENT_NULLABLE_FIELDS else (fields.get(c) or "")
+            for c in _CLIENT_FIELDS
+        ]
+        conn.execute(
+            f"INSERT INTO clients (user_id, {', '.join(_CLIENT_FIELDS)}, updated_at) "
+            f"VALUES ({', '.join('?' * (len(_CLIENT_FIELDS) + 2))})",
+            (user_id, *values, now),
+        )
+
+
+def fresh_db() -> PaymentsDB:
+    return PaymentsDB(os.path.join(tempfile.mkdtemp(), "payments.sqlite3"))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Массовый импорт анкет в clients")
+    parser.add_argument("--ankets", type=int, default=100000)
+    parser.add_argument("--chunk", type=int, default=1000)
+    args = parser.parse_args()
+
+    ankets = make_ankets(args.ankets, seed=1)
+    results = []
+
+    db = fresh_db()
+    t = time.perf_counter()
+    for anket in ankets:
+        legacy_upsert_client(db, **anket)
+    results.append(("SELECT + UPDATE/INSERT", time.perf_counter() - t))
+    db.close()
+
+    db = fresh_db()
+    t = time.perf_counter()
+    for anket in ankets:
+        db.upsert_client(**anket)
+    results.append(("upsert_client, ON CONFLICT", time.perf_counter() - t))
+    db.close()
+
+    db = fresh_db()
+    t = time.perf_counter()
+    db.bulk_upsert_clients(ankets, chunk_size=args.chunk)
+    results.append((f"bulk_upsert_clients({args.chunk})", time.perf_counter() - t))
+    rows = db._conn().execute("SELECT COUNT(*) FROM clients").fetchone()[0]
+    db.close()
+
+    print(f"{args.ankets} анкет ({rows} клиентов)")
+    print(f"{'способ':<28} | {'всего, с':>8} | {'анкет/с':>9}")
+    for name, elapsed in results:
+        print(f"{name:<28} | {elapsed:>8.2f} | {args.ankets / elapsed:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
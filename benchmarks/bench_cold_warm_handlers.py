@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Задержка обработчиков Cloud Functions: «холодный» вызов (состояние экземпляра сброшено) против
+«тёплого» (приложение, цикл событий, конфигурация и PaymentsDB переиспользуются).
+
+- webhook (deploy/handler_webhook.handler): update без подходящего обработчика, так что меряется
+  только обвязка — сборка Application, initialize (getMe) и shutdown. Сеть не нужна: getMe
+  подменяется задержкой --rtt (типичный RTT до api.telegram.org).
+- result (deploy/handler_robokassa.handler_result): подписанный ResultURL по новому заказу во
+  временной базе SQLite; холодный вызов заново читает конфигурацию и выполняет DDL.
+
+Импорт модулей (часть настоящего холодного старта) меряется отдельно, один раз.
+
+Запуск: python benchmarks/bench_cold_warm_handlers.py [--runs 30] [--rtt 0.05] [--only webhook|result]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "deploy"))
+
+
+def _report(name: str, cold: list[float], warm: list[float]) -> None:
+    def ms(values: list[float]) -> str:
+        return f"{statistics.median(values) * 1000:>11.2f} | {max(values) * 1000:>8.2f}"
+
+    print(f"{name:<8} | холодный | {ms(cold)}")
+    print(f"{name:<8} | тёплый   | {ms(warm)}")
+
+
+def bench_webhook(runs: int, rtt: float) -> None:
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:bench")
+    os.environ.setdefault("DEEPSEEK_API_KEY", "bench")
+    t0 = time.perf_counter()
+    import handler_webhook  # noqa: E402
+    import bot  # noqa: E402
+    from telegram import Bot, User  # noqa: E402
+    print(f"импорт bot + PTB: {(time.perf_counter() - t0) * 1000:.0f} мс")
+
+    async def fake_get_me(self, *args, **kwargs):
+        await asyncio.sleep(rtt)
+        self._bot_user = User(id=123456, first_name="bench", is_bot=True, username="bench_bot")
+        return self._bot_user
+
+    Bot.get_me = fake_get_me
+    event = {"body": json.dumps({"update_id": 1, "poll": {
+        "id": "1", "question": "?", "options": [], "total_voter_count": 0, "is_closed": True,
+        "is_anonymous": True, "type": "regular", "allows_multiple_answers": False,
+    }})}
+
+    def call() -> float:
+        t = time.perf_counter()
+        resp = handler_webhook.handler(event, None)
+        assert resp["statusCode"] == 200, resp
+        return time.perf_counter() - t
+
+    cold, warm = [], []
+    for _ in range(runs):
+        loop = handler_webhook._event_loop()
+        loop.run_until_complete(bot.shutdown_webhook_app())
+        loop.close()
+        cold.append(call())
+        warm.append(call())
+    _report("webhook", cold, warm)
+
+
+def bench_result(runs: int) -> None:
+    tmp = tempfile.mkdtemp()
+    os.environ["PAYMENTS_DB_PATH"] = os.path.join(tmp, "payments.sqlite3")
+    os.environ.setdefault("ROBOKASSA_MERCHANT_LOGIN", "bench")
+    os.environ.setdefault("ROBOKASSA_PASSWORD1", "bench1")
+    os.environ.setdefault("ROBOKASSA_PASSWORD2", "bench2")
+    os.environ["TELEGRAM_BOT_TOKEN"] = ""
+    t0 = time.perf_counter()
+    import handler_robokassa  # noqa: E402
+    from robokassa_integration import PaymentsDB  # noqa: E402
+    print(f"импорт robokassa_integration: {(time.perf_counter() - t0) * 1000:.0f} мс")
+
+    db = PaymentsDB.from_env()
+    password2 = os.environ["ROBOKASSA_PASSWORD2"]
+
+    def event_for_new_order() -> dict:
+        inv_id, token = db.create_order(
+            user_id=1, chat_id=1, product_code="webinar", amount="2990.00", description="bench",
+        )
+        shp = f"Shp_order_token={token}"
+        sig = hashlib.md5(f"2990.00:{inv_id}:{password2}:{shp}".encode("utf-8")).hexdigest()
+        body = f"OutSum=2990.00&InvId={inv_id}&SignatureValue={sig}&{shp}"
+        return {"body": body}
+
+    def call(event: dict) -> float:
+        t = time.perf_counter()
+        resp = handler_robokassa.handler_result(event, None)
+        assert resp["body"].startswith("OK"), resp
+        return time.perf_counter() - t
+
+    cold, warm = [], []
+    for _ in range(runs):
+        handler_robokassa._cfg = None
+        PaymentsDB._shared.clear()
+        cold.append(call(event_for_new_order()))
+        warm.append(call(event_for_new_order()))
+    _report("result", cold, warm)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Холодный и тёплый вызов обработчиков Cloud Functions")
+    parser.add_argument("--runs", type=int, default=30)
+    parser.add_argument("--rtt", type=float, default=0.05, help="задержка getMe для webhook, с")
+    parser.add_argument("--only", choices=("webhook", "result"))
+    args = parser.parse_args()
+
+    print(f"{'handler':<8} | {'вызов':<8} | {'медиана, мс':>11} | {'макс, мс':>8}")
+    if args.only in (None, "result"):
+        bench_result(args.runs)
+    if args.only in (None, "webhook"):
+        bench_webhook(args.runs, args.rtt)
+
+
+if __name__ == "__main__":
+    main()
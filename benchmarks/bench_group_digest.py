@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Дайджест групповых по расписанию: cron, запускающий send_group_digest.py каждые N минут, против
+планировщика в процессе сервера (group_digest.DigestScheduler).
+
+1. Цена проверки «пора ли отправлять»: холодный старт python send_group_digest.py (импорты, .env,
+   открытие базы) против прохода run_due_digest в уже запущенном процессе.
+2. Сколько слотов ЧЧ:ММ из 1440 возможных прежнее правило (отправка, только если минута запуска cron
+   совпала со слотом) не отправит никогда; планировщик спит до самого слота и отправляет каждый.
+
+Запуск: python benchmarks/bench_group_digest.py [--runs 10]
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, time as dtime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from group_digest import DIGEST_JOB, MSK, last_slot, run_due_digest  # noqa: E402
+from robokassa_integration import PaymentsDB  # noqa: E402
+
+SLOTS = [dtime(12, 0), dtime(16, 0)]
+
+
+def cold_checks(path: str, runs: int) -> list[float]:
+    env = dict(
+        os.environ,
+        PAYMENTS_DB_PATH=path,
+        GROUP_DIGEST_MODE="scheduled",
+        GROUP_DIGEST_TIME_1="12:00",
+        GROUP_DIGEST_TIME_2="16:00",
+        TELEGRAM_BOT_TOKEN="123:bench",
+        TELEGRAM_GROUP_NOTIFY_CHAT_ID="-100",
+    )
+    env.pop("PAYMENTS_DB_URL", None)
+    env.pop("REPORTING_REPLICA_PATH", None)
+    timings = []
+    for _ in range(runs):
+        t = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(ROOT, "send_group_digest.py")], env=env, check=True, capture_output=True)
+        timings.append(time.perf_counter() - t)
+    return timings
+
+
+def warm_checks(db: PaymentsDB, runs: int) -> list[float]:
+    timings = []
+    for _ in range(runs):
+        t = time.perf_counter()
+        run_due_digest(db, lambda text: None, slots=SLOTS)
+        timings.append(time.perf_counter() - t)
+    return timings
+
+
+def missed_slots(step_min: int) -> int:
+    """Слоты ЧЧ:ММ, которые прежнее правило (strftime('%H:%M') == слот) не отправит при cron */step_min."""
+    return sum(1 for minute in range(1440) if minute % step_min)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Дайджест групповых: cron с холодным стартом против планировщика")
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "payments.sqlite3")
+        db = PaymentsDB(path)
+        # Последний слот уже отправлен: обе проверки доходят до метки и ничего не шлют.
+        slot = last_slot(datetime.now(MSK), SLOTS)
+        db.set_job_mark(DIGEST_JOB, expected=None, mark=int(slot.timestamp()))
+        cold = cold_checks(path, args.runs)
+        warm = warm_checks(db, args.runs * 100)
+        db.close()
+
+    print(f"{'проверка слота':<34} | {'медиана, мс':>11} | {'max, мс':>8}")
+    print(f"{'cron: python send_group_digest.py':<34} | {statistics.median(cold) * 1000:>11.1f} | {max(cold) * 1000:>8.1f}")
+    print(f"{'планировщик: run_due_digest':<34} | {statistics.median(warm) * 1000:>11.3f} | {max(warm) * 1000:>8.3f}")
+    print()
+    print(f"{'расписание':<34} | {'слотов ЧЧ:ММ никогда не отправит':>35}")
+    for step in (5, 10):
+        print(f"{f'cron */{step}, прежнее правило':<34} | {missed_slots(step):>27} из 1440")
+    print(f"{'планировщик в сервере':<34} | {0:>27} из 1440")
+
+
+if __name__ == "__main__":
+    main()
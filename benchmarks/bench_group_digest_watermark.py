@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Дайджест групповых: окно «оплаты за последние GROUP_DIGEST_SINCE_HOURS часов» против водяного знака
+orders.group_notified_at (group_digest.send_new_orders, миграция 7).
+
+1. Полнота: --days дней оплат (--per-day в сутки в случайное время), слоты 12:00 и 16:00 МСК. Окно
+   12 ч между слотами через 4 ч повторяет оплаты, а через 20 ч теряет; водяной знак отправляет
+   каждую ровно один раз.
+2. Цена выборки на большой истории (--orders оплаченных групповых, все уже отправлены) при --new
+   новых: окно + анкета клиента отдельным get_client на строку против одного запроса с JOIN clients
+   по частичному индексу.
+
+Запуск: python benchmarks/bench_group_digest_watermark.py [--days 30] [--orders 200000] [--new 20]
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, time as dtime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from group_digest import MSK, send_new_orders  # noqa: E402
+from robokassa_integration import PaymentsDB  # noqa: E402
+
+SLOTS = (dtime(12, 0), dtime(16, 0))
+WINDOW_HOURS = 12
+
+
+def insert_paid(db: PaymentsDB, paid: list[tuple[int, int]], *, notified: bool = False) -> None:
+    """(user_id, paid_at) -> оплаченные group_vip; notified — уже отправлены прежними дайджестами."""
+    conn = db._conn()
+    conn.execute("BEGIN")
+    conn.executemany(
+        """
+        INSERT INTO orders (order_token, user_id, chat_id, product_code, amount, description, status,
+                            created_at, paid_at, group_notified_at)
+        VALUES ('t', ?, ?, 'group_vip', '10.00', 'bench', 'paid', ?, ?, ?)
+        """,
+        [(uid, uid, ts, ts, ts if notified else None) for uid, ts in paid],
+    )
+    conn.execute("COMMIT")
+
+
+class _Recorder:
+    """PaymentsDB, который считает отмеченные дайджестом заказы."""
+
+    def __init__(self, db: PaymentsDB, sent: Counter):
+        self._db, self._sent = db, sent
+
+    def __getattr__(self, name: str):
+        return getattr(self._db, name)
+
+    def mark_group_notified(self, inv_ids) -> int:
+        self._sent.update(inv_ids)
+        return self._db.mark_group_notified(inv_ids)
+
+
+def completeness(path: str, days: int, per_day: int, seed: int) -> tuple[Counter, Counter, int]:
+    """Сколько раз каждая оплата попала в дайджест: окно и водяной знак на одной последовательности слотов."""
+    rng = random.Random(seed)
+    start = datetime(2026, 1, 1, tzinfo=MSK)
+    slots = [datetime.combine(start.date() + timedelta(days=d), s, tzinfo=MSK) for d in range(days) for s in SLOTS]
+    payments = sorted(int(start.timestamp()) + rng.randrange(days * 86400) for _ in range(days * per_day))
+    db = PaymentsDB(path)
+    window, watermark = Counter(), Counter()
+    pos = 0
+    for slot in slots:
+        slot_ts = int(slot.timestamp())
+        batch = []
+        while pos < len(payments) and payments[pos] <= slot_ts:
+            batch.append((pos, payments[pos]))
+            pos += 1
+        insert_paid(db, batch)
+        window.update(o["inv_id"] for o in db.get_group_orders_paid_since(slot_ts - WINDOW_HOURS * 3600))
+        send_new_orders(_Recorder(db, watermark), lambda text: None, now=slot)
+    db.close()
+    return window, watermark, pos
+
+
+def selection_cost(path: str, orders: int, new: int, repeat: int, seed: int) -> tuple[float, float]:
+    rng = random.Random(seed)
+    now = int(time.time())
+    db = PaymentsDB(path)
+    users = max(orders // 2, 1)
+    db.bulk_upsert_clients(
+        ({"user_id": u, "username": f"user{u}", "contact_value": f"+7999{u:07d}"} for u in range(users)), chunk_size=5000
+    )
+    insert_paid(db, [(rng.randrange(users), now - rng.randint(86400, 365 * 86400)) for _ in range(orders)], notified=True)
+    insert_paid(db, [(rng.randrange(users), now - rng.randint(0, 3600)) for _ in range(new)])
+    db._conn().execute("ANALYZE")
+
+    t = time.perf_counter()
+    for _ in range(repeat):
+        rows = db.get_group_orders_paid_since(now - WINDOW_HOURS * 3600)
+        for r in rows:
+            db.get_client(r["user_id"])
+    window = (time.perf_counter() - t) / repeat
+    t = time.perf_counter()
+    for _ in range(repeat):
+        db.unnotified_group_orders(limit=new)
+    watermark = (time.perf_counter() - t) / repeat
+    db.close()
+    return window, watermark
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Дайджест групповых: окно часов против водяного знака")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--per-day", type=int, default=20)
+    parser.add_argument("--orders", type=int, default=200000)
+    parser.add_argument("--new", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        window, watermark, total = completeness(os.path.join(tmp, "slots.sqlite3"), args.days, args.per_day, seed=1)
+        window_cost, watermark_cost = selection_cost(
+            os.path.join(tmp, "history.sqlite3"), args.orders, args.new, args.repeat, seed=2
+        )
+
+    print(f"{args.days} дн., {total} оплат, слоты 12:00 и 16:00 МСК")
+    print(f"{'выборка':<24} | {'не отправлено':>13} | {'повторено':>9} | {'отправок':>8}")
+    for name, counts in ((f"окно {WINDOW_HOURS} ч", window), ("водяной знак", watermark)):
+        lost = total - len(counts)
+        repeated = sum(1 for c in counts.values() if c > 1)
+        print(f"{name:<24} | {lost:>13} | {repeated:>9} | {sum(counts.values()):>8}")
+    print()
+    print(f"{args.orders} отправленных оплат в истории, {args.new} новых")
+    print(f"{'выборка с анкетой':<34} | {'мс на дайджест':>14}")
+    print(f"{'окно + get_client на строку':<34} | {window_cost * 1000:>14.3f}")
+    print(f"{'водяной знак, JOIN clients':<34} | {watermark_cost * 1000:>14.3f}")
+
+
+if __name__ == "__main__":
+    main()
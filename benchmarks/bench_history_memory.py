@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк памяти истории диалогов на N синтетических пользователей (по умолчанию 100 000).
+
+Сравниваются:
+  legacy — прежнее хранение: defaultdict(list) из dict {"role", "content"}, обрезка list.pop(0)
+           до MAX_HISTORY_MESSAGES * 2 сообщений;
+  hot    — ConversationHistory, все диалоги горячие (Turn с __slots__ в deque);
+  tiered — ConversationHistory с лимитом горячих диалогов (--hot), остальные сжаты zlib в памяти.
+
+Реплики собираются из набора типичных фраз с номером пользователя, так что строки у всех разные;
+реальная переписка сжимается хуже, чем синтетика, — для tiered это оценка снизу.
+Память — tracemalloc (объекты Python вместе со строками реплик, без накладных аллокатора).
+
+Запуск: python benchmarks/bench_history_memory.py [--users 100000] [--turns 12] [--hot 2000]
+"""
+from __future__ import annotations
+
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conversation import ConversationHistory  # noqa: E402
+
+LEGACY_MAX_HISTORY_MESSAGES = 10
+TOKEN_BUDGET = 2500
+
+USER_PHRASES = [
+    "Мне тревожно последние несколько месяцев.",
+    "Не могу уснуть, постоянно прокручиваю мысли.",
+    "На работе всё валится из рук.",
+    "Наверное, год или около того.",
+    "Пробовала медитации, но хватает ненадолго.",
+    "Меня зовут Анна, можно на ты.",
+    "Да, это про отношения с мамой.",
+    "Где-то на шестёрку по шкале.",
+    "Хочу понять, что со мной происходит.",
+    "Telegram, так удобнее всего.",
+]
+BOT_PHRASES = [
+    "Я слышу, как непросто вам сейчас.",
+    "Расскажите, пожалуйста, когда это началось?",
+    "Это важное наблюдение — давайте на нём остановимся.",
+    "Как к вам лучше обращаться — на ты или на вы?",
+    "Что вы уже пробовали, чтобы справиться с этим?",
+    "Оцените, пожалуйста, своё состояние от 1 до 10.",
+    "Похоже, здесь есть внутренний конфликт между долгом и желанием.",
+    "Спасибо, что делитесь. Это требует смелости.",
+    "Давайте посмотрим, какой формат работы вам подойдёт.",
+    "Что для вас сейчас самое трудное?",
+]
+
+
+def iter_dialogs(users: int, turns: int, seed: int):
+    """(user_id, role, content) — диалог пользователя целиком, затем следующий (сессиями)."""
+    rng = random.Random(seed)
+    for uid in range(users):
+        for i in range(turns):
+            role = "user" if i % 2 == 0 else "assistant"
+            pool = USER_PHRASES if role == "user" else BOT_PHRASES
+            text = " ".join(rng.choice(pool) for _ in range(rng.randint(1, 3)))
+            yield uid, role, f"{text} ({uid}:{i})"
+
+
+def build_legacy(messages):
+    history = defaultdict(list)
+    for uid, role, content in messages:
+        history[uid].append({"role": role, "content": content})
+        while len(history[uid]) > LEGACY_MAX_HISTORY_MESSAGES * 2:
+            history[uid].pop(0)
+    return history
+
+
+def build_history(messages, max_cached_users: int):
+    h = ConversationHistory(TOKEN_BUDGET, max_cached_users=max_cached_users)
+    for uid, role, content in messages:
+        h.add(uid, role, content)
+    return h
+
+
+def measure(build, messages, *args):
+    gc.collect()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    obj = build(messages, *args)
+    elapsed = time.perf_counter() - t0
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return obj, used, elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Память истории диалогов на N пользователей")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--turns", type=int, default=12)
+    parser.add_argument("--hot", type=int, default=2000, help="горячих диалогов в режиме tiered")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    def messages():
+        return iter_dialogs(args.users, args.turns, args.seed)
+
+    print(f"{args.users} пользователей × {args.turns} реплик, горячих в tiered: {args.hot}")
+    print(f"{'режим':<8} | {'МБ':>8} | {'байт/польз.':>11} | {'сборка, с':>9} | примечание")
+
+    rows = []
+    legacy, used, elapsed = measure(build_legacy, messages())
+    rows.append(("legacy", used, elapsed, f"{sum(len(v) for v in legacy.values())} dict-сообщений"))
+    del legacy
+
+    hot, used, elapsed = measure(build_history, messages(), 0)
+    rows.append(("hot", used, elapsed, f"{hot.memory_stats()['hot_users']} горячих"))
+    del hot
+
+    tiered, used, elapsed = measure(build_history, messages(), args.hot)
+    stats = tiered.memory_stats()
+    rows.append(("tiered", used, elapsed, f"{stats['hot_users']} горячих, {stats['cold_users']} сжатых "
+                 f"({stats['cold_bytes'] / 2**20:.1f} МБ zlib)"))
+    del tiered
+
+    for name, used, elapsed, note in rows:
+        print(f"{name:<8} | {used / 2**20:>8.1f} | {used / args.users:>11.0f} | {elapsed:>9.2f} | {note}")
+
+
+if __name__ == "__main__":
+    main()
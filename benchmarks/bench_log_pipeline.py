@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Стоимость записи в лог для вызывающего потока: прежний отладочный лог (open + append JSON + close на
+каждое событие, как в build_payment_url / verify_result_url) против log_pipeline (событие в очередь,
+файл с ротацией пишет фоновый поток).
+
+--fsync-ms имитирует медленный диск (сетевой диск ВМ): задержка на каждую запись файла.
+
+Запуск: python benchmarks/bench_log_pipeline.py [--events 5000] [--fsync-ms 0]
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import log_pipeline  # noqa: E402
+
+FIELDS = {"inv_id": 123, "out_sum": "2990.00", "shp_keys": ["Shp_chat_id", "Shp_order_token"], "match": True}
+
+
+def inline_append(path: str, delay: float) -> None:
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"id": "verify_result_url", "timestamp": time.time(), "data": FIELDS}, ensure_ascii=False) + "\n")
+        if delay:
+            time.sleep(delay)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Задержка логирования на горячем пути")
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--fsync-ms", type=float, default=0.0, help="задержка записи в файл, мс")
+    args = parser.parse_args()
+    delay = args.fsync_ms / 1000
+
+    tmp = tempfile.mkdtemp()
+    inline, queued = [], []
+    path = os.path.join(tmp, "debug.log")
+    for _ in range(args.events):
+        t = time.perf_counter()
+        inline_append(path, delay)
+        inline.append(time.perf_counter() - t)
+
+    log_pipeline.setup_logging(service="bench", level="INFO", log_file=os.path.join(tmp, "app.log"), console=False)
+    handler = log_pipeline._listener.handlers[0]
+    emit = handler.emit
+
+    def slow_emit(record):
+        emit(record)
+        if delay:
+            time.sleep(delay)
+
+    handler.emit = slow_emit
+    log = logging.getLogger("bench")
+    t_all = time.perf_counter()
+    for _ in range(args.events):
+        t = time.perf_counter()
+        log_pipeline.log_event(log, "robokassa.result_signature", **FIELDS)
+        queued.append(time.perf_counter() - t)
+    log_pipeline.flush_logs(timeout=600)
+    drained = time.perf_counter() - t_all
+    log_pipeline.shutdown_logging()
+
+    def us(values: list[float]) -> str:
+        values = sorted(values)
+        return f"{statistics.median(values) * 1e6:>12.1f} | {values[int(len(values) * 0.99)] * 1e6:>10.1f}"
+
+    print(f"{args.events} событий, задержка записи {args.fsync_ms} мс")
+    print(f"{'способ':<26} | {'медиана, мкс':>12} | {'p99, мкс':>10}")
+    print(f"{'open/append/close':<26} | {us(inline)}")
+    print(f"{'log_pipeline (очередь)':<26} | {us(queued)}")
+    print(f"фоновый поток дописал файл за {drained:.2f} с, отброшено записей: {log_pipeline.dropped_records()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Запросы по оплатам на большой таблице orders: только индекс по status (схема до миграции 3)
+против покрывающих индексов миграции 3.
+
+Заполняется --orders заказов (случайные пользователи и продукты, ~70% оплачены, даты за год),
+затем меряются дайджест по групповым за 12 ч (send_group_digest) и проверка доступа пользователя
+(has_paid / last_paid_at — Pro и вебинар, DATABASE_DESIGN 3.3–3.4).
+
+Запуск: python benchmarks/bench_order_queries.py [--orders 200000] [--repeat 200]
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from robokassa_integration import _MIGRATIONS, PaymentsDB  # noqa: E402
+
+PRODUCTS = ("webinar", "group_standard", "group_vip", "pro")
+
+
+def fill(db: PaymentsDB, orders: int, users: int, now: int, seed: int) -> None:
+    rng = random.Random(seed)
+    rows = []
+    for _ in range(orders):
+        paid = rng.random() < 0.7
+        created = now - rng.randint(0, 365 * 86400)
+        rows.append((
+            "t", rng.randrange(users), 1, rng.choice(PRODUCTS), "10.00", "bench",
+            "paid" if paid else "pending", created, created + 60 if paid else None,
+        ))
+    conn = db._conn()
+    conn.execute("BEGIN")
+    conn.executemany(
+        """
+        INSERT INTO orders (order_token, user_id, chat_id, product_code, amount, description, status, created_at, paid_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        rows,
+    )
+    conn.execute("COMMIT")
+    conn.execute("ANALYZE")
+
+
+def measure(db: PaymentsDB, repeat: int, users: int, now: int) -> tuple[float, float]:
+    rng = random.Random(1)
+    t = time.perf_counter()
+    for _ in range(repeat):
+        db.get_group_orders_paid_since(now - 12 * 3600)
+    digest = (time.perf_counter() - t) / repeat
+    t = time.perf_counter()
+    for _ in range(repeat):
+        uid = rng.randrange(users)
+        db.has_paid(uid, "webinar")
+        db.last_paid_at(uid, "pro")
+    access = (time.perf_counter() - t) / repeat
+    return digest, access
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Индексы миграции 3 на запросах по оплатам")
+    parser.add_argument("--orders", type=int, default=200000)
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    now = int(time.time())
+    db = PaymentsDB(os.path.join(tempfile.mkdtemp(), "payments.sqlite3"))
+    fill(db, args.orders, args.users, now, seed=1)
+    conn = db._conn()
+
+    print(f"{args.orders} заказов, {args.users} пользователей")
+    print(f"{'индексы':<24} | {'дайджест 12 ч, мс':>17} | {'доступ user_id, мс':>18}")
+    conn.execute("DROP INDEX idx_orders_product_status_paid")
+    conn.execute("DROP INDEX idx_orders_user_product_status")
+    digest, access = measure(db, args.repeat, args.users, now)
+    print(f"{'только status':<24} | {digest * 1000:>17.3f} | {access * 1000:>18.3f}")
+
+    # Только индексы миграции 3: повторный прогон _migrate с user_version=2 упал бы на ALTER миграции 4.
+    for sql in dict(_MIGRATIONS)[3]:
+        conn.execute(sql)
+    conn.execute("ANALYZE")
+    digest, access = measure(db, args.repeat, args.users, now)
+    print(f"{'миграция 3':<24} | {digest * 1000:>17.3f} | {access * 1000:>18.3f}")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+orders с историей брошенных заказов: задержка get_order (ResultURL), дайджеста и выборки ожидающих
+заказов до и после обслуживания (orders_maintenance.run_maintenance: архив + expired + incremental vacuum).
+
+Заполняется --orders заказов за 2 года: ~85% — брошенные ссылки (pending), остальные оплачены.
+ResultURL приходит по свежим заказам, поэтому get_order меряется по последним --recent inv_id.
+Кэш страниц сбрасывается перед каждым замером (новое соединение): в боевом процессе горячие
+страницы orders делят кэш с остальными таблицами.
+
+Запуск: python benchmarks/bench_orders_maintenance.py [--orders 1000000] [--repeat 2000]
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from orders_maintenance import run_maintenance  # noqa: E402
+from robokassa_integration import PaymentsDB  # noqa: E402
+
+PRODUCTS = ("webinar", "group_standard", "group_vip", "pro")
+
+
+def fill(db: PaymentsDB, orders: int, now: int, seed: int) -> None:
+    rng = random.Random(seed)
+    span = 2 * 365 * 86400
+    conn = db._conn()
+    conn.execute("BEGIN")
+    batch = []
+    for i in range(orders):
+        created = now - span + span * i // orders + rng.randint(0, 60)
+        paid = rng.random() < 0.15
+        batch.append((
+            "t" * 22, rng.randrange(orders // 4), 1, rng.choice(PRODUCTS), "2990.00", "Оплата участия",
+            "paid" if paid else "pending", created, created + 120 if paid else None,
+        ))
+        if len(batch) == 10000:
+            conn.executemany(
+                """
+                INSERT INTO orders (order_token, user_id, chat_id, product_code, amount, description, status, created_at, paid_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                batch,
+            )
+            batch = []
+    if batch:
+        conn.executemany(
+            """
+            INSERT INTO orders (order_token, user_id, chat_id, product_code, amount, description, status, created_at, paid_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            batch,
+        )
+    conn.execute("COMMIT")
+    conn.execute("ANALYZE")
+
+
+def measure(path: str, repeat: int, recent: list[int], now: int) -> dict[str, float]:
+    db = PaymentsDB(path)
+    rng = random.Random(1)
+    result = {}
+    t = time.perf_counter()
+    for _ in range(repeat):
+        db.get_order(rng.choice(recent))
+    result["get_order"] = (time.perf_counter() - t) / repeat
+    t = time.perf_counter()
+    for _ in range(max(1, repeat // 100)):
+        db.get_group_orders_paid_since(now - 12 * 3600)
+    result["digest"] = (time.perf_counter() - t) / max(1, repeat // 100)
+    t = time.perf_counter()
+    db._conn().execute("SELECT COUNT(*) FROM orders WHERE status = 'pending'").fetchone()
+    result["pending"] = time.perf_counter() - t
+    sizes = dict(db._conn().execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name"))
+    result["orders_mb"] = sum(v for k, v in sizes.items() if k == "orders" or k.startswith("idx_orders")) / 2**20
+    result["file_mb"] = os.path.getsize(path) / 2**20
+    db.close()
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Обслуживание orders на большой истории заказов")
+    parser.add_argument("--orders", type=int, default=1000000)
+    parser.add_argument("--recent", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    now = int(time.time())
+    path = os.path.join(tempfile.mkdtemp(), "payments.sqlite3")
+    db = PaymentsDB(path)
+    t = time.perf_counter()
+    fill(db, args.orders, now, seed=1)
+    print(f"{args.orders} заказов записано за {time.perf_counter() - t:.1f} с")
+    top = db._conn().execute("SELECT MAX(inv_id) FROM orders").fetchone()[0]
+    recent = list(range(top - args.recent + 1, top + 1))
+    db.close()
+
+    before = measure(path, args.repeat, recent, now)
+    db = PaymentsDB(path)
+    t = time.perf_counter()
+    stats = run_maintenance(db, vacuum_pages=0)
+    print(f"обслуживание: {time.perf_counter() - t:.1f} с, {stats}; {db.order_counts()}")
+    db.close()
+    after = measure(path, args.repeat, recent, now)
+
+    print(f"{'':<26} | {'до':>10} | {'после':>10}")
+    print(f"{'get_order, мкс':<26} | {before['get_order'] * 1e6:>10.1f} | {after['get_order'] * 1e6:>10.1f}")
+    print(f"{'дайджест 12 ч, мс':<26} | {before['digest'] * 1000:>10.3f} | {after['digest'] * 1000:>10.3f}")
+    print(f"{'COUNT pending, мс':<26} | {before['pending'] * 1000:>10.1f} | {after['pending'] * 1000:>10.1f}")
+    print(f"{'orders + индексы, МБ':<26} | {before['orders_mb']:>10.1f} | {after['orders_mb']:>10.1f}")
+    print(f"{'файл базы, МБ':<26} | {before['file_mb']:>10.1f} | {after['file_mb']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Задержка нажатия «Оплатить» до готовой ссылки: создание заказа и подпись по нажатию (как раньше в
+send_payment_link) против ссылки, подготовленной при показе клавиатуры (PaymentLinkPrefetcher.take).
+
+--busy-ms имитирует занятую базу: каждый запрос в пуле потоков ждёт столько миллисекунд
+(параллельные стримы и ResultURL, DATABASE_DESIGN 1).
+
+Запуск: python benchmarks/bench_payment_link.py [--clicks 500] [--busy-ms 0]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from payment_links import PaymentLinkPrefetcher, payment_url_for_order  # noqa: E402
+from payments_async import AsyncPaymentsDB  # noqa: E402
+from robokassa_integration import PaymentsDB, RobokassaConfig  # noqa: E402
+
+CFG = RobokassaConfig(merchant_login="shop", password1="p1", password2="p2", merchant_url="https://pay.test/", is_test=False)
+
+
+class BusyPaymentsDB(PaymentsDB):
+    busy = 0.0
+
+    def create_order(self, **kwargs):
+        time.sleep(self.busy)
+        return super().create_order(**kwargs)
+
+
+async def run(clicks: int, db: PaymentsDB) -> tuple[list[float], list[float]]:
+    adb = AsyncPaymentsDB(lambda: db)
+    links = PaymentLinkPrefetcher(lambda: adb, config=lambda: CFG)
+    on_click, prefetched = [], []
+    for uid in range(clicks):
+        t = time.perf_counter()
+        inv_id, token = await adb.create_order(user_id=uid, chat_id=uid, product_code="webinar", amount="10.00", description="b")
+        payment_url_for_order(
+            CFG,
+            inv_id=inv_id, order_token=token, user_id=uid, chat_id=uid,
+            product_code="webinar", amount="10.00", description="b",
+        )
+        on_click.append(time.perf_counter() - t)
+
+        links.prefetch(user_id=uid, chat_id=uid, product_code="webinar", amount="10.00", description="b")
+        await asyncio.sleep(0.05 + db.busy * 2)  # пользователь читает сообщение перед нажатием
+        t = time.perf_counter()
+        assert await links.take(user_id=uid, chat_id=uid, product_code="webinar")
+        prefetched.append(time.perf_counter() - t)
+    await asyncio.sleep(0.1)  # фоновый перевод последнего заказа в pending
+    adb.shutdown()
+    return on_click, prefetched
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Задержка выдачи ссылки на оплату")
+    parser.add_argument("--clicks", type=int, default=500)
+    parser.add_argument("--busy-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    db = BusyPaymentsDB(os.path.join(tempfile.mkdtemp(), "payments.sqlite3"))
+    db.busy = args.busy_ms / 1000
+    on_click, prefetched = asyncio.run(run(args.clicks, db))
+
+    def ms(values: list[float]) -> str:
+        values = sorted(values)
+        return f"{statistics.median(values) * 1000:>12.2f} | {values[int(len(values) * 0.99)] * 1000:>9.2f}"
+
+    print(f"{args.clicks} нажатий, занятость базы {args.busy_ms} мс на запрос")
+    print(f"{'способ':<30} | {'медиана, мс':>12} | {'p99, мс':>9}")
+    print(f"{'заказ и подпись по нажатию':<30} | {ms(on_click)}")
+    print(f"{'подготовлено заранее':<30} | {ms(prefetched)}")
+
+
+if __name__ == "__main__":
+    main()
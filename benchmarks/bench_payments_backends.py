@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Хранилище оплат: SQLite (PaymentsDB) против PostgreSQL (PostgresPaymentsDB, пул asyncpg) под
+конкурентной нагрузкой через AsyncPaymentsDB — так их вызывают robokassa_server и бот.
+
+--tasks корутин в течение --seconds повторяют ResultURL: create_order + confirm_payment (запись
+orders, clients, outbox в одной транзакции), и по --reads чтений pro_entitlement(use_cache=False).
+Меряются оплаты в секунду, медиана и p99 одной оплаты.
+
+PostgreSQL — из --pg-dsn или PAYMENTS_TEST_PG_DSN; для замера создаётся и удаляется отдельная база.
+
+Запуск: python benchmarks/bench_payments_backends.py [--tasks 1,16,64] [--seconds 5] [--pg-dsn postgresql://...]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from urllib.parse import urlsplit, urlunsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from payments_async import AsyncPaymentsDB  # noqa: E402
+from robokassa_integration import PaymentsDB  # noqa: E402
+
+
+async def load(db, tasks: int, seconds: float, reads: int) -> list[float]:
+    adb = AsyncPaymentsDB(db_factory=lambda: db)
+    latencies: list[float] = []
+    deadline = time.monotonic() + seconds
+
+    async def worker(n: int) -> None:
+        uid = n * 10_000_000
+        while time.monotonic() < deadline:
+            uid += 1
+            t = time.perf_counter()
+            inv_id, token = await adb.create_order(
+                user_id=uid, chat_id=uid, product_code="group_vip", amount="10.00", description="bench"
+            )
+            await adb.confirm_payment(inv_id, out_sum="10.00", order_token=token, raw_params={"InvId": inv_id})
+            latencies.append(time.perf_counter() - t)
+            for _ in range(reads):
+                await adb.call("pro_entitlement", uid, use_cache=False)
+
+    try:
+        await asyncio.gather(*(worker(n) for n in range(tasks)))
+    finally:
+        adb.shutdown()
+    latencies.sort()
+    return latencies
+
+
+def report(name: str, tasks: int, seconds: float, lat: list[float]) -> None:
+    print(
+        f"{name:<10} | {tasks:>6} | {len(lat) / seconds:>9.0f} | "
+        f"{statistics.median(lat) * 1000:>11.2f} | {lat[int(len(lat) * 0.99)] * 1000:>8.2f}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Оплаты через AsyncPaymentsDB: SQLite против PostgreSQL")
+    parser.add_argument("--tasks", default="1,16,64", help="числа одновременных корутин через запятую")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--reads", type=int, default=2, help="чтений доступа Pro на одну оплату")
+    parser.add_argument("--pg-dsn", default=os.getenv("PAYMENTS_TEST_PG_DSN"))
+    args = parser.parse_args()
+    levels = [int(x) for x in args.tasks.split(",")]
+
+    print(f"{'хранилище':<10} | {'задач':>6} | {'оплат/с':>9} | {'медиана, мс':>11} | {'p99, мс':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for tasks in levels:
+            db = PaymentsDB(os.path.join(tmp, f"payments_{tasks}.sqlite3"))
+            report("SQLite", tasks, args.seconds, asyncio.run(load(db, tasks, args.seconds, args.reads)))
+            db.close()
+
+    if not args.pg_dsn:
+        print("PostgreSQL пропущен: задайте --pg-dsn или PAYMENTS_TEST_PG_DSN")
+        return
+    import asyncpg
+
+    from payments_pg import PostgresPaymentsDB
+
+    name = f"payments_bench_{uuid.uuid4().hex[:12]}"
+
+    async def admin(sql: str) -> None:
+        conn = await asyncpg.connect(args.pg_dsn)
+        try:
+            await conn.execute(sql)
+        finally:
+            await conn.close()
+
+    asyncio.run(admin(f"CREATE DATABASE {name}"))
+    try:
+        db = PostgresPaymentsDB(urlunsplit(urlsplit(args.pg_dsn)._replace(path="/" + name)))
+        try:
+            for tasks in levels:
+                report("PostgreSQL", tasks, args.seconds, asyncio.run(load(db, tasks, args.seconds, args.reads)))
+        finally:
+            db.close()
+    finally:
+        asyncio.run(admin(f"DROP DATABASE {name}"))
+
+
+if __name__ == "__main__":
+    main()
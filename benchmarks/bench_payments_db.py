@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Микробенчмарк PaymentsDB: create_order, get_order, mark_paid_if_pending.
+
+- legacy — как было: PaymentsDB.from_env() (со всеми CREATE TABLE) на каждое обращение, новое
+  соединение и PRAGMA journal_mode=WAL на каждый метод;
+- pooled — общий на процесс PaymentsDB.from_env(): схема мигрирована один раз, соединение на поток.
+
+Запуск: python benchmarks/bench_payments_db.py [--ops 2000]
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from robokassa_integration import _MIGRATIONS, PaymentsDB  # noqa: E402
+
+
+class LegacyPaymentsDB:
+    """Прежняя реализация: DDL в конструкторе, соединение на каждый вызов."""
+
+    def __init__(self, path: str):
+        self.path = path
+        conn = self._connect()
+        try:
+            for _, statements in _MIGRATIONS:
+                for sql in statements:
+                    sql(conn) if callable(sql) else conn.execute(sql)
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA foreign_keys=ON;")
+        return conn
+
+    def create_order(self, **kw) -> tuple[int, str]:
+        conn = self._connect()
+        try:
+            cur = conn.execute(
+                "INSERT INTO orders (order_token, user_id, chat_id, product_code, amount, description, status, created_at)"
+                " VALUES ('t', ?, ?, ?, ?, ?, 'pending', ?)",
+                (kw["user_id"], kw["chat_id"], kw["product_code"], kw["amount"], kw["description"], int(time.time())),
+            )
+            return int(cur.lastrowid), "t"
+        finally:
+            conn.close()
+
+    def get_order(self, inv_id: int):
+        conn = self._connect()
+        try:
+            cur = conn.execute("SELECT * FROM orders WHERE inv_id=?", (inv_id,))
+            row = cur.fetchone()
+            return dict(zip([d[0] for d in cur.description], row)) if row else None
+        finally:
+            conn.close()
+
+    def mark_paid_if_pending(self, inv_id: int, *, raw_params) -> bool:
+        conn = self._connect()
+        try:
+            cur = conn.execute(
+                "UPDATE orders SET status='paid', paid_at=?, raw_result_params=? WHERE inv_id=? AND status='pending'",
+                (int(time.time()), json.dumps(raw_params), inv_id),
+            )
+            return cur.rowcount > 0
+        finally:
+            conn.close()
+
+
+def run(name: str, get_db, ops: int) -> None:
+    order = {"user_id": 1, "chat_id": 1, "product_code": "webinar", "amount": "2990.00", "description": "bench"}
+    timings = {}
+    t = time.perf_counter()
+    ids = [get_db().create_order(**order)[0] for _ in range(ops)]
+    timings["create_order"] = time.perf_counter() - t
+    t = time.perf_counter()
+    for inv_id in ids:
+        get_db().get_order(inv_id)
+    timings["get_order"] = time.perf_counter() - t
+    t = time.perf_counter()
+    for inv_id in ids:
+        get_db().mark_paid_if_pending(inv_id, raw_params={"InvId": inv_id})
+    timings["mark_paid_if_pending"] = time.perf_counter() - t
+    for op, elapsed in timings.items():
+        print(f"{name:<7} | {op:<21} | {elapsed / ops * 1e6:>9.1f} | {ops / elapsed:>9.0f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="PaymentsDB: соединение на вызов против соединения на поток")
+    parser.add_argument("--ops", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'режим':<7} | {'операция':<21} | {'мкс/оп':>9} | {'оп/с':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "legacy.sqlite3")
+        run("legacy", lambda: LegacyPaymentsDB(legacy_path), args.ops)
+        os.environ["PAYMENTS_DB_PATH"] = os.path.join(tmp, "pooled.sqlite3")
+        run("pooled", PaymentsDB.from_env, args.ops)
+        PaymentsDB.from_env().close()
+
+
+if __name__ == "__main__":
+    main()
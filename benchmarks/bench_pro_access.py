@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Проверка доступа к Pro на каждое сообщение: запрос к базе против кэша процесса (PRO_ENTITLEMENTS).
+
+Режимы: синхронно (PaymentsDB.pro_entitlement с кэшем и без) и из async-обработчика
+(AsyncPaymentsDB.pro_entitlement: промах — пул потоков, попадание — без него).
+
+Запуск: python benchmarks/bench_pro_access.py [--users 1000] [--checks 20000]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from payments_async import AsyncPaymentsDB  # noqa: E402
+from robokassa_integration import PRO_ENTITLEMENTS, PaymentsDB  # noqa: E402
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Стоимость проверки доступа к Pro")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--checks", type=int, default=20000)
+    args = parser.parse_args()
+
+    db = PaymentsDB(os.path.join(tempfile.mkdtemp(), "payments.sqlite3"))
+    for uid in range(args.users):
+        if uid % 2:
+            inv_id, token = db.create_order(user_id=uid, chat_id=uid, product_code="pro", amount="990.00", description="b")
+            db.confirm_payment(inv_id, out_sum="990.00", order_token=token, raw_params={})
+    rng = random.Random(1)
+    users = [rng.randrange(args.users) for _ in range(args.checks)]
+
+    def run_sync(use_cache: bool) -> float:
+        t = time.perf_counter()
+        for uid in users:
+            db.pro_entitlement(uid, use_cache=use_cache)
+        return (time.perf_counter() - t) / len(users)
+
+    async def run_async(use_cache: bool) -> float:
+        adb = AsyncPaymentsDB(lambda: db)
+        t = time.perf_counter()
+        for uid in users:
+            if use_cache:
+                await adb.pro_entitlement(uid)
+            else:
+                await adb.call("pro_entitlement", uid, use_cache=False)
+        elapsed = (time.perf_counter() - t) / len(users)
+        adb.shutdown()
+        return elapsed
+
+    print(f"{args.checks} проверок по {args.users} пользователям")
+    print(f"{'режим':<28} | {'мкс на проверку':>15}")
+    PRO_ENTITLEMENTS.clear()
+    print(f"{'sync, запрос к базе':<28} | {run_sync(False) * 1e6:>15.1f}")
+    PRO_ENTITLEMENTS.clear()
+    print(f"{'sync, кэш':<28} | {run_sync(True) * 1e6:>15.1f}")
+    PRO_ENTITLEMENTS.clear()
+    print(f"{'async, пул потоков + база':<28} | {asyncio.run(run_async(False)) * 1e6:>15.1f}")
+    PRO_ENTITLEMENTS.clear()
+    print(f"{'async, кэш':<28} | {asyncio.run(run_async(True)) * 1e6:>15.1f}")
+    print(f"кэш: {PRO_ENTITLEMENTS.counters}")
+
+
+if __name__ == "__main__":
+    main()
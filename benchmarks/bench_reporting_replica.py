@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Оплаты (ResultURL: create_order + confirm_payment) во время долгих отчётов: выгрузка всех заказов
+читается из рабочей базы или из снимка (reporting_replica.py, снимок обновляется каждые --refresh-sec).
+
+Выгрузка идёт медленно (--row-us на строку — форматирование, запись в CSV), всё это время её
+транзакция чтения держит WAL рабочей базы: checkpoint не может сбросить его, файл -wal растёт.
+Меряются задержка записей ResultURL (медиана, p99) и наибольший размер -wal рабочей базы.
+
+Запуск: python benchmarks/bench_reporting_replica.py [--orders 200000] [--seconds 10]
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reporting_replica import ReportingReplica  # noqa: E402
+from robokassa_integration import PaymentsDB  # noqa: E402
+
+PRODUCTS = ("webinar", "group_standard", "group_vip", "pro")
+
+
+def fill(db: PaymentsDB, orders: int, now: int) -> None:
+    rng = random.Random(1)
+    conn = db._conn()
+    conn.execute("BEGIN")
+    conn.executemany(
+        """
+        INSERT INTO orders (order_token, user_id, chat_id, product_code, amount, description, status, created_at, paid_at)
+        VALUES ('t', ?, 1, ?, '10.00', 'bench', 'paid', ?, ?)
+        """,
+        ((rng.randrange(orders), rng.choice(PRODUCTS), now - i, now - i) for i in range(orders)),
+    )
+    conn.execute("COMMIT")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def run(path: str, report_db: PaymentsDB, seconds: float, row_us: float, refresh: ReportingReplica | None, refresh_sec: float):
+    db = PaymentsDB(path)
+    stop = threading.Event()
+    latencies: list[float] = []
+    wal_max = [0]
+    exports = [0]
+
+    def writer() -> None:
+        uid = 0
+        while not stop.is_set():
+            uid += 1
+            t = time.perf_counter()
+            inv_id, token = db.create_order(user_id=uid, chat_id=uid, product_code="group_vip", amount="10.00", description="b")
+            db.confirm_payment(inv_id, out_sum="10.00", order_token=token, raw_params={})
+            latencies.append(time.perf_counter() - t)
+            wal = path + "-wal"
+            if os.path.exists(wal):
+                wal_max[0] = max(wal_max[0], os.path.getsize(wal))
+            time.sleep(0.002)
+
+    def exporter() -> None:
+        while not stop.is_set():
+            for _row in report_db._conn().execute("SELECT * FROM orders ORDER BY inv_id"):
+                deadline = time.perf_counter() + row_us / 1e6
+                while time.perf_counter() < deadline:
+                    pass
+                if stop.is_set():
+                    break
+            exports[0] += 1
+
+    def refresher() -> None:
+        while not stop.wait(refresh_sec):
+            refresh.refresh()
+
+    threads = [threading.Thread(target=writer), threading.Thread(target=exporter)]
+    if refresh is not None:
+        threads.append(threading.Thread(target=refresher))
+    for th in threads:
+        th.start()
+    time.sleep(seconds)
+    stop.set()
+    for th in threads:
+        th.join()
+    db.close()
+    latencies.sort()
+    return latencies, wal_max[0], exports[0]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Записи оплат во время отчётов: рабочая база против снимка")
+    parser.add_argument("--orders", type=int, default=200000)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--row-us", type=float, default=20.0)
+    parser.add_argument("--refresh-sec", type=float, default=2.0)
+    args = parser.parse_args()
+
+    print(f"{args.orders} заказов, {args.seconds} с записи, выгрузка {args.row_us} мкс на строку")
+    print(f"{'отчёты читают':<16} | {'записей':>7} | {'медиана, мс':>11} | {'p99, мс':>8} | {'-wal max, МБ':>12}")
+    for mode in ("рабочую базу", "снимок"):
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, "payments.sqlite3")
+        fill(PaymentsDB(path), args.orders, int(time.time()))
+        replica = None
+        if mode == "снимок":
+            replica = ReportingReplica(path, os.path.join(tmp, "report.sqlite3"))
+            replica.refresh()
+            report_db = replica.db()
+        else:
+            report_db = PaymentsDB(path)
+        lat, wal, _exports = run(path, report_db, args.seconds, args.row_us, replica, args.refresh_sec)
+        print(
+            f"{mode:<16} | {len(lat):>7} | {statistics.median(lat) * 1000:>11.2f} | "
+            f"{lat[int(len(lat) * 0.99)] * 1000:>8.2f} | {wal / 2**20:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк CPU на один потоковый ответ: старый stream_edit (повторный разбор всего накопленного
+текста на каждом фрагменте) против StreamRenderer (инкрементально).
+
+50 одновременных стримов в одном цикле asyncio, фрагменты по ~4 символа (как токены DeepSeek),
+правка сообщения не чаще, чем раз в 10 фрагментов (≈ троттлинг 0.2 с при ~50 ток/с).
+Telegram не вызывается — меряется только работа рендера.
+
+Запуск: python benchmarks/bench_stream_render.py [--streams 50] [--lengths 400,1500,4000]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streaming import StreamRenderer  # noqa: E402
+
+STEP_TAG_REGEX = re.compile(r"\[STEP:\s*([\w:]+)\]", re.IGNORECASE)
+STEP_TAG_ANYWHERE = re.compile(r"\s*\[STEP:\s*[\w:]+\]\s*", re.IGNORECASE)
+CHUNK = 4
+EDIT_EVERY = 10
+
+
+def _legacy_parse_step(reply: str):
+    matches = list(STEP_TAG_REGEX.finditer(reply))
+    if not matches:
+        return reply, None
+    last = matches[-1]
+    step_id = last.group(1).lower()
+    reply_clean = reply[: last.start()].rstrip()
+    if step_id == "custom":
+        reply_clean = (reply_clean + " " + reply[last.end():].lstrip()).strip()
+    reply_clean = STEP_TAG_ANYWHERE.sub(" ", reply_clean)
+    return re.sub(r"\s+", " ", reply_clean).strip(), step_id
+
+
+def _legacy_display(accumulated: str) -> str:
+    display, _ = _legacy_parse_step(accumulated)
+    display = re.sub(r"\[[^\]]*\]", "", display or "")
+    display = re.sub(r"  +", " ", display).strip()
+    display = display or "…"
+    if len(display) > 4090:
+        display = display[:4090] + "..."
+    return display
+
+
+def make_reply(length: int) -> str:
+    sentence = "Я слышу, как непросто вам сейчас — и это важно заметить. "
+    body = (sentence * (length // len(sentence) + 1))[:length]
+    return body + "\n[STEP:pay_choice:webinar]"
+
+
+async def legacy_stream(reply: str) -> int:
+    accumulated = ""
+    edits = 0
+    for n, i in enumerate(range(0, len(reply), CHUNK)):
+        accumulated += reply[i:i + CHUNK]
+        display = _legacy_display(accumulated)
+        if n % EDIT_EVERY == 0:
+            edits += bool(display)
+        await asyncio.sleep(0)
+    return edits
+
+
+async def renderer_stream(reply: str) -> int:
+    renderer = StreamRenderer()
+    parts = []
+    edits = 0
+    for n, i in enumerate(range(0, len(reply), CHUNK)):
+        delta = reply[i:i + CHUNK]
+        parts.append(delta)
+        renderer.feed(delta)
+        if n % EDIT_EVERY == 0 and renderer.dirty:
+            renderer.display()
+            edits += 1
+        await asyncio.sleep(0)
+    "".join(parts)
+    return edits
+
+
+async def run(fn, reply: str, streams: int) -> tuple[float, int]:
+    t0 = time.process_time()
+    edits = await asyncio.gather(*(fn(reply) for _ in range(streams)))
+    return time.process_time() - t0, sum(edits)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="CPU на потоковый ответ: старый рендер vs StreamRenderer")
+    parser.add_argument("--streams", type=int, default=50)
+    parser.add_argument("--lengths", default="400,1500,4000")
+    args = parser.parse_args()
+
+    print(f"{args.streams} одновременных стримов, фрагмент {CHUNK} симв., правка раз в {EDIT_EVERY} фрагментов")
+    print(f"{'длина':>6} | {'старый, мс/ответ':>17} | {'новый, мс/ответ':>16} | {'ускорение':>9} | правок стар./нов.")
+    for length in [int(x) for x in args.lengths.split(",") if x.strip()]:
+        reply = make_reply(length)
+        old_cpu, old_edits = asyncio.run(run(legacy_stream, reply, args.streams))
+        new_cpu, new_edits = asyncio.run(run(renderer_stream, reply, args.streams))
+        old_ms = old_cpu * 1000 / args.streams
+        new_ms = new_cpu * 1000 / args.streams
+        speedup = old_ms / new_ms if new_ms else float("inf")
+        print(f"{length:>6} | {old_ms:>17.2f} | {new_ms:>16.2f} | {speedup:>8.1f}x | {old_edits}/{new_edits}")
+
+
+if __name__ == "__main__":
+    main()
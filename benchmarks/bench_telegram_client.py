@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Отправка серии сообщений в Bot API: urllib (новое соединение на каждое сообщение, как было в
+telegram_send_message и send_group_digest) против общего клиента telegram_api (пул keep-alive).
+
+Сеть не нужна: локальный HTTP-сервер отвечает как sendMessage, а установку соединения имитирует
+задержка --handshake на каждое новое соединение (TCP + TLS до api.telegram.org — 2–3 RTT).
+
+Запуск: python benchmarks/bench_telegram_client.py [--messages 100] [--handshake 0.06] [--concurrency 8]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram_api import SyncTelegramBotAPI, TelegramBotAPI  # noqa: E402
+
+
+def start_server(handshake: float) -> tuple[ThreadingHTTPServer, dict]:
+    stats = {"connections": 0, "requests": 0}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            super().setup()
+            with lock:
+                stats["connections"] += 1
+            time.sleep(handshake)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            with lock:
+                stats["requests"] += 1
+            body = json.dumps({"ok": True, "result": {"message_id": stats["requests"]}}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, stats
+
+
+def send_urllib(base_url: str, messages: int) -> None:
+    for i in range(messages):
+        payload = urlencode({"chat_id": "1", "text": f"msg {i}"}).encode("utf-8")
+        req = Request(f"{base_url}/bot123:bench/sendMessage", data=payload, method="POST")
+        req.add_header("Content-Type", "application/x-www-form-urlencoded")
+        with urlopen(req, timeout=10) as resp:
+            resp.read()
+
+
+def send_sync_client(base_url: str, messages: int) -> None:
+    api = SyncTelegramBotAPI("123:bench", base_url=base_url)
+    try:
+        for i in range(messages):
+            api.send_message(1, f"msg {i}")
+    finally:
+        api.close()
+
+
+def send_async_client(base_url: str, messages: int, concurrency: int) -> None:
+    async def run() -> None:
+        api = TelegramBotAPI("123:bench", base_url=base_url, max_connections=concurrency)
+        try:
+            await asyncio.gather(*(api.send_message(1, f"msg {i}") for i in range(messages)))
+        finally:
+            await api.aclose()
+
+    asyncio.run(run())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Новое соединение на сообщение против пула keep-alive")
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--handshake", type=float, default=0.06, help="задержка установки соединения, с")
+    parser.add_argument("--concurrency", type=int, default=8, help="соединений у async-клиента")
+    args = parser.parse_args()
+
+    server, stats = start_server(args.handshake)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    print(f"{args.messages} сообщений, установка соединения {args.handshake * 1000:.0f} мс")
+    print(f"{'клиент':<28} | {'время, с':>8} | {'сообщ./с':>8} | соединений")
+    modes = [
+        ("urllib, соединение на сообщ.", lambda: send_urllib(base_url, args.messages)),
+        ("SyncTelegramBotAPI", lambda: send_sync_client(base_url, args.messages)),
+        (f"TelegramBotAPI x{args.concurrency}", lambda: send_async_client(base_url, args.messages, args.concurrency)),
+    ]
+    for name, run in modes:
+        stats["connections"] = stats["requests"] = 0
+        t0 = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - t0
+        print(f"{name:<28} | {elapsed:>8.2f} | {args.messages / elapsed:>8.1f} | {stats['connections']}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
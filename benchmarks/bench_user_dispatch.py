@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный тест обработки update: последовательно (PTB по умолчанию) против параллельной
+обработки (concurrent_updates) с упорядочиванием по пользователю через UserDispatcher.
+
+Обработчик имитирует ответ бота: пишет реплику пользователя в историю, «ждёт DeepSeek»
+(asyncio.sleep со случайной задержкой) и пишет ответ. Telegram и DeepSeek не вызываются.
+Update приходят вперемешку от разных пользователей, по несколько подряд от каждого.
+Проверяется и порядок: в истории каждого пользователя реплики должны идти user, assistant, user, ...
+в порядке отправки. Режим «без очереди» показывает, что без диспетчера порядок ломается.
+
+Запуск: python benchmarks/bench_user_dispatch.py [--users 100] [--messages 4] [--latency 0.02] [--concurrency 64]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from user_dispatch import UserDispatcher  # noqa: E402
+
+
+def make_updates(users: int, messages: int, seed: int) -> list[tuple[int, int]]:
+    """(user_id, номер сообщения): у каждого пользователя сообщения по порядку, пользователи вперемешку."""
+    rng = random.Random(seed)
+    pending = {uid: 0 for uid in range(users)}
+    updates = []
+    while pending:
+        uid = rng.choice(list(pending))
+        updates.append((uid, pending[uid]))
+        pending[uid] += 1
+        if pending[uid] == messages:
+            del pending[uid]
+    return updates
+
+
+def make_handler(history: dict, latency: float, seed: int):
+    rng = random.Random(seed)
+
+    async def handler(user_id: int, n: int) -> None:
+        history[user_id].append(("user", n))
+        await asyncio.sleep(latency * rng.uniform(0.5, 1.5))
+        history[user_id].append(("assistant", n))
+
+    return handler
+
+
+def order_violations(history: dict, messages: int) -> int:
+    expected = [(role, n) for n in range(messages) for role in ("user", "assistant")]
+    return sum(1 for turns in history.values() if turns != expected)
+
+
+async def run_sequential(updates, handler) -> None:
+    for user_id, n in updates:
+        await handler(user_id, n)
+
+
+async def run_concurrent(updates, handler, concurrency: int, dispatcher: UserDispatcher | None) -> None:
+    # Как PTB concurrent_updates: не больше concurrency обработчиков одновременно, update берутся по порядку.
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = []
+    for user_id, n in updates:
+        await semaphore.acquire()
+
+        async def one(user_id=user_id, n=n):
+            try:
+                if dispatcher is None:
+                    await handler(user_id, n)
+                else:
+                    await dispatcher.run(user_id, handler, user_id, n)
+            finally:
+                semaphore.release()
+
+        tasks.append(asyncio.create_task(one()))
+    await asyncio.gather(*tasks)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Пропускная способность обработки update с очередью по пользователю")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=4, help="сообщений подряд от каждого пользователя")
+    parser.add_argument("--latency", type=float, default=0.02, help="средняя задержка ответа модели, с")
+    parser.add_argument("--concurrency", type=int, default=64, help="как CONCURRENT_UPDATES в bot.py")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    updates = make_updates(args.users, args.messages, args.seed)
+    print(f"{len(updates)} update от {args.users} пользователей, задержка ~{args.latency * 1000:.0f} мс, "
+          f"параллельно до {args.concurrency}")
+    print(f"{'режим':<24} | {'время, с':>8} | {'update/с':>8} | нарушений порядка")
+
+    modes = [
+        ("последовательно", lambda h: run_sequential(updates, h)),
+        ("параллельно + очередь", lambda h: run_concurrent(updates, h, args.concurrency, UserDispatcher())),
+        ("параллельно без очереди", lambda h: run_concurrent(updates, h, args.concurrency, None)),
+    ]
+    for name, runner in modes:
+        history = defaultdict(list)
+        handler = make_handler(history, args.latency, args.seed)
+        t0 = time.perf_counter()
+        asyncio.run(runner(handler))
+        elapsed = time.perf_counter() - t0
+        bad = order_violations(history, args.messages)
+        print(f"{name:<24} | {elapsed:>8.2f} | {len(updates) / elapsed:>8.1f} | {bad}")
+
+
+if __name__ == "__main__":
+    main()
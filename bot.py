@@ -14,24 +14,35 @@ import logging
 import tempfile
 import time
 import asyncio
-from collections import defaultdict
+import functools
 from typing import Optional, Callable
 
 from robokassa_integration import (
-    PaymentsDB,
+    PRO_ENTITLEMENTS,
     RobokassaConfig,
-    build_payment_url,
     _to_amount_str,
 )
+from prompt_compiler import PromptCompiler
+from conversation import ConversationHistory
+from conversation_store import store_from_env
+from streaming import StopCondition, StreamRenderer, default_stop_conditions, first_fired
+from edit_scheduler import EditScheduler
+from user_dispatch import UserDispatcher
+from reply_debounce import ReplyDebouncer
+from payments_async import payments_db_async
+from payment_links import PaymentLinkPrefetcher, payment_url_for_order
+from log_pipeline import setup_logging
 
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
+    TypeHandler,
     filters,
 )
 from openai import AsyncOpenAI
@@ -96,6 +107,10 @@ def _load_system_prompt() -> str:
 
 
 SYSTEM_PROMPT = _load_system_prompt()
+# Промпт по этапам: в запрос уходит ядро + секции для последнего [STEP:...] (см. prompt_compiler.py).
+# False = всегда отправлять SYSTEM_PROMPT целиком.
+PROMPT_ROUTING_ENABLED = True
+PROMPT_COMPILER = PromptCompiler(SYSTEM_PROMPT)
 
 
 def _load_validator_prompt() -> str:
@@ -138,8 +153,26 @@ def _load_simulator_prompt() -> str:
 SIMULATOR_PROMPT = _load_simulator_prompt()
 SIMULATOR_ENABLED = bool(SIMULATOR_PROMPT)
 
-# История диалога: сколько последних пар сообщений хранить (Этап 4). 0 = не хранить.
-MAX_HISTORY_MESSAGES = 10
+# История диалога (Этап 4): бюджет в токенах на последние реплики. Что не влезает — сжимается
+# в фоне в сводку (см. conversation.py), поэтому длинный монолог не раздувает контекст,
+# а короткие ответы кнопками не занимают «слоты». 0 = без лимита. Можно задать в .env.
+try:
+    HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "2500"))
+except (TypeError, ValueError):
+    HISTORY_TOKEN_BUDGET = 2500
+# Горячие диалоги в памяти: не больше HISTORY_CACHED_USERS; простаивающие дольше HISTORY_IDLE_MINUTES
+# выгружаются — при CONVERSATION_STORE=sqlite на диск, иначе сжимаются в памяти (zlib).
+# Подбор размера VM: python benchmarks/bench_history_memory.py
+HISTORY_CACHED_USERS = 10000
+HISTORY_IDLE_MINUTES = 30
+# Сводка вытесненных реплик: короткий вызов DeepSeek с низкой температурой.
+HISTORY_SUMMARY_MAX_TOKENS = 400
+HISTORY_SUMMARY_PROMPT = (
+    "Ты ведёшь конспект диалога психолога с клиентом. Обнови краткую сводку: сохрани имя, форму обращения, "
+    "возраст, канал и контакт для связи, описание состояния, длительность, предыдущие попытки, выбранный "
+    "конфликт, оценку по шкале, инсайт, готовность, выбранный продукт и тариф, а также на каком шаге диалога "
+    "остановились. Только факты, без оценок, не больше 120 слов, обычным текстом."
+)
 
 # Максимальная длина ответа ИИ в символах (Этап 2). 0 = без жёсткого лимита.
 MAX_RESPONSE_LENGTH = 0
@@ -158,7 +191,20 @@ PRIVACY_TEXT = "Сообщения обрабатываются для отве
 # Разрешённые user_id (Этап 6). Пустой список = доступ у всех. Иначе только эти id.
 ALLOWED_USER_IDS = []  # Пример: [123456789, 987654321]
 
-# Логирование в файл (Этап 5). True = писать в bot.log.
+# Режим Pro-бота (DATABASE_DESIGN 3.3): отвечать только пользователям с действующей подпиской Pro
+# (orders.access_until). Действующий доступ — из кэша процесса (robokassa_integration.PRO_ENTITLEMENTS),
+# перед отказом — запрос к базе: оплату принимает robokassa_server, и его сброс кэша сюда не доходит.
+PRO_ACCESS_REQUIRED = (os.getenv("PRO_ACCESS_REQUIRED") or "").strip().lower() in ("1", "true", "yes")
+# Команды, доступные и без подписки.
+PRO_OPEN_COMMANDS = ("/support", "/privacy")
+PRO_ACCESS_DENIED_TEXT = (
+    "Доступ к ИИ-психологу открыт по подписке, а она сейчас не активна или закончилась. "
+    "Продлить её можно в основном боте — после оплаты просто напишите сюда снова."
+)
+# db_errors — проверок, на которых база не ответила; stale_served — из них решено по последней записи кэша.
+PRO_GATE_COUNTERS = {"db_errors": 0, "stale_served": 0}
+
+# Логирование в файл (Этап 5). True = писать в bot.log (JSON-строки, ротация по размеру; LOG_MAX_BYTES, LOG_BACKUP_COUNT).
 LOG_TO_FILE = False
 
 # Модель DeepSeek (Этап 2): "deepseek-chat" или "deepseek-reasoner"
@@ -167,6 +213,38 @@ DEEPSEEK_MODEL = "deepseek-chat"
 # Потоковый вывод ответа (Этап 2). True = ответ печатается по частям.
 STREAM_RESPONSE = True
 
+# Правки сообщений при стриме: общий на процесс планировщик (edit_scheduler.py).
+# STREAM_EDITS_PER_SEC — лимит правок в секунду на весь бот; STREAM_CHAT_EDIT_INTERVAL_SEC — минимальный
+# интервал между правками в одном чате (при большой нагрузке увеличивается автоматически).
+STREAM_EDITS_PER_SEC = 25.0
+STREAM_CHAT_EDIT_INTERVAL_SEC = 0.5
+
+# Ранняя остановка генерации (streaming.py): стрим DeepSeek закрывается, как только закрыт финальный
+# тег [STEP:...], видимый текст превысил бюджет на границе предложения или модель зациклилась.
+# STREAM_STOP_CHAR_BUDGET — бюджет видимых символов (0 = без лимита); по умолчанию с запасом к MAX_RESPONSE_CHARS.
+STREAM_STOP_ENABLED = True
+try:
+    STREAM_STOP_CHAR_BUDGET = int(os.getenv("STREAM_STOP_CHAR_BUDGET", str(max(MAX_RESPONSE_CHARS * 3, 1000))))
+except ValueError:
+    STREAM_STOP_CHAR_BUDGET = max(MAX_RESPONSE_CHARS * 3, 1000)
+
+# Параллельная обработка update (PTB concurrent_updates): сколько update обрабатывать одновременно
+# (0 = последовательно, как раньше). Сообщения одного пользователя всё равно идут строго по очереди
+# (user_dispatch.py), параллельны только разные пользователи.
+CONCURRENT_UPDATES = 64
+
+# Ссылка на оплату готовится заранее (payment_links.py): при показе кнопки «Оплатить» в фоне создаётся
+# заказ 'draft' и подписанная ссылка, нажатие отвечает без обращения к базе на создание заказа.
+# Подготовленная ссылка годится PAYMENT_LINK_PREFETCH_TTL_SEC, неиспользованные заказы 'draft' удаляются через вдвое больший срок.
+PAYMENT_LINK_PREFETCH = True
+PAYMENT_LINK_PREFETCH_TTL_SEC = 600
+
+# Склейка сообщений, отправленных подряд (reply_debounce.py): ответ строится после BURST_DEBOUNCE_SEC
+# тишины, тексты всех сообщений уходят модели одной репликой; ещё не готовый ответ на предыдущие
+# сообщения отменяется. В режиме webhook не применяется (каждый update — отдельный вызов).
+BURST_MERGE_ENABLED = True
+BURST_DEBOUNCE_SEC = 1.0
+
 # Голосовые сообщения: транскрипция через OpenAI Whisper. Нужен OPENAI_API_KEY в .env.
 VOICE_ENABLED = True
 
@@ -280,7 +358,53 @@ client = AsyncOpenAI(
 )
 # OpenAI — только для Whisper (голосовые). Если ключа нет, голос отключён.
 openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
-user_history = defaultdict(list)
+
+
+async def _summarize_history(previous_summary: str, turns: list[dict]) -> str:
+    """Сжимает вытесненные из бюджета реплики (и прошлую сводку) в новую сводку через DeepSeek."""
+    lines = []
+    if previous_summary:
+        lines.append("Текущая сводка:\n" + previous_summary)
+    lines.append("Новые реплики:")
+    for t in turns:
+        who = "Психолог" if t["role"] == "assistant" else "Клиент"
+        lines.append(f"{who}: {t['content']}")
+    response = await client.chat.completions.create(
+        model=DEEPSEEK_MODEL,
+        messages=[
+            {"role": "system", "content": HISTORY_SUMMARY_PROMPT},
+            {"role": "user", "content": "\n".join(lines)},
+        ],
+        max_tokens=HISTORY_SUMMARY_MAX_TOKENS,
+        temperature=0.3,
+    )
+    return response.choices[0].message.content or previous_summary
+
+
+# Хранилище истории: CONVERSATION_STORE=memory|sqlite (см. conversation_store.py).
+# Этап диалога (последний step_id, по нему выбираются секции промпта) хранится вместе с историей.
+user_history = ConversationHistory(
+    HISTORY_TOKEN_BUDGET,
+    summarizer=_summarize_history,
+    store=store_from_env(),
+    max_cached_users=HISTORY_CACHED_USERS,
+    idle_after=HISTORY_IDLE_MINUTES * 60,
+)
+EDIT_SCHEDULER = EditScheduler(STREAM_EDITS_PER_SEC, STREAM_CHAT_EDIT_INTERVAL_SEC)
+USER_DISPATCHER = UserDispatcher()
+REPLY_DEBOUNCER = ReplyDebouncer(BURST_DEBOUNCE_SEC)
+PAYMENT_LINKS = PaymentLinkPrefetcher(ttl=PAYMENT_LINK_PREFETCH_TTL_SEC)
+
+
+def _ordered_per_user(handler: Callable) -> Callable:
+    """Обработчики, меняющие историю диалога, выполняются для одного пользователя по очереди (FIFO)."""
+
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        user_id = update.effective_user.id if update.effective_user else 0
+        await USER_DISPATCHER.run(user_id, handler, update, context)
+
+    return wrapper
 
 
 def _format_reply_for_telegram(text: str) -> tuple[str, Optional[str]]:
@@ -402,23 +526,35 @@ def _parse_custom_buttons(reply: str) -> tuple[str, Optional[InlineKeyboardMarku
     return cleaned, keyboard
 
 
+def _system_prompt_for_user(user_id: int) -> str:
+    """Системный промпт для текущего этапа пользователя (или полный, если роутинг выключен)."""
+    if not PROMPT_ROUTING_ENABLED:
+        return SYSTEM_PROMPT
+    last = user_history.last(user_id)
+    include_anket = bool(last) and last["role"] == "user" and last["content"] == "SHOW_JSON"
+    return PROMPT_COMPILER.compile(user_history.stage(user_id), include_anket=include_anket)
+
+
+def _remember_step(user_id: int, step_id: Optional[str]) -> None:
+    """Запоминает этап диалога по тегу ответа. [STEP:custom] этап не меняет."""
+    stage = PROMPT_COMPILER.stage_for_step(step_id)
+    if stage:
+        user_history.set_stage(user_id, stage)
+
+
 def get_history_messages(user_id: int) -> list[dict]:
     """Возвращает список сообщений для API OpenAI в формате role/content."""
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-    for item in user_history[user_id]:
-        messages.append({"role": item["role"], "content": item["content"]})
+    messages = [{"role": "system", "content": _system_prompt_for_user(user_id)}]
+    messages.extend(user_history.messages(user_id))
     return messages
 
 
 def add_to_history(user_id: int, role: str, content: str) -> None:
-    user_history[user_id].append({"role": role, "content": content})
-    if MAX_HISTORY_MESSAGES > 0:
-        while len(user_history[user_id]) > MAX_HISTORY_MESSAGES * 2:
-            user_history[user_id].pop(0)
+    user_history.add(user_id, role, content)
 
 
 def clear_history(user_id: int) -> None:
-    user_history[user_id].clear()
+    user_history.clear(user_id)
 
 
 def truncate_response(text: str) -> str:
@@ -443,6 +579,40 @@ async def check_access(update: Update) -> bool:
     return True
 
 
+async def pro_access_gate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Гейт Pro-бота (TypeHandler в группе -1, до всех обработчиков): без действующей подписки update дальше
+    не обрабатывается. Действующий доступ берётся из кэша; «нет доступа» перепроверяется в базе мимо кэша —
+    оплата, только что принятая robokassa_server, видна сразу. База недоступна — решает последняя запись
+    кэша, а без неё доступ закрыт.
+    """
+    user = update.effective_user
+    if user is None:
+        return
+    message = update.effective_message
+    text = (message.text or "").strip() if message else ""
+    if text and text.split()[0].split("@")[0] in PRO_OPEN_COMMANDS:
+        return
+    entitlement = PRO_ENTITLEMENTS.get(user.id)
+    if entitlement is not None and entitlement.active:
+        return
+    try:
+        entitlement = await payments_db_async().call("pro_entitlement", user.id, use_cache=False)
+    except Exception:
+        PRO_GATE_COUNTERS["db_errors"] += 1
+        logging.exception("Pro: не удалось проверить доступ user_id=%s", user.id)
+        entitlement = PRO_ENTITLEMENTS.last_known(user.id)
+        if entitlement is not None:
+            PRO_GATE_COUNTERS["stale_served"] += 1
+    if entitlement is not None and entitlement.active:
+        return
+    if update.callback_query:
+        await update.callback_query.answer()
+    if message:
+        await message.reply_text(PRO_ACCESS_DENIED_TEXT)
+    raise ApplicationHandlerStop
+
+
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not await check_access(update):
         return
@@ -462,7 +632,7 @@ async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "Команды: /start — начало разговора, /help — эта справка."
         + (" /support — контакты поддержки." if SUPPORT_TEXT else "")
         + (" /privacy — конфиденциальность." if PRIVACY_TEXT else "")
-        + (" /new — начать диалог заново (сбросить контекст)." if MAX_HISTORY_MESSAGES else "")
+        + " /new — начать диалог заново (сбросить контекст)."
     )
 
 
@@ -484,6 +654,7 @@ async def cmd_privacy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     await update.message.reply_text(PRIVACY_TEXT)
 
 
+@_ordered_per_user
 async def cmd_new(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Сброс контекста диалога (команда /new)."""
     if not await check_access(update):
@@ -492,6 +663,7 @@ async def cmd_new(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     clear_history(user_id)
     await update.message.reply_text("Контекст сброшен. Можешь начать разговор заново — напиши сообщение или нажми /start.")
 
+@_ordered_per_user
 async def button_new_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
@@ -501,7 +673,7 @@ async def button_new_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if ALLOWED_USER_IDS and user_id not in ALLOWED_USER_IDS:
         await query.edit_message_text("Доступ ограничен.")
         return
-    had_history = len(user_history[user_id]) > 0
+    had_history = user_history.has_history(user_id)
     clear_history(user_id)
     if had_history:
         await query.edit_message_text("Контекст сброшен. Можешь начать новый разговор.")
@@ -509,6 +681,7 @@ async def button_new_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.edit_message_text("История пуста. Напиши сообщение — и мы начнём.")
 
 
+@_ordered_per_user
 async def button_start_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Кнопка «Начать» при /start — запускает первый ответ бота (как если бы пользователь написал «Начать»)."""
     if not update.callback_query:
@@ -548,6 +721,7 @@ def _apply_product_and_tariff_from_text(context: ContextTypes.DEFAULT_TYPE, text
             context.user_data["selected_product"] = "group"
 
 
+@_ordered_per_user
 async def handle_step_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработка нажатия кнопки шага: callback_data уходит в модель как ответ пользователя."""
     if not update.callback_query:
@@ -594,7 +768,7 @@ async def handle_step_button(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     # «Еще думаю» — сохраняем анкету из контекста (отказ от оплаты), затем продолжаем диалог.
     if user_text == "Еще думаю":
-        _save_anket_after_refusal(update, context)
+        await _save_anket_after_refusal(update, context)
 
     await _reply_to_user(update, context, user_id, user_text)
 
@@ -620,40 +794,37 @@ async def send_payment_link(update: Update, context: ContextTypes.DEFAULT_TYPE,
         await query.edit_message_text("Сначала выбери тариф (VIP или Стандарт) для групповых занятий.")
         return
 
-    try:
-        cfg = RobokassaConfig.from_env()
-        db = PaymentsDB.from_env()
-    except Exception as e:
-        logging.exception("Robokassa config/db error: %s", e)
-        await query.edit_message_text("Оплата временно недоступна. Попробуй позже.")
-        return
-
     product = PRODUCTS[product_code]
     amount = str(product["amount"])
     description = str(product["description"])
 
-    inv_id, token = db.create_order(
-        user_id=int(user.id),
-        chat_id=int(chat.id),
-        product_code=str(product_code),
-        amount=amount,
-        description=description,
-    )
-
-    shp = {
-        "Shp_user_id": str(user.id),
-        "Shp_chat_id": str(chat.id),
-        "Shp_product": str(product_code),
-        "Shp_order_token": token,
-    }
-
-    pay_url = build_payment_url(
-        cfg=cfg,
-        inv_id=inv_id,
-        out_sum=amount,
-        description=description,
-        shp=shp,
-    )
+    # Заказ и ссылка обычно уже готовы (PAYMENT_LINKS.prefetch при показе кнопки «Оплатить»).
+    pay_url = await PAYMENT_LINKS.take(user_id=int(user.id), chat_id=int(chat.id), product_code=str(product_code))
+    if pay_url is None:
+        # База — в пуле потоков (payments_async.py): занятая SQLite не останавливает стримы других пользователей.
+        try:
+            cfg = RobokassaConfig.from_env()
+            inv_id, token = await payments_db_async().create_order(
+                user_id=int(user.id),
+                chat_id=int(chat.id),
+                product_code=str(product_code),
+                amount=amount,
+                description=description,
+            )
+        except Exception as e:
+            logging.exception("Robokassa config/db error: %s", e)
+            await query.edit_message_text("Оплата временно недоступна. Попробуй позже.")
+            return
+        pay_url = payment_url_for_order(
+            cfg,
+            inv_id=inv_id,
+            order_token=token,
+            user_id=int(user.id),
+            chat_id=int(chat.id),
+            product_code=str(product_code),
+            amount=amount,
+            description=description,
+        )
 
     kb = InlineKeyboardMarkup([[InlineKeyboardButton("Перейти к оплате", url=pay_url)]])
     await query.edit_message_text(
@@ -663,8 +834,53 @@ async def send_payment_link(update: Update, context: ContextTypes.DEFAULT_TYPE,
     )
 
 
-async def _generate_reply(msgs: list[dict], stream: bool = False, on_chunk: Optional[Callable[[str], None]] = None) -> str:
-    """Генерация ответа модели. При stream=True и on_chunk вызывается on_chunk(accumulated) для каждого фрагмента (on_chunk может быть async)."""
+def _prefetch_payment_link(update: Update, keyboard: Optional[InlineKeyboardMarkup]) -> None:
+    """Если в клавиатуре есть «Оплатить» (callback pay:КОД), заказ и ссылка готовятся в фоне до нажатия."""
+    chat = update.effective_chat
+    user = update.effective_user
+    if not PAYMENT_LINK_PREFETCH or keyboard is None or not chat or not user:
+        return
+    for row in keyboard.inline_keyboard:
+        for btn in row:
+            data = btn.callback_data
+            if not isinstance(data, str) or not data.startswith("pay:") or data[4:] not in PRODUCTS:
+                continue
+            product = PRODUCTS[data[4:]]
+            PAYMENT_LINKS.prefetch(
+                user_id=int(user.id),
+                chat_id=int(chat.id),
+                product_code=data[4:],
+                amount=str(product["amount"]),
+                description=str(product["description"]),
+            )
+
+
+def _stop_conditions_for(user_text: str) -> Optional[list[StopCondition]]:
+    """Условия остановки для ответа на user_text; для SHOW_JSON (анкета JSON) — без ранней остановки."""
+    if not STREAM_STOP_ENABLED or user_text == "SHOW_JSON":
+        return None
+    return default_stop_conditions(STREAM_STOP_CHAR_BUDGET)
+
+
+async def _generate_reply(
+    msgs: list[dict],
+    stream: bool = False,
+    on_chunk: Optional[Callable[[str], None]] = None,
+    *,
+    renderer: Optional[StreamRenderer] = None,
+    stop_conditions: Optional[list[StopCondition]] = None,
+    stats: Optional[dict] = None,
+) -> str:
+    """
+    Генерация ответа модели. При stream=True и on_chunk вызывается on_chunk(delta) для каждого нового фрагмента (on_chunk может быть async).
+    renderer — StreamRenderer, который получает каждый фрагмент до on_chunk. stop_conditions — при срабатывании
+    любого стрим закрывается досрочно (заданные условия включают стрим). В stats["stop_reason"] пишется
+    причина остановки: reason условия или finish_reason модели (stop, length).
+    """
+    if stop_conditions:
+        stream = True
+        if renderer is None:
+            renderer = StreamRenderer()
     if stream:
         stream_obj = await client.chat.completions.create(
             model=DEEPSEEK_MODEL,
@@ -673,18 +889,41 @@ async def _generate_reply(msgs: list[dict], stream: bool = False, on_chunk: Opti
             temperature=1.75,
             stream=True,
         )
-        accumulated = ""
-        async for chunk in stream_obj:
-            if chunk.choices and chunk.choices[0].delta.content:
-                accumulated += chunk.choices[0].delta.content
-                if on_chunk:
-                    try:
-                        result = on_chunk(accumulated)
-                        if asyncio.iscoroutine(result):
-                            await result
-                    except Exception:
-                        pass
-        return truncate_response(accumulated.strip()) or "Не удалось сформировать ответ."
+        parts: list[str] = []
+        stop_reason = None
+        try:
+            async for chunk in stream_obj:
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if choice.finish_reason:
+                    stop_reason = choice.finish_reason
+                if choice.delta.content:
+                    delta = choice.delta.content
+                    parts.append(delta)
+                    if renderer is not None:
+                        renderer.feed(delta)
+                    if on_chunk:
+                        try:
+                            result = on_chunk(delta)
+                            if asyncio.iscoroutine(result):
+                                await result
+                        except Exception:
+                            pass
+                    if stop_conditions:
+                        fired = first_fired(stop_conditions, renderer)
+                        if fired:
+                            stop_reason = fired
+                            # Закрываем HTTP-стрим: DeepSeek перестаёт генерировать, лишние токены не оплачиваются.
+                            await stream_obj.close()
+                            break
+        except asyncio.CancelledError:
+            # Ответ вытеснен (новое сообщение пользователя) — стрим тоже закрываем.
+            await stream_obj.close()
+            raise
+        if stats is not None:
+            stats["stop_reason"] = stop_reason or "stop"
+        return truncate_response("".join(parts).strip()) or "Не удалось сформировать ответ."
     response = await client.chat.completions.create(
         model=DEEPSEEK_MODEL,
         messages=msgs,
@@ -693,6 +932,8 @@ async def _generate_reply(msgs: list[dict], stream: bool = False, on_chunk: Opti
         stream=False,
     )
     raw = response.choices[0].message.content or ""
+    if stats is not None:
+        stats["stop_reason"] = response.choices[0].finish_reason or "stop"
     return truncate_response(raw.strip()) or "Не удалось сформировать ответ."
 
 
@@ -707,18 +948,31 @@ async def get_bot_reply(
     """
     Один шаг диалога без Telegram. Возвращает (reply_clean, buttons, validator_outputs, timings, rejected_reply_clean).
     Валидатор отключён: validator_outputs всегда [], rejected_reply_clean всегда None.
-    stream_callback(text_so_far): при задании ответ психолога стримится по фрагментам.
+    stream_callback(text_so_far): при задании ответ психолога стримится; вызывается с видимым текстом (без тегов) при его изменении.
     """
     add_to_history(user_id, "user", user_text)
     messages = get_history_messages(user_id)
     use_stream = stream_callback is not None
+    renderer = StreamRenderer()
+
+    def emit(delta: str) -> None:
+        if renderer.dirty:
+            stream_callback(renderer.display())
+
+    stats: dict = {}
     t0_psych = time.monotonic()
     reply_raw = await _generate_reply(
-        messages, stream=use_stream, on_chunk=stream_callback if use_stream else None
+        messages,
+        stream=use_stream,
+        on_chunk=emit if use_stream else None,
+        renderer=renderer,
+        stop_conditions=_stop_conditions_for(user_text),
+        stats=stats,
     )
     psychologist_ms = int((time.monotonic() - t0_psych) * 1000)
 
     reply_clean, step_id = _parse_step_from_reply(reply_raw)
+    _remember_step(user_id, step_id)
     keyboard = _keyboard_for_step(step_id, context) if step_id else None
     if keyboard is None:
         reply_clean, keyboard = _parse_custom_buttons(reply_clean)
@@ -728,7 +982,7 @@ async def get_bot_reply(
         for row in keyboard.inline_keyboard:
             for btn in row:
                 buttons.append((getattr(btn, "text", ""), getattr(btn, "callback_data", "")))
-    timings = {"psychologist_ms": psychologist_ms}
+    timings = {"psychologist_ms": psychologist_ms, "stop_reason": stats.get("stop_reason")}
     return (reply_clean or "").strip(), buttons, [], timings, None
 
 
@@ -835,7 +1089,7 @@ def _anket_flat_from_parsed(parsed: dict, user_id: int, chat_id: int, username:
     }
 
 
-def _save_anket_from_show_json(update: Update, reply_clean: str) -> None:
+async def _save_anket_from_show_json(update: Update, reply_clean: str) -> None:
     """После ответа на SHOW_JSON парсит JSON из ответа и сохраняет анкету в clients."""
     if (reply_clean or "").strip() == "":
         return
@@ -847,7 +1101,6 @@ def _save_anket_from_show_json(update: Update, reply_clean: str) -> None:
     if not parsed or not isinstance(parsed, dict):
         return
     try:
-        db = PaymentsDB.from_env()
         flat = _anket_flat_from_parsed(
             parsed,
             user_id=user.id,
@@ -856,12 +1109,14 @@ def _save_anket_from_show_json(update: Update, reply_clean: str) -> None:
             first_name=user.first_name,
             last_name=user.last_name,
         )
-        db.upsert_client(**{k: v for k, v in flat.items() if k != "user_id" and v is not None}, user_id=flat["user_id"])
+        await payments_db_async().upsert_client(
+            **{k: v for k, v in flat.items() if k != "user_id" and v is not None}, user_id=flat["user_id"]
+        )
     except Exception as e:
         logging.exception("Сохранение анкеты (SHOW_JSON): %s", e)
 
 
-def _save_anket_after_refusal(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def _save_anket_after_refusal(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Сохраняет/обновляет анкету клиента после нажатия «Еще думаю» (отказ от оплаты).
     Один клиент = одна строка по user_id (или username при необходимости).
@@ -871,8 +1126,7 @@ def _save_anket_after_refusal(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not user or not chat:
         return
     try:
-        db = PaymentsDB.from_env()
-        db.upsert_client(
+        await payments_db_async().upsert_client(
             user_id=user.id,
             chat_id=chat.id,
             username=user.username,
@@ -901,71 +1155,103 @@ async def _reply_to_user(
     if not target or not chat:
         return
 
-    await chat.send_action("typing")
-
+    sent_msg = None
     try:
+        await chat.send_action("typing")
         sent_msg = await target.reply_text("…")
 
-        # Потоковый вывод. Троттлинг ~0.2 с.
-        last_stream_edit = [0.0]
-        STREAM_THROTTLE_SEC = 0.2
-
-        async def stream_edit(accumulated: str) -> None:
-            display, _ = _parse_step_from_reply(accumulated)
-            # Убираем из показа любые фрагменты вида [...]
-            display = re.sub(r"\[[^\]]*\]", "", display or "")
-            display = re.sub(r"  +", " ", display).strip()
-            display = display or "…"
-            if len(display) > 4090:
-                display = display[:4090] + "..."
-            now = time.monotonic()
-            if now - last_stream_edit[0] >= STREAM_THROTTLE_SEC or not last_stream_edit[0]:
-                try:
-                    await sent_msg.edit_text(display or "…")
-                    last_stream_edit[0] = now
-                except Exception:
-                    pass
-
-        reply_raw = await _generate_reply(messages, stream=True, on_chunk=stream_edit)
+        # Потоковый вывод: правки идут через общий планировщик (бюджеты на чат и на бота, latest-wins);
+        # фрагменты в рендер подаёт _generate_reply, правка ставится, только если видимый текст изменился,
+        # текст собирается в момент отправки.
+        renderer = StreamRenderer()
+        shown = [0]
+
+        def stream_edit(delta: str) -> None:
+            if renderer.visible_len != shown[0]:
+                shown[0] = renderer.visible_len
+                EDIT_SCHEDULER.submit(sent_msg, renderer.display)
+
+        stats: dict = {}
+        t0 = time.monotonic()
+        reply_raw = await _generate_reply(
+            messages,
+            stream=True,
+            on_chunk=stream_edit,
+            renderer=renderer,
+            stop_conditions=_stop_conditions_for(user_text),
+            stats=stats,
+        )
+        # Ответ готов — новое сообщение пользователя его уже не вытесняет, а ждёт своей очереди.
+        REPLY_DEBOUNCER.commit(user_id)
+        logging.info(
+            "Ответ user_id=%s: %d мс, %d симв., остановка: %s",
+            user_id,
+            int((time.monotonic() - t0) * 1000),
+            renderer.raw_len,
+            stats.get("stop_reason"),
+        )
 
         reply_clean, step_id = _parse_step_from_reply(reply_raw)
+        _remember_step(user_id, step_id)
         keyboard = _keyboard_for_step(step_id, context) if step_id else None
         if keyboard is None:
             reply_clean, keyboard = _parse_custom_buttons(reply_clean)
+        _prefetch_payment_link(update, keyboard)
         final_text = reply_clean[:4096] if len(reply_clean) > 4096 else reply_clean
         final_text, parse_mode = _format_reply_for_telegram(final_text)
         if len(final_text) > 4096:
             final_text = final_text[:4093] + "..."
 
-        try:
-            await sent_msg.edit_text(
-                final_text,
-                parse_mode=parse_mode if parse_mode else None,
-                reply_markup=keyboard,
-            )
-        except Exception:
-            pass
+        await EDIT_SCHEDULER.finalize(
+            sent_msg,
+            final_text,
+            parse_mode=parse_mode if parse_mode else None,
+            reply_markup=keyboard,
+        )
         add_to_history(user_id, "assistant", reply_clean or "")
+    except asyncio.CancelledError:
+        # Вытеснен новым сообщением: реплика пользователя уйдёт модели в склейке, заглушку убираем.
+        user_history.pop_last(user_id)
+        if sent_msg is not None:
+            EDIT_SCHEDULER.discard(sent_msg)
+            try:
+                await sent_msg.delete()
+            except Exception as e:
+                logging.debug("Не удалось удалить заглушку ответа: %s", e)
+        raise
     except APIStatusError as e:
-        if user_history[user_id]:
-            user_history[user_id].pop()
+        user_history.pop_last(user_id)
         err_text = (
             "Сейчас сервис ответов временно недоступен (исчерпан баланс API). Попробуй позже или обратись к администратору бота."
             if e.status_code == 402
             else "Что-то пошло не так при ответе. Попробуй ещё раз или позже."
         )
-        try:
-            await sent_msg.edit_text(err_text)
-        except Exception:
+        if sent_msg is None or not await EDIT_SCHEDULER.finalize(sent_msg, err_text):
             await target.reply_text(err_text)
     except Exception as e:
         logging.exception("DeepSeek API error: %s", e)
-        if user_history[user_id]:
-            user_history[user_id].pop()
-        try:
-            await sent_msg.edit_text("Что-то пошло не так при ответе. Попробуй ещё раз или позже.")
-        except Exception:
-            await target.reply_text("Что-то пошло не так при ответе. Попробуй ещё раз или позже.")
+        user_history.pop_last(user_id)
+        err_text = "Что-то пошло не так при ответе. Попробуй ещё раз или позже."
+        if sent_msg is None or not await EDIT_SCHEDULER.finalize(sent_msg, err_text):
+            await target.reply_text(err_text)
+
+
+async def _submit_user_text(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, text: str) -> None:
+    """Ответ на сообщение пользователя: со склейкой сообщений подряд (если включена) и по очереди пользователя."""
+
+    async def reply(merged: str) -> None:
+        await USER_DISPATCHER.run(user_id, _reply_to_user, update, context, user_id, merged)
+
+    if BURST_MERGE_ENABLED and context.bot_data.get("burst_merge", True):
+        await REPLY_DEBOUNCER.submit(user_id, text, reply, order=update.effective_message.message_id)
+    else:
+        await reply(text)
+
+
+async def _show_json_ack(update: Update, user_id: int, text: str) -> None:
+    add_to_history(user_id, "user", text)
+    add_to_history(user_id, "assistant", "Запрос принят. Можем продолжить разговор.")
+    await update.message.reply_text("Запрос принят. Можем продолжить разговор.")
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -979,16 +1265,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     # Служебная команда SHOW_JSON — не передаём в модель, клиенту не показываем никакой JSON.
     if text == "SHOW_JSON":
-        add_to_history(user_id, "user", text)
-        add_to_history(user_id, "assistant", "Запрос принят. Можем продолжить разговор.")
-        await update.message.reply_text("Запрос принят. Можем продолжить разговор.")
+        await USER_DISPATCHER.run(user_id, _show_json_ack, update, user_id, text)
         return
 
     # Сохраняем выбор продукта/тарифа и при текстовом ответе (напр. «ВИП», «Групповые занятия»),
     # чтобы кнопка «Оплатить» потом работала.
     _apply_product_and_tariff_from_text(context, text)
 
-    await _reply_to_user(update, context, user_id, text)
+    await _submit_user_text(update, context, user_id, text)
 
 
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1036,24 +1320,26 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
     # Служебная команда SHOW_JSON — не передаём в модель, клиенту не показываем JSON.
     if user_text == "SHOW_JSON":
-        add_to_history(user_id, "user", user_text)
-        add_to_history(user_id, "assistant", "Запрос принят. Можем продолжить разговор.")
-        await update.message.reply_text("Запрос принят. Можем продолжить разговор.")
+        await USER_DISPATCHER.run(user_id, _show_json_ack, update, user_id, user_text)
         return
 
     _apply_product_and_tariff_from_text(context, user_text)
 
     await update.message.reply_text(f"🎤 Ты сказал(а): {user_text}")
-    await _reply_to_user(update, context, user_id, user_text)
+    await _submit_user_text(update, context, user_id, user_text)
 
 
 def build_application() -> Application:
     """Собирает и возвращает приложение бота (для polling или webhook)."""
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+    builder = Application.builder().token(TELEGRAM_TOKEN)
+    if CONCURRENT_UPDATES > 0:
+        builder = builder.concurrent_updates(CONCURRENT_UPDATES)
+    app = builder.build()
+    if PRO_ACCESS_REQUIRED:
+        app.add_handler(TypeHandler(Update, pro_access_gate), group=-1)
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("help", cmd_help))
-    if MAX_HISTORY_MESSAGES:
-        app.add_handler(CommandHandler("new", cmd_new))
+    app.add_handler(CommandHandler("new", cmd_new))
     if SUPPORT_TEXT:
         app.add_handler(CommandHandler("support", cmd_support))
     if PRIVACY_TEXT:
@@ -1067,39 +1353,78 @@ def build_application() -> Application:
     return app
 
 
+# Webhook (Cloud Functions): приложение собирается и инициализируется один раз на «тёплый» контейнер
+# и переиспользуется между вызовами (вместе с HTTP-клиентами), пока жив его цикл событий. Если вызовов
+# не было дольше WEBHOOK_APP_MAX_IDLE_SEC (контейнер, скорее всего, замораживался и соединения
+# протухли), приложение пересобирается.
+WEBHOOK_APP_MAX_IDLE_SEC = 300.0
+_webhook_app: Optional[Application] = None
+_webhook_loop: Optional[asyncio.AbstractEventLoop] = None
+_webhook_last_used = 0.0
+
+
+async def _get_webhook_app() -> Application:
+    global _webhook_app, _webhook_loop
+    loop = asyncio.get_running_loop()
+    if _webhook_app is not None:
+        if _webhook_loop is not loop:
+            # Прежний цикл событий закрыт (например, asyncio.run на каждый вызов) — его объекты не переиспользовать.
+            _webhook_app = None
+        elif time.monotonic() - _webhook_last_used > WEBHOOK_APP_MAX_IDLE_SEC:
+            logging.info("Webhook: простой дольше %.0f с — пересобираем приложение", WEBHOOK_APP_MAX_IDLE_SEC)
+            await shutdown_webhook_app()
+    if _webhook_app is None:
+        app = build_application()
+        # Каждый update — отдельный вызов: склеивать не с чем, окно тишины только задержало бы ответ.
+        app.bot_data["burst_merge"] = False
+        await app.initialize()
+        _webhook_app, _webhook_loop = app, loop
+    return _webhook_app
+
+
+async def shutdown_webhook_app() -> None:
+    """Закрывает закэшированное webhook-приложение (следующий update соберёт новое)."""
+    global _webhook_app, _webhook_loop
+    app, _webhook_app, _webhook_loop = _webhook_app, None, None
+    if app is None:
+        return
+    try:
+        await app.shutdown()
+    except Exception as e:
+        logging.warning("Webhook: остановка приложения не удалась: %s", e)
+
+
 async def process_webhook_update(update_body: str) -> None:
     """
     Обрабатывает один update от Telegram (режим webhook).
     Для использования в Cloud Functions: передайте сюда тело HTTP-запроса (JSON).
+    Приложение переиспользуется между вызовами в одном цикле событий (см. deploy/handler_webhook.py).
     """
-    import json
-    app = build_application()
-    update_data = json.loads(update_body)
-    update = Update.de_json(update_data, app.bot)
-    await app.initialize()
+    global _webhook_last_used
+    app = await _get_webhook_app()
+    update = Update.de_json(json.loads(update_body), app.bot)
     try:
         await app.process_update(update)
     finally:
-        await app.shutdown()
+        _webhook_last_used = time.monotonic()
+        # Экземпляр функции может быть остановлен сразу после ответа — дописываем историю до возврата.
+        user_history.flush()
 
 
 def main() -> None:
-    if LOG_TO_FILE:
-        logging.basicConfig(
-            format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-            level=logging.INFO,
-            filename="bot.log",
-            encoding="utf-8",
-        )
-    else:
-        logging.basicConfig(
-            format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-            level=logging.INFO,
-        )
+    # Запись — в фоновом потоке (log_pipeline.py); bot.log — JSON-строки с ротацией по размеру.
+    setup_logging(service="bot", log_file="bot.log" if LOG_TO_FILE else None)
+
+    if PROMPT_ROUTING_ENABLED:
+        for step, tokens in PROMPT_COMPILER.stage_report():
+            logging.info("Промпт для шага %s: ~%s токенов (полный ~%s)", step, tokens, PROMPT_COMPILER.full_tokens)
 
     app = build_application()
     print("Бот запущен. Остановка: Ctrl+C")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    try:
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
+    finally:
+        user_history.close()
 
 
 if __name__ == "__main__":
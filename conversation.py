@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+История диалога с бюджетом по токенам и скользящей сводкой.
+
+Вместо обрезки по числу сообщений держим в контексте столько последних реплик, сколько
+влезает в бюджет токенов (оценка — prompt_compiler.estimate_tokens). Реплики, вытесненные
+из бюджета, в фоновой задаче сжимаются в одну сводку (summarizer — async-функция, обычно
+вызов DeepSeek), которая уходит модели отдельным system-сообщением. Пока сводка не готова,
+вытесненные реплики отправляются как есть — факты диагностики не теряются.
+
+Память ограничена по уровням:
+- горячие диалоги — объекты _Dialog с репликами Turn (__slots__) в deque, LRU на max_cached_users;
+- простаивающие дольше idle_after секунд (и вытесненные из LRU) при персистентном хранилище
+  просто выгружаются — снимок уже стоит на записи в ConversationStore (conversation_store.py);
+  без хранилища снимок сжимается zlib и остаётся в памяти;
+- при обращении холодный диалог разворачивается обратно (сжатый снимок, затем хранилище).
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+import zlib
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+from conversation_store import ConversationStore, MemoryConversationStore
+from prompt_compiler import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# summarizer(previous_summary, turns) -> новая сводка; turns — [{"role", "content"}].
+Summarizer = Callable[[str, list[dict]], Awaitable[str]]
+
+SUMMARY_PREFIX = "Краткое содержание предыдущей части диалога (факты о собеседнике и ход диагностики):\n"
+
+# Как часто (секунды) при add() проверять простаивающие диалоги.
+_COMPACT_EVERY_SEC = 30.0
+
+
+_ROLES = {r: r for r in ("user", "assistant", "system")}
+
+
+class Turn:
+    """Одна реплика: роль, текст и оценка токенов. __slots__ — без __dict__ на каждую реплику."""
+
+    __slots__ = ("role", "content", "tokens")
+
+    def __init__(self, role: str, content: str, tokens: int):
+        # Роли — одни и те же строки у всех реплик, храним одну копию.
+        self.role = _ROLES.get(role, role)
+        self.content = content
+        self.tokens = tokens
+
+    def as_message(self) -> dict:
+        return {"role": self.role, "content": self.content}
+
+
+def _turn_from_snapshot(item: list) -> Turn:
+    """[role, content, tokens]; в старых снимках tokens нет — считаем заново."""
+    role, content = item[0], item[1]
+    tokens = item[2] if len(item) > 2 else estimate_tokens(content)
+    return Turn(role, content, tokens)
+
+
+@dataclass(slots=True)
+class _Dialog:
+    turns: deque = field(default_factory=deque)
+    tokens: int = 0
+    overflow: deque = field(default_factory=deque)
+    overflow_tokens: int = 0
+    summary: str = ""
+    # Этап диалога (ключ STAGE_SECTIONS) — по нему собирается системный промпт.
+    stage: Optional[str] = None
+    summary_task: Optional[asyncio.Task] = None
+    last_access: float = 0.0
+
+
+class ConversationHistory:
+    """
+    token_budget — сколько токенов живых реплик держать (0 = без лимита).
+    min_turns — сколько последних реплик не вытеснять никогда (даже если одна реплика длиннее бюджета).
+    store — хранилище диалогов (по умолчанию только память); max_cached_users — сколько горячих
+    диалогов держать (0 = без лимита); idle_after — через сколько секунд без обращений диалог
+    уходит в холодный уровень (0 = только по LRU).
+    """
+
+    def __init__(
+        self,
+        token_budget: int,
+        summarizer: Optional[Summarizer] = None,
+        *,
+        min_turns: int = 2,
+        store: Optional[ConversationStore] = None,
+        max_cached_users: int = 10000,
+        idle_after: float = 0.0,
+    ):
+        self.token_budget = token_budget
+        self.summarizer = summarizer
+        self.min_turns = min_turns
+        self.store = store or MemoryConversationStore()
+        self.max_cached_users = max_cached_users
+        self.idle_after = idle_after
+        self._dialogs: OrderedDict[int, _Dialog] = OrderedDict()
+        # user_id -> zlib(JSON-снимок): холодный уровень без персистентного хранилища.
+        self._cold: dict[int, bytes] = {}
+        self._cold_bytes = 0
+        self._last_compact = time.monotonic()
+
+    def _dialog(self, user_id: int, *, create: bool = True) -> Optional[_Dialog]:
+        """Горячий диалог (отмечается как недавний); иначе — из холодного уровня; create=False — не создавать пустой."""
+        d = self._dialogs.get(user_id)
+        if d is not None:
+            self._dialogs.move_to_end(user_id)
+            d.last_access = time.monotonic()
+            return d
+        snapshot = self._load_cold(user_id)
+        if snapshot is not None:
+            d = self._restore(snapshot)
+        elif not create:
+            return None
+        else:
+            d = _Dialog()
+        d.last_access = time.monotonic()
+        self._dialogs[user_id] = d
+        self._evict()
+        return d
+
+    def _load_cold(self, user_id: int) -> Optional[dict]:
+        packed = self._cold.pop(user_id, None)
+        if packed is not None:
+            self._cold_bytes -= len(packed)
+            return json.loads(zlib.decompress(packed))
+        if self.store.persistent:
+            return self.store.load(user_id)
+        return None
+
+    def _to_cold(self, user_id: int, d: _Dialog) -> None:
+        """Выгружает горячий диалог. С хранилищем снимок уже стоит на записи; без него — сжимаем в памяти."""
+        del self._dialogs[user_id]
+        if self.store.persistent:
+            return
+        packed = zlib.compress(json.dumps(self._snapshot(d), ensure_ascii=False).encode("utf-8"))
+        self._cold[user_id] = packed
+        self._cold_bytes += len(packed)
+
+    @staticmethod
+    def _busy(d: _Dialog) -> bool:
+        # Сводка ещё считается и допишет результат в этот объект — не выгружаем.
+        return d.summary_task is not None and not d.summary_task.done()
+
+    def _evict(self) -> None:
+        """Выгружает самые давние горячие диалоги сверх max_cached_users."""
+        if self.max_cached_users <= 0:
+            return
+        skipped = 0
+        while len(self._dialogs) > self.max_cached_users and skipped < len(self._dialogs):
+            user_id, d = next(iter(self._dialogs.items()))
+            if self._busy(d):
+                self._dialogs.move_to_end(user_id)
+                skipped += 1
+                continue
+            self._to_cold(user_id, d)
+
+    def compact_idle(self, now: Optional[float] = None) -> int:
+        """Выгружает диалоги, к которым не обращались дольше idle_after. Возвращает, сколько выгружено."""
+        if self.idle_after <= 0:
+            return 0
+        now = time.monotonic() if now is None else now
+        self._last_compact = now
+        deadline = now - self.idle_after
+        moved = 0
+        busy = []
+        # Порядок OrderedDict — порядок обращений: первый не простаивающий диалог останавливает обход.
+        while self._dialogs:
+            user_id, d = next(iter(self._dialogs.items()))
+            if d.last_access > deadline:
+                break
+            if self._busy(d):
+                # Временно снимаем с начала очереди и возвращаем на место после обхода.
+                del self._dialogs[user_id]
+                busy.append((user_id, d))
+                continue
+            self._to_cold(user_id, d)
+            moved += 1
+        for user_id, d in reversed(busy):
+            self._dialogs[user_id] = d
+            self._dialogs.move_to_end(user_id, last=False)
+        if moved:
+            logger.debug("История: в холодный уровень выгружено %s диалогов", moved)
+        return moved
+
+    def _maybe_compact(self) -> None:
+        if self.idle_after > 0 and time.monotonic() - self._last_compact >= _COMPACT_EVERY_SEC:
+            self.compact_idle()
+
+    @staticmethod
+    def _snapshot(d: _Dialog) -> dict:
+        return {
+            "turns": [[t.role, t.content, t.tokens] for t in d.turns],
+            "overflow": [[t.role, t.content, t.tokens] for t in d.overflow],
+            "summary": d.summary,
+            "stage": d.stage,
+        }
+
+    @staticmethod
+    def _restore(snapshot: dict) -> _Dialog:
+        d = _Dialog(summary=snapshot.get("summary") or "", stage=snapshot.get("stage"))
+        for item in snapshot.get("turns") or ():
+            t = _turn_from_snapshot(item)
+            d.turns.append(t)
+            d.tokens += t.tokens
+        for item in snapshot.get("overflow") or ():
+            t = _turn_from_snapshot(item)
+            d.overflow.append(t)
+            d.overflow_tokens += t.tokens
+        return d
+
+    def _persist(self, user_id: int, d: _Dialog) -> None:
+        if self.store.persistent:
+            self.store.save(user_id, self._snapshot(d))
+
+    def add(self, user_id: int, role: str, content: str) -> None:
+        self._maybe_compact()
+        d = self._dialog(user_id)
+        turn = Turn(role, content, estimate_tokens(content))
+        d.turns.append(turn)
+        d.tokens += turn.tokens
+        if self.token_budget <= 0:
+            self._persist(user_id, d)
+            return
+        while d.tokens > self.token_budget and len(d.turns) > self.min_turns:
+            old = d.turns.popleft()
+            d.tokens -= old.tokens
+            d.overflow.append(old)
+            d.overflow_tokens += old.tokens
+        if d.overflow:
+            self._schedule_summary(user_id, d)
+        self._persist(user_id, d)
+
+    def _schedule_summary(self, user_id: int, d: _Dialog) -> None:
+        if self.summarizer is None:
+            self._drop_overflow_over_budget(d)
+            return
+        if d.summary_task is not None and not d.summary_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Нет цикла событий (синхронный вызов) — сводку сделаем при следующем add в async-контексте.
+            self._drop_overflow_over_budget(d)
+            return
+        d.summary_task = loop.create_task(self._summarize(user_id, d))
+
+    def _drop_overflow_over_budget(self, d: _Dialog) -> None:
+        """Без сводки вытесненные реплики не должны копиться бесконечно: держим не больше бюджета."""
+        while d.overflow and d.overflow_tokens > self.token_budget:
+            old = d.overflow.popleft()
+            d.overflow_tokens -= old.tokens
+
+    async def _summarize(self, user_id: int, d: _Dialog) -> None:
+        batch = list(d.overflow)
+        turns = [t.as_message() for t in batch]
+        try:
+            summary = (await self.summarizer(d.summary, turns)).strip()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Сводка истории user_id=%s не удалась: %s", user_id, e)
+            self._drop_overflow_over_budget(d)
+            self._persist(user_id, d)
+            return
+        if self._dialogs.get(user_id) is not d:
+            # Пока считали сводку, диалог сбросили (/new) — результат не нужен.
+            return
+        if summary:
+            d.summary = summary
+        for _ in batch:
+            d.overflow.popleft()
+        d.overflow_tokens = sum(t.tokens for t in d.overflow)
+        self._persist(user_id, d)
+
+    def messages(self, user_id: int) -> list[dict]:
+        """Сводка (если есть) + ещё не сжатые вытесненные реплики + реплики в бюджете."""
+        d = self._dialog(user_id, create=False)
+        if d is None:
+            return []
+        out: list[dict] = []
+        if d.summary:
+            out.append({"role": "system", "content": SUMMARY_PREFIX + d.summary})
+        out.extend(t.as_message() for t in d.overflow)
+        out.extend(t.as_message() for t in d.turns)
+        return out
+
+    def last(self, user_id: int) -> Optional[dict]:
+        d = self._dialog(user_id, create=False)
+        if d is None or not d.turns:
+            return None
+        return d.turns[-1].as_message()
+
+    def pop_last(self, user_id: int) -> Optional[dict]:
+        """Убирает последнюю реплику (откат сообщения пользователя при ошибке API)."""
+        d = self._dialog(user_id, create=False)
+        if d is None or not d.turns:
+            return None
+        turn = d.turns.pop()
+        d.tokens -= turn.tokens
+        self._persist(user_id, d)
+        return turn.as_message()
+
+    def has_history(self, user_id: int) -> bool:
+        d = self._dialog(user_id, create=False)
+        return bool(d and (d.turns or d.overflow or d.summary))
+
+    def token_count(self, user_id: int) -> int:
+        d = self._dialog(user_id, create=False)
+        return d.tokens if d else 0
+
+    def stage(self, user_id: int) -> Optional[str]:
+        d = self._dialog(user_id, create=False)
+        return d.stage if d else None
+
+    def set_stage(self, user_id: int, stage: str) -> None:
+        d = self._dialog(user_id)
+        if d.stage != stage:
+            d.stage = stage
+            self._persist(user_id, d)
+
+    def clear(self, user_id: int) -> None:
+        d = self._dialogs.pop(user_id, None)
+        packed = self._cold.pop(user_id, None)
+        if packed is not None:
+            self._cold_bytes -= len(packed)
+        if self.store.persistent:
+            self.store.delete(user_id)
+        if d is None:
+            return
+        if d.summary_task is not None and not d.summary_task.done():
+            d.summary_task.cancel()
+
+    def cached_users(self) -> int:
+        return len(self._dialogs)
+
+    def memory_stats(self) -> dict:
+        """Горячие и холодные (сжатые в памяти) диалоги — для логов и подбора размера VM."""
+        return {"hot_users": len(self._dialogs), "cold_users": len(self._cold), "cold_bytes": self._cold_bytes}
+
+    def flush(self) -> None:
+        """Синхронно дописать отложенные изменения в хранилище (конец webhook-обработки, остановка)."""
+        self.store.flush()
+
+    def close(self) -> None:
+        self.store.close()
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Хранилище истории диалогов (ConversationStore) для conversation.ConversationHistory.
+
+- MemoryConversationStore — ничего не сохраняет (история живёт, пока жив процесс; прежнее поведение).
+- SQLiteConversationStore — SQLite в режиме WAL с отложенной записью (write-behind): save() только
+  кладёт снимок диалога в очередь (последний снимок пользователя заменяет предыдущий), фоновый поток
+  пишет очередь пачками в одной транзакции. Путь ответа пользователю диск не ждёт; чтение при промахе
+  кэша сначала смотрит в очередь, затем в пачку, которая пишется сейчас (до COMMIT в базе её ещё нет),
+  затем — точечный SELECT по первичному ключу.
+
+Снимок диалога — dict, сериализуемый в JSON (см. ConversationHistory._snapshot).
+Выбор хранилища: CONVERSATION_STORE=memory|sqlite, путь к базе — CONVERSATION_DB_PATH.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Пауза между сбросами очереди на диск и размер пачки по умолчанию.
+DEFAULT_FLUSH_INTERVAL_SEC = 0.5
+DEFAULT_BATCH_SIZE = 500
+
+# Метка удаления в очереди записи.
+_DELETED = object()
+
+
+class ConversationStore:
+    """
+    Интерфейс хранилища. persistent=False — данные не переживают процесс, и вытеснять
+    диалоги из кэша ConversationHistory нельзя.
+    """
+
+    persistent = False
+
+    def load(self, user_id: int) -> Optional[dict]:
+        """Снимок диалога или None."""
+        return None
+
+    def save(self, user_id: int, snapshot: dict) -> None:
+        """Поставить снимок на запись (не блокирует)."""
+
+    def delete(self, user_id: int) -> None:
+        """Удалить диалог (не блокирует)."""
+
+    def flush(self) -> None:
+        """Синхронно записать всё, что стоит в очереди."""
+
+    def close(self) -> None:
+        """Записать очередь и освободить ресурсы."""
+
+
+class MemoryConversationStore(ConversationStore):
+    """Без сохранения: история только в памяти процесса."""
+
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    path — файл SQLite; flush_interval — как часто фоновый поток сбрасывает очередь (секунды);
+    batch_size — сколько диалогов писать в одной транзакции.
+    """
+
+    persistent = True
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL_SEC,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+    ):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.counters = {"saved": 0, "coalesced": 0, "written": 0, "batches": 0, "errors": 0}
+        # user_id -> снимок или _DELETED; порядок вставки = порядок записи.
+        self._pending: dict[int, object] = {}
+        # Пачка, взятая из очереди и ещё не закоммиченная: load() читает её, пока SELECT видит старую строку.
+        self._inflight: dict[int, object] = {}
+        self._lock = threading.Lock()
+        # Запись на диск — только под этим замком (фоновый поток и flush() из обработчика).
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._local = threading.local()
+        self._init()
+        self._thread = threading.Thread(target=self._run, name="conversation-store-flush", daemon=True)
+        self._thread.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        return conn
+
+    def _conn(self) -> sqlite3.Connection:
+        """Отдельное соединение на поток: sqlite3 не разрешает делить соединение между потоками."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def _init(self) -> None:
+        self._conn().execute(
+            """
+            CREATE TABLE IF NOT EXISTS conversations (
+                user_id INTEGER PRIMARY KEY,
+                state TEXT NOT NULL,
+                updated_at INTEGER NOT NULL
+            )
+            """
+        )
+
+    # ---------- API ----------
+
+    def load(self, user_id: int) -> Optional[dict]:
+        with self._lock:
+            pending = self._pending.get(user_id)
+            if pending is None:
+                pending = self._inflight.get(user_id)
+        if pending is _DELETED:
+            return None
+        if pending is not None:
+            return pending
+        row = self._conn().execute("SELECT state FROM conversations WHERE user_id = ?", (user_id,)).fetchone()
+        if not row:
+            return None
+        try:
+            return json.loads(row[0])
+        except ValueError:
+            logger.warning("Повреждённая история диалога user_id=%s в %s — начинаем заново", user_id, self.path)
+            return None
+
+    def save(self, user_id: int, snapshot: dict) -> None:
+        self._enqueue(user_id, snapshot)
+
+    def delete(self, user_id: int) -> None:
+        self._enqueue(user_id, _DELETED)
+
+    def flush(self) -> None:
+        while self._write_batch():
+            pass
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join(timeout=5)
+        self.flush()
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    # ---------- внутреннее ----------
+
+    def _enqueue(self, user_id: int, item: object) -> None:
+        with self._lock:
+            if user_id in self._pending:
+                self.counters["coalesced"] += 1
+                # Переставляем в конец: пишем в порядке последних изменений.
+                del self._pending[user_id]
+            self._pending[user_id] = item
+            self.counters["saved"] += 1
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def _take_batch(self) -> list[tuple[int, object]]:
+        with self._lock:
+            batch = []
+            for user_id in list(self._pending)[: self.batch_size]:
+                item = self._inflight[user_id] = self._pending.pop(user_id)
+                batch.append((user_id, item))
+            return batch
+
+    def _write_batch(self) -> bool:
+        """Пишет одну пачку; False — очередь пуста."""
+        with self._write_lock:
+            batch = self._take_batch()
+            if not batch:
+                return False
+            now = int(time.time())
+            upserts = []
+            deletes = []
+            for user_id, item in batch:
+                if item is _DELETED:
+                    deletes.append((user_id,))
+                else:
+                    upserts.append((user_id, json.dumps(item, ensure_ascii=False), now))
+            conn = self._conn()
+            try:
+                conn.execute("BEGIN")
+                if deletes:
+                    conn.executemany("DELETE FROM conversations WHERE user_id = ?", deletes)
+                if upserts:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO conversations(user_id, state, updated_at) VALUES(?, ?, ?)",
+                        upserts,
+                    )
+                conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                self.counters["errors"] += 1
+                logger.warning("Запись истории диалогов в %s не удалась: %s", self.path, e)
+                self._requeue(batch)
+                return False
+            with self._lock:
+                self._inflight.clear()
+            self.counters["written"] += len(batch)
+            self.counters["batches"] += 1
+            return True
+
+    def _requeue(self, batch: list[tuple[int, object]]) -> None:
+        """Неудачную пачку возвращаем в очередь, не затирая более новые снимки."""
+        with self._lock:
+            for user_id, item in batch:
+                self._pending.setdefault(user_id, item)
+            self._inflight.clear()
+
+    def _run(self) -> None:
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception("Фоновая запись истории диалогов: %s", e)
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+
+
+def store_from_env() -> ConversationStore:
+    """CONVERSATION_STORE=memory (по умолчанию) | sqlite; CONVERSATION_DB_PATH — файл базы для sqlite."""
+    kind = (os.getenv("CONVERSATION_STORE") or "memory").strip().lower()
+    if kind == "sqlite":
+        path = (os.getenv("CONVERSATION_DB_PATH") or "conversations.sqlite3").strip()
+        return SQLiteConversationStore(path)
+    if kind != "memory":
+        logger.warning("Неизвестный CONVERSATION_STORE=%r — история только в памяти", kind)
+    return MemoryConversationStore()
@@ -8,6 +8,13 @@
   - deploy.handler_robokassa.handler_fail    — FailURL (редирект пользователя)
 
 ResultURL ОБЯЗАТЕЛЕН: именно он подтверждает оплату. В ответ нужно вернуть "OK{InvId}".
+
+Уведомления об оплате ResultURL только записывает в outbox; отправляет их
+deploy.handler_robokassa.handler_outbox — функция с триггером-таймером (раз в минуту).
+Брошенные заказы истекают и уходят в архив в deploy.handler_robokassa.handler_maintenance (таймер, раз в час).
+
+Конфигурация и хранилище оплат (со схемой) создаются один раз на «тёплый» экземпляр функции и
+переиспользуются между вызовами (_config/_payments_db).
 """
 
 import base64
@@ -15,25 +22,40 @@ import json
 import logging
 import os
 import sys
+import time
 from urllib.parse import parse_qs
 
 # Добавляем корень проекта в путь (как в handler_webhook.py)
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from log_pipeline import flush_logs_after, setup_logging  # noqa: E402
+from payments_store import PaymentsStore, payments_db  # noqa: E402
 from robokassa_integration import (  # noqa: E402
-    PaymentsDB,
     RobokassaConfig,
-    build_access_message,
-    telegram_send_message,
     verify_result_url,
     verify_success_url,
-    send_group_payment_notify_immediate,
 )
 
-logging.basicConfig(
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
-)
+setup_logging(service="handler_robokassa")
+
+_cfg: RobokassaConfig | None = None
+
+
+def _config() -> RobokassaConfig:
+    global _cfg
+    if _cfg is None:
+        _cfg = RobokassaConfig.from_env()
+    return _cfg
+
+
+def _payments_db() -> PaymentsStore:
+    """
+    Хранилище оплат экземпляра функции (общее на процесс, payments_store.payments_db): миграция схемы —
+    при первом вызове. Задайте PAYMENTS_DB_URL (PostgreSQL): у каждого экземпляра функции свой временный
+    диск, и без общей базы заказы бота ResultURL не найдёт. С SQLite (PAYMENTS_DB_PATH) схема создаётся
+    заново, если файл базы пропал.
+    """
+    return payments_db()
 
 
 def _collect_params(event: dict) -> dict:
@@ -61,74 +83,94 @@ def _collect_params(event: dict) -> dict:
     return params
 
 
+@flush_logs_after
 def handler_result(event, context):
     """
     ResultURL (server-to-server). Должен вернуть "OK{InvId}".
     """
     try:
-        cfg = RobokassaConfig.from_env()
-        db = PaymentsDB.from_env()
+        cfg = _config()
+        db = _payments_db()
         params = _collect_params(event)
         parsed = verify_result_url(params, cfg=cfg)
 
         inv_id = int(parsed["inv_id"])
-        out_sum = str(parsed["out_sum"])
-        order = db.get_order(inv_id)
-        if not order:
-            logging.warning("Robokassa: unknown InvId=%s", inv_id)
-            return {"statusCode": 200, "body": "ERROR"}
-
-        if str(order.get("amount")) != out_sum:
-            logging.warning("Robokassa: amount mismatch InvId=%s %s != %s", inv_id, order.get("amount"), out_sum)
-            return {"statusCode": 200, "body": "ERROR"}
-
         shp = parsed.get("shp") or {}
-        token_expected = str(order.get("order_token") or "")
-        token_got = str(shp.get("Shp_order_token") or "")
-        if token_expected and token_got and token_expected != token_got:
-            logging.warning("Robokassa: token mismatch InvId=%s", inv_id)
+        # Проверка суммы и токена, перевод в paid, запись клиента и уведомлений в outbox —
+        # одна транзакция (PaymentsDB.confirm_payment); отправка — в handler_outbox.
+        result = db.confirm_payment(
+            inv_id,
+            out_sum=str(parsed["out_sum"]),
+            order_token=str(shp.get("Shp_order_token") or "") or None,
+            raw_params=parsed.get("raw") or {},
+        )
+        if not result.ok:
+            logging.warning(
+                "Robokassa: %s InvId=%s (OutSum=%s, в заказе %s)",
+                result.error,
+                inv_id,
+                parsed["out_sum"],
+                (result.order or {}).get("amount"),
+            )
             return {"statusCode": 200, "body": "ERROR"}
 
-        newly_paid = db.mark_paid_if_pending(inv_id, raw_params=parsed.get("raw") or {})
-        if newly_paid:
-            order = db.get_order(inv_id)
-            if order:
-                try:
-                    db.upsert_client_from_order(order)
-                except Exception as e:
-                    logging.exception("upsert_client_from_order failed: %s", e)
-            bot_token = os.getenv("TELEGRAM_BOT_TOKEN") or ""
-            if bot_token and order:
-                chat_id = int(order.get("chat_id") or shp.get("Shp_chat_id") or 0)
-                if chat_id:
-                    text = build_access_message(str(order.get("product_code") or ""))
-                    try:
-                        telegram_send_message(
-                            bot_token=bot_token,
-                            chat_id=chat_id,
-                            text=text,
-                            disable_web_preview=True,
-                        )
-                    except Exception as e:
-                        logging.exception("Telegram sendMessage failed: %s", e)
-                try:
-                    send_group_payment_notify_immediate(bot_token, db.get_order(inv_id))
-                except Exception as e:
-                    logging.exception("Group digest immediate notify failed: %s", e)
-
         return {"statusCode": 200, "body": f"OK{inv_id}"}
     except Exception as e:
         logging.exception("Robokassa ResultURL error: %s", e)
         return {"statusCode": 200, "body": "ERROR"}
 
 
+# Сколько секунд handler_outbox разбирает очередь за один вызов (меньше таймаута функции).
+OUTBOX_TIME_BUDGET_SEC = 40.0
+
+
+@flush_logs_after
+def handler_outbox(event, context):
+    """
+    Триггер-таймер: отправляет накопившиеся уведомления об оплате из outbox (payment_outbox.drain_outbox),
+    пачками, пока есть что отправлять и не вышел OUTBOX_TIME_BUDGET_SEC.
+    """
+    # Клиент Bot API (httpx) нужен только здесь — handler_result стартует без него.
+    from payment_outbox import drain_outbox, telegram_sender
+
+    bot_token = os.getenv("TELEGRAM_BOT_TOKEN") or ""
+    if not bot_token:
+        logging.warning("Outbox: TELEGRAM_BOT_TOKEN не задан, отправка пропущена")
+        return {"statusCode": 200, "body": "skipped"}
+    db = _payments_db()
+    send = telegram_sender(bot_token)
+    deadline = time.monotonic() + OUTBOX_TIME_BUDGET_SEC
+    total = {"sent": 0, "retry": 0, "failed": 0}
+    while time.monotonic() < deadline:
+        stats = drain_outbox(db, send)
+        for key, n in stats.items():
+            total[key] += n
+        if not any(stats.values()):
+            break
+    return {"statusCode": 200, "body": json.dumps(total)}
+
+
+# Сколько секунд handler_maintenance обслуживает orders за вызов; остальное — в следующий.
+MAINTENANCE_TIME_BUDGET_SEC = 40.0
+
+
+@flush_logs_after
+def handler_maintenance(event, context):
+    """Триггер-таймер: истечение брошенных заказов, перенос в архив, incremental vacuum (orders_maintenance)."""
+    from orders_maintenance import run_maintenance
+
+    stats = run_maintenance(_payments_db(), time_budget=MAINTENANCE_TIME_BUDGET_SEC)
+    return {"statusCode": 200, "body": json.dumps(stats)}
+
+
+@flush_logs_after
 def handler_success(event, context):
     """
     SuccessURL (редирект пользователя после оплаты).
     Это НЕ подтверждение оплаты, подтверждение приходит на ResultURL.
     """
     try:
-        cfg = RobokassaConfig.from_env()
+        cfg = _config()
         params = _collect_params(event)
         _ = verify_success_url(params, cfg=cfg)
         return {
@@ -6,6 +6,9 @@
 В настройках функции укажите:
   Точка входа: deploy.handler_webhook.handler
   Переменные окружения: TELEGRAM_BOT_TOKEN, DEEPSEEK_API_KEY, при необходимости OPENAI_API_KEY
+
+Цикл событий создаётся один раз на экземпляр функции и переживает вызовы: в «тёплом» контейнере
+приложение PTB, HTTP-клиенты Telegram/DeepSeek и история диалогов не пересоздаются (bot._get_webhook_app).
 """
 import asyncio
 import base64
@@ -17,14 +20,24 @@ import sys
 # Добавляем корень проекта в путь (при деплое в функцию обычно кладут весь проект)
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from bot import process_webhook_update
+from bot import process_webhook_update, shutdown_webhook_app
+from log_pipeline import flush_logs_after, setup_logging
+
+setup_logging(service="handler_webhook")
+
+_loop: asyncio.AbstractEventLoop | None = None
+
 
-logging.basicConfig(
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
-)
+def _event_loop() -> asyncio.AbstractEventLoop:
+    """Цикл событий экземпляра функции; новый — только при первом вызове или если прежний закрыт."""
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+    return _loop
 
 
+@flush_logs_after
 def handler(event, context):
     """
     Обработчик HTTP-триггера Yandex Cloud Functions.
@@ -37,8 +50,8 @@ def handler(event, context):
         if isinstance(body, bytes):
             body = body.decode("utf-8")
 
-        # Запускаем асинхронную обработку в том же процессе
-        asyncio.run(process_webhook_update(body))
+        # Асинхронная обработка в цикле событий, общем для всех вызовов этого экземпляра
+        _event_loop().run_until_complete(process_webhook_update(body))
 
         return {
             "statusCode": 200,
@@ -47,6 +60,11 @@ def handler(event, context):
         }
     except Exception as e:
         logging.exception("Webhook handler error: %s", e)
+        # Следующий вызов соберёт приложение заново — на случай, если ошибка в его состоянии.
+        try:
+            _event_loop().run_until_complete(shutdown_webhook_app())
+        except Exception:
+            logging.exception("Webhook: сброс приложения не удался")
         return {
             "statusCode": 500,
             "body": "error",
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+Общий на процесс планировщик правок сообщений Telegram (edit_text) при потоковом выводе.
+
+- Бюджеты: глобальный token bucket на бота (правок/с) и минимальный интервал между правками в одном чате.
+- Latest-wins: пока правка сообщения ждёт своей очереди, новый текст просто заменяет старый
+  (промежуточные версии не отправляются — счётчик coalesced).
+- Адаптивный интервал: чем больше чатов одновременно стримят, тем реже правки в каждом,
+  чтобы суммарно укладываться в глобальный лимит.
+- RetryAfter (flood wait) обрабатывается явно: чат (и при повторах весь бот) ставится на паузу
+  на указанное Telegram время, последняя версия текста переотправляется после паузы.
+- Финальная правка (finalize) не теряется: ждёт бюджет, повторяет после RetryAfter, а ожидающая
+  потоковая правка того же сообщения отбрасывается (счётчик dropped). После finalize и discard
+  сообщение закрыто для потоковых правок, а finalize дожидается правки, которая уже в полёте:
+  она не придёт в Telegram после итогового текста и клавиатуры и не переотправится после RetryAfter.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Callable, Union
+
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Активным считается чат, в котором была правка за последние столько секунд.
+_ACTIVE_WINDOW_SEC = 5.0
+# Две паузы RetryAfter за это время — притормаживаем весь бот, а не только чат.
+_GLOBAL_FLOOD_WINDOW_SEC = 10.0
+_STATS_LOG_EVERY_SEC = 300.0
+# Сколько последних закрытых (finalize/discard) сообщений помнить: правка в полёте живёт недолго.
+_CLOSED_KEYS_MAX = 4096
+
+# Текст правки или функция, возвращающая актуальный текст в момент отправки
+# (чтобы не собирать строку на каждом фрагменте стрима).
+EditText = Union[str, Callable[[], str]]
+
+
+def _retry_after_seconds(e: RetryAfter) -> float:
+    value = e.retry_after
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
+
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now: float) -> float:
+        """Сколько ждать до свободного токена (0 — можно брать сейчас)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class EditScheduler:
+    """
+    global_rate — правок в секунду на весь бот; chat_interval — базовый минимальный интервал между
+    правками в одном чате (секунды). Работает в текущем цикле asyncio; фоновая задача стартует лениво.
+    """
+
+    def __init__(self, global_rate: float = 25.0, chat_interval: float = 0.5, *, final_attempts: int = 3):
+        self.global_rate = global_rate
+        self.chat_interval = chat_interval
+        self.final_attempts = final_attempts
+        self.counters = {
+            "submitted": 0,
+            "sent": 0,
+            "coalesced": 0,
+            "dropped": 0,
+            "retry_after": 0,
+            "not_modified": 0,
+            "errors": 0,
+            "final_sent": 0,
+            "final_failed": 0,
+        }
+        self._reset_state()
+
+    def _reset_state(self) -> None:
+        self._bucket = TokenBucket(self.global_rate, max(1.0, self.global_rate))
+        # (chat_id, message_id) -> (message, text, kwargs)
+        self._pending: OrderedDict[tuple[int, int], tuple[Any, EditText, dict]] = OrderedDict()
+        # Сообщения после finalize/discard: потоковые правки для них больше не ставятся.
+        self._closed: OrderedDict[tuple[int, int], None] = OrderedDict()
+        # Потоковая правка, которую воркер сейчас отправляет: finalize ждёт её завершения.
+        self._inflight: dict[tuple[int, int], asyncio.Event] = {}
+        self._chat_next: dict[int, float] = {}
+        self._chat_last_edit: dict[int, float] = {}
+        self._global_pause_until = 0.0
+        self._last_flood_at = 0.0
+        self._wakeup: asyncio.Event | None = None
+        self._worker: asyncio.Task | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._last_stats_log = time.monotonic()
+
+    # ---------- публичный API ----------
+
+    def submit(self, message: Any, text: EditText, **kwargs: Any) -> None:
+        """
+        Поставить промежуточную (потоковую) правку. Не ждёт отправки; более новый текст заменяет старый.
+        text может быть функцией — тогда она вызывается в момент отправки.
+        """
+        self._ensure_worker()
+        key = (message.chat_id, message.message_id)
+        self.counters["submitted"] += 1
+        if key in self._closed:
+            self.counters["dropped"] += 1
+            return
+        if key in self._pending:
+            self.counters["coalesced"] += 1
+        self._pending[key] = (message, text, kwargs)
+        self._wakeup.set()
+
+    async def finalize(self, message: Any, text: str, **kwargs: Any) -> bool:
+        """
+        Финальная правка сообщения (итоговый текст, клавиатура). Ожидающая потоковая правка отбрасывается.
+        Возвращает True при успехе (или если текст уже совпадает), False — если отправить не удалось.
+        """
+        self._ensure_worker()
+        key = (message.chat_id, message.message_id)
+        self._close(key)
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            await inflight.wait()
+        for _ in range(self.final_attempts):
+            await self._acquire(message.chat_id)
+            try:
+                await message.edit_text(text, **kwargs)
+                self.counters["final_sent"] += 1
+                return True
+            except RetryAfter as e:
+                self._on_retry_after(message.chat_id, _retry_after_seconds(e))
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    self.counters["not_modified"] += 1
+                    return True
+                logger.warning("Финальная правка сообщения не удалась: %s", e)
+                break
+            except Exception as e:
+                logger.warning("Финальная правка сообщения не удалась: %s", e)
+                break
+        self.counters["final_failed"] += 1
+        return False
+
+    def discard(self, message: Any) -> None:
+        """Отбросить ожидающую потоковую правку сообщения (сообщение удаляется или больше не нужно)."""
+        self._close((message.chat_id, message.message_id))
+
+    def stats(self) -> dict[str, Any]:
+        """Счётчики и текущая нагрузка (для логов/мониторинга)."""
+        now = time.monotonic()
+        out: dict[str, Any] = dict(self.counters)
+        out["pending"] = len(self._pending)
+        out["active_chats"] = self._active_chats(now)
+        out["chat_interval_sec"] = round(self._current_chat_interval(now), 3)
+        return out
+
+    # ---------- внутреннее ----------
+
+    def _ensure_worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Новый цикл событий (например, webhook с asyncio.run на каждый update) — старое состояние не переносим.
+            if self._pending:
+                self.counters["dropped"] += len(self._pending)
+            self._reset_state()
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._run())
+
+    def _close(self, key: tuple[int, int]) -> None:
+        """Закрывает сообщение для потоковых правок и отбрасывает ожидающую."""
+        self._closed[key] = None
+        self._closed.move_to_end(key)
+        if len(self._closed) > _CLOSED_KEYS_MAX:
+            self._closed.popitem(last=False)
+        if self._pending.pop(key, None) is not None:
+            self.counters["dropped"] += 1
+
+    def _active_chats(self, now: float) -> int:
+        active = {key[0] for key in self._pending}
+        stale = []
+        for chat_id, ts in self._chat_last_edit.items():
+            if now - ts <= _ACTIVE_WINDOW_SEC:
+                active.add(chat_id)
+            else:
+                stale.append(chat_id)
+        # Давно неактивные чаты забываем, чтобы словари не росли на всех пользователей.
+        for chat_id in stale:
+            del self._chat_last_edit[chat_id]
+            if self._chat_next.get(chat_id, 0.0) <= now:
+                self._chat_next.pop(chat_id, None)
+        return len(active)
+
+    def _current_chat_interval(self, now: float) -> float:
+        """Базовый интервал или больше, если чатов столько, что глобальный лимит не даёт чаще."""
+        return max(self.chat_interval, self._active_chats(now) / self.global_rate)
+
+    def _on_retry_after(self, chat_id: int, seconds: float) -> None:
+        now = time.monotonic()
+        self.counters["retry_after"] += 1
+        self._chat_next[chat_id] = max(self._chat_next.get(chat_id, 0.0), now + seconds)
+        if now - self._last_flood_at <= _GLOBAL_FLOOD_WINDOW_SEC:
+            self._global_pause_until = max(self._global_pause_until, now + seconds)
+        self._last_flood_at = now
+        logger.warning("Telegram RetryAfter %.1f с (chat_id=%s)", seconds, chat_id)
+
+    def _ready_wait(self, chat_id: int, now: float) -> float:
+        return max(self._global_pause_until - now, self._chat_next.get(chat_id, 0.0) - now, 0.0)
+
+    def _mark_sent(self, chat_id: int, now: float) -> None:
+        self._bucket.take()
+        self._chat_last_edit[chat_id] = now
+        self._chat_next[chat_id] = now + self._current_chat_interval(now)
+
+    async def _acquire(self, chat_id: int) -> None:
+        """Ждёт, пока чат и глобальный бюджет позволят правку, и занимает её."""
+        while True:
+            now = time.monotonic()
+            wait = self._ready_wait(chat_id, now) or self._bucket.wait_time(now)
+            if wait <= 0:
+                self._mark_sent(chat_id, now)
+                return
+            await asyncio.sleep(wait)
+
+    def _pick(self, now: float) -> tuple[tuple[int, int] | None, float]:
+        """Первое по очереди сообщение, чат которого готов; иначе — сколько ждать ближайшего."""
+        best_wait = float("inf")
+        for key in self._pending:
+            wait = self._ready_wait(key[0], now)
+            if wait <= 0:
+                return key, 0.0
+            best_wait = min(best_wait, wait)
+        return None, best_wait
+
+    async def _run(self) -> None:
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            key, wait = self._pick(now)
+            if key is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            bucket_wait = self._bucket.wait_time(now)
+            if bucket_wait > 0:
+                await asyncio.sleep(bucket_wait)
+                continue
+            message, text, kwargs = self._pending.pop(key)
+            self._mark_sent(key[0], now)
+            done = self._inflight[key] = asyncio.Event()
+            try:
+                await self._send(key, message, text, kwargs)
+            finally:
+                del self._inflight[key]
+                done.set()
+            self._maybe_log_stats()
+
+    async def _send(self, key: tuple[int, int], message: Any, text: EditText, kwargs: dict) -> None:
+        try:
+            await message.edit_text(text() if callable(text) else text, **kwargs)
+            self.counters["sent"] += 1
+        except RetryAfter as e:
+            self._on_retry_after(key[0], _retry_after_seconds(e))
+            # Переотправим после паузы, если за это время не пришёл более новый текст и сообщение не
+            # закрыли: finalize мог отправить итог, пока эта правка была в полёте.
+            if key in self._closed:
+                self.counters["dropped"] += 1
+            else:
+                self._pending.setdefault(key, (message, text, kwargs))
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                self.counters["not_modified"] += 1
+            else:
+                self.counters["errors"] += 1
+                logger.debug("Правка при стриме не удалась: %s", e)
+        except Exception as e:
+            self.counters["errors"] += 1
+            logger.debug("Правка при стриме не удалась: %s", e)
+
+    def _maybe_log_stats(self) -> None:
+        now = time.monotonic()
+        if now - self._last_stats_log >= _STATS_LOG_EVERY_SEC:
+            self._last_stats_log = now
+            logger.info("Правки Telegram: %s", self.stats())
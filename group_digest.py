@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""
+Дайджест по оплатившим групповые занятия по расписанию (GROUP_DIGEST_MODE=scheduled): сводка в чат
+TELEGRAM_GROUP_NOTIFY_CHAT_ID в слоты GROUP_DIGEST_TIME_1/2/3 по часам МСК.
+
+- send_new_orders — отправляет оплаченные групповые заказы, ещё не попавшие в дайджест, с анкетой
+  клиента (username, связь, желаемый старт) и отмечает их (orders.group_notified_at) после каждого
+  успешно отправленного сообщения: каждая оплата уходит в чат один раз, без перекрытий и дыр
+  окна «за последние N часов», а выборка — O(новых оплат) по частичному индексу.
+- run_due_digest — отправляет дайджест за последний наступивший слот, если он ещё не отправлен.
+  Метка последнего слота (job_marks, задание DIGEST_JOB) лежит в базе оплат и ставится сравнением с
+  обменом: сервер, cron и несколько воркеров uvicorn не отправят слот дважды. Слот, пропущенный из-за
+  простоя, догоняется при запуске, если прошло не больше GROUP_DIGEST_CATCHUP_HOURS; после долгого
+  простоя уходит один дайджест за последний слот, а не по одному за каждый пропущенный. Ошибка
+  отправки возвращает метку — слот повторится с ещё не отмеченных оплат.
+- DigestScheduler — в robokassa_server.py: спит до следующего слота и отправляет через общие на
+  процесс базу оплат и клиент Bot API, без холодного старта Python на каждую проверку.
+
+Ручной запуск и cron без сервера — send_group_digest.py; там же отчёт за окно часов (digest_text),
+который ничего не отмечает.
+"""
+from __future__ import annotations
+
+import asyncio
+import html
+import logging
+import os
+import time
+from datetime import datetime, time as dtime, timedelta, timezone
+from typing import Any, Callable, Optional, Sequence
+from zoneinfo import ZoneInfo
+
+from payments_store import PaymentsStore, payments_db
+from reporting_replica import report_watermark
+from robokassa_integration import _env, _parse_notify_chat_id
+from telegram_api import TelegramAPIError, sync_bot_api
+
+logger = logging.getLogger(__name__)
+
+MSK = ZoneInfo("Europe/Moscow")
+DIGEST_JOB = "group_digest"
+# Захват отправки новых оплат (job_marks, метка — до какого времени он действует): слот сервера и
+# ручной --force не выбирают одни и те же неотмеченные оплаты одновременно.
+DIGEST_SEND_JOB = "group_digest_send"
+# Через сколько секунд захват упавшего процесса освобождается сам.
+DIGEST_SEND_LEASE_SEC = 600
+DEFAULT_SINCE_HOURS = 12.0
+# Оплат за одну выборку; в сообщения они делятся по длине текста (MESSAGE_LIMIT).
+DIGEST_BATCH = 25
+# Лимит Telegram на текст сообщения.
+MESSAGE_LIMIT = 4096
+# Свободный текст анкеты (имя, связь, желаемый старт) записывает модель — длина не ограничена.
+FIELD_MAX = 60
+# Ответ Telegram, при котором повтор того же сообщения бессмыслен (как в payment_outbox). 403 — чат
+# недоступен целиком: оплаты не отмечаются и уйдут, когда чат починят.
+_PERMANENT_ERROR_CODES = (400,)
+DEFAULT_CATCHUP_HOURS = 6
+# Пауза перед повтором, если слот не отправился (Telegram или база недоступны).
+DEFAULT_RETRY_SEC = 60
+# Самый долгий сон планировщика: asyncio.sleep идёт по монотонным часам, и перевод системных часов
+# или сон ВМ не сдвинут слот больше чем на столько.
+MAX_SLEEP_SEC = 300
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name) or default)
+    except ValueError:
+        return default
+
+
+def parse_slot(value: str) -> Optional[dtime]:
+    """'9:05', '09:05' или '09:05:00' -> time(9, 5); пустая или неверная строка -> None."""
+    parts = value.strip().split(":")
+    if len(parts) < 2 or not (parts[0].strip().isdigit() and parts[1].strip().isdigit()):
+        return None
+    hour, minute = int(parts[0]), int(parts[1])
+    if hour > 23 or minute > 59:
+        return None
+    return dtime(hour, minute)
+
+
+def digest_slots() -> list[dtime]:
+    """Непустые GROUP_DIGEST_TIME_1/2/3 по возрастанию; неверный формат пишется в лог и пропускается."""
+    slots = set()
+    for name in ("GROUP_DIGEST_TIME_1", "GROUP_DIGEST_TIME_2", "GROUP_DIGEST_TIME_3"):
+        raw = (os.getenv(name) or "").strip()
+        if not raw:
+            continue
+        slot = parse_slot(raw)
+        if slot is None:
+            logger.warning("%s=%r: ожидается ЧЧ:ММ, слот пропущен", name, raw)
+        else:
+            slots.add(slot)
+    return sorted(slots)
+
+
+def last_slot(now: datetime, slots: Sequence[dtime]) -> Optional[datetime]:
+    """Последний наступивший (<= now) момент слота по МСК: сегодня или вчера."""
+    day = now.astimezone(MSK).date()
+    past = [
+        datetime.combine(day - timedelta(days=d), s, tzinfo=MSK) for d in (0, 1) for s in slots
+    ]
+    past = [t for t in past if t <= now]
+    return max(past) if past else None
+
+
+def next_slot(now: datetime, slots: Sequence[dtime]) -> Optional[datetime]:
+    """Ближайший будущий (> now) момент слота по МСК: сегодня или завтра."""
+    day = now.astimezone(MSK).date()
+    future = [
+        datetime.combine(day + timedelta(days=d), s, tzinfo=MSK) for d in (0, 1) for s in slots
+    ]
+    future = [t for t in future if t > now]
+    return min(future) if future else None
+
+
+def _clip(value: Any) -> str:
+    text = str(value)
+    return text if len(text) <= FIELD_MAX else text[: FIELD_MAX - 1] + "…"
+
+
+def _client_label(r: dict) -> str:
+    if r.get("username"):
+        return _clip(f"@{r['username']}")
+    name = " ".join(str(r[k]) for k in ("first_name", "last_name") if r.get(k))
+    return _clip(name) if name else "—"
+
+
+def _client_contact(r: dict) -> str:
+    value = r.get("contact_value")
+    if not value:
+        return "—"
+    return _clip(f"{r['contact_channel']}: {value}" if r.get("contact_channel") else value)
+
+
+def format_digest(rows: list[dict]) -> str:
+    """
+    Форматирует список заказов в текстовую таблицу. Даты в МСК. Строки с полями анкеты
+    (unnotified_group_orders) дополняются колонками «Клиент», «Связь», «Старт».
+    """
+    if not rows:
+        return "За выбранный период оплат по групповым нет."
+    with_client = "username" in rows[0]
+    header = "Дата и время (МСК) | user_id | chat_id | Тариф | Сумма"
+    lines = [header + (" | Клиент | Связь | Старт" if with_client else "")]
+    for r in rows:
+        paid_at = r.get("paid_at")
+        if paid_at:
+            dt = datetime.fromtimestamp(paid_at, tz=timezone.utc).astimezone(MSK)
+            time_str = dt.strftime("%d.%m.%Y %H:%M")
+        else:
+            time_str = "—"
+        user_id = r.get("user_id") or "—"
+        chat_id = r.get("chat_id") or "—"
+        product = (r.get("product_code") or "").replace("group_", "").capitalize()
+        if product == "Standard":
+            product = "Стандарт"
+        elif product == "Vip":
+            product = "VIP"
+        amount = r.get("amount") or "—"
+        line = f"{time_str} | {user_id} | {chat_id} | {product} | {amount} ₽"
+        if with_client:
+            start = r.get("preferred_group_start")
+            line += f" | {_client_label(r)} | {_client_contact(r)} | {_clip(start) if start else '—'}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def digest_text(db: PaymentsStore, *, since_hours: float, now: Optional[datetime] = None) -> tuple[str, int]:
+    """Текст дайджеста (HTML) за последние since_hours часов и число оплат в нём."""
+    now = now or datetime.now(MSK)
+    rows = db.get_group_orders_paid_since(int(now.timestamp() - since_hours * 3600))
+    watermark = datetime.fromtimestamp(report_watermark(db), tz=timezone.utc).astimezone(MSK)
+    title = (
+        f"Групповые занятия: оплаты за последние {int(since_hours)} ч (на {now.astimezone(MSK):%d.%m.%Y %H:%M} МСК)\n"
+        f"Данные базы на {watermark:%d.%m.%Y %H:%M} МСК"
+    )
+    return f"{title}\n\n<pre>{html.escape(format_digest(rows))}</pre>", len(rows)
+
+
+def _split_by_length(rows: list[dict], budget: int) -> list[list[dict]]:
+    """Делит строки на сообщения так, чтобы таблица (после html.escape) укладывалась в budget символов."""
+    chunks: list[list[dict]] = []
+    current: list[dict] = []
+    for r in rows:
+        if current and len(html.escape(format_digest(current + [r]))) > budget:
+            chunks.append(current)
+            current = []
+        current.append(r)
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _claim_sending(db: PaymentsStore) -> Optional[int]:
+    """Захватывает отправку сравнением с обменом; возвращает метку захвата или None — отправляет другой."""
+    now_ts = int(time.time())
+    current = db.job_mark(DIGEST_SEND_JOB)
+    if current is not None and current > now_ts:
+        return None
+    lease = now_ts + DIGEST_SEND_LEASE_SEC
+    return lease if db.set_job_mark(DIGEST_SEND_JOB, expected=current, mark=lease) else None
+
+
+def send_new_orders(
+    db: PaymentsStore, send: Callable[[str], Any], *, now: Optional[datetime] = None, batch: int = DIGEST_BATCH
+) -> Optional[int]:
+    """
+    Отправляет ещё не попавшие в дайджест оплаты и отмечает оплаты каждого сообщения сразу после его
+    отправки; сообщения делятся по длине (MESSAGE_LIMIT), нет новых — одно сообщение об этом.
+    Возвращает число отправленных оплат или None — сейчас их отправляет другой процесс (DIGEST_SEND_JOB).
+
+    Читает рабочую базу, а не снимок для отчётов: отставший снимок вернул бы уже отмеченные оплаты.
+    Ошибка отправки пробрасывается, отправленные до неё сообщения остаются отмеченными. Постоянная
+    ошибка Telegram (400) — оплаты сообщения отмечаются и пишутся в лог: иначе они стояли бы первыми в
+    каждой следующей выборке и повтор раз в минуту не пропускал бы ни одного дайджеста.
+    """
+    lease = _claim_sending(db)
+    if lease is None:
+        logger.info("Дайджест групповых уже отправляет другой процесс")
+        return None
+    try:
+        return _send_unnotified(db, send, now=now or datetime.now(MSK), batch=batch)
+    finally:
+        db.set_job_mark(DIGEST_SEND_JOB, expected=lease, mark=0)
+
+
+def _send_unnotified(db: PaymentsStore, send: Callable[[str], Any], *, now: datetime, batch: int) -> int:
+    title = f"Групповые занятия: новые оплаты с прошлого дайджеста (на {now.astimezone(MSK):%d.%m.%Y %H:%M} МСК)"
+    budget = MESSAGE_LIMIT - len(title) - len(", часть 9999\n\n<pre></pre>")
+    sent = part = 0
+    while True:
+        rows = db.unnotified_group_orders(limit=batch)
+        if not rows:
+            if not part:
+                send(f"{title}\n\nНовых оплат по групповым с прошлого дайджеста нет.")
+            return sent
+        chunks = _split_by_length(rows, budget)
+        marked = 0
+        for i, chunk in enumerate(chunks):
+            part += 1
+            more = i + 1 < len(chunks) or len(rows) == batch
+            suffix = f", часть {part}" if part > 1 or more else ""
+            inv_ids = [r["inv_id"] for r in chunk]
+            try:
+                send(f"{title}{suffix}\n\n<pre>{html.escape(format_digest(chunk))}</pre>")
+            except TelegramAPIError as e:
+                if e.error_code not in _PERMANENT_ERROR_CODES:
+                    raise
+                logger.error("Дайджест групповых: Telegram отклонил сообщение (%s), оплаты %s пропущены", e, inv_ids)
+            else:
+                sent += len(chunk)
+            marked += db.mark_group_notified(inv_ids)
+        if len(rows) < batch or not marked:
+            # Выборка неполная — новых больше нет; ничего не отмечено — их отметил и отправил другой процесс.
+            return sent
+
+
+def run_due_digest(
+    db: PaymentsStore,
+    send: Callable[[str], Any],
+    *,
+    slots: Sequence[dtime],
+    catchup_sec: float = DEFAULT_CATCHUP_HOURS * 3600,
+    now: Optional[datetime] = None,
+) -> Optional[int]:
+    """
+    Отправляет дайджест за последний наступивший слот, если его ещё никто не отправил. Возвращает
+    число оплат в отправленном дайджесте или None — отправлять нечего.
+    """
+    now = now or datetime.now(MSK)
+    slot = last_slot(now, slots)
+    if slot is None:
+        return None
+    slot_ts = int(slot.timestamp())
+    mark = db.job_mark(DIGEST_JOB)
+    if mark is None:
+        # Первый запуск: прошедшие слоты не догоняются, следующий уйдёт по расписанию.
+        db.set_job_mark(DIGEST_JOB, expected=None, mark=slot_ts)
+        return None
+    if mark >= slot_ts:
+        return None
+    if now.timestamp() - slot_ts > catchup_sec:
+        if db.set_job_mark(DIGEST_JOB, expected=mark, mark=slot_ts):
+            logger.warning("Дайджест за %s МСК пропущен: простой дольше %.0f ч", f"{slot:%d.%m %H:%M}", catchup_sec / 3600)
+        return None
+    if not db.set_job_mark(DIGEST_JOB, expected=mark, mark=slot_ts):
+        return None  # слот забрал другой процесс
+    try:
+        count = send_new_orders(db, send, now=now)
+    except BaseException:
+        db.set_job_mark(DIGEST_JOB, expected=slot_ts, mark=mark)
+        raise
+    if count is None:
+        # Новые оплаты сейчас отправляет другой процесс (--force): слот они и покроют.
+        return None
+    logger.info("Дайджест за %s МСК отправлен: %d оплат", f"{slot:%d.%m %H:%M}", count)
+    return count
+
+
+def digest_sender(bot_token: str, chat_id: int | str) -> Callable[[str], Any]:
+    """Отправка через общий клиент Bot API (telegram_api): соединения с api.telegram.org переиспользуются."""
+    api = sync_bot_api(bot_token)
+    return lambda text: api.send_message(chat_id, text, parse_mode="HTML")
+
+
+class DigestScheduler:
+    """Дайджест по слотам в процессе с циклом asyncio (robokassa_server.py): проход в потоке в момент слота."""
+
+    def __init__(
+        self,
+        send: Callable[[str], Any],
+        *,
+        slots: Sequence[dtime],
+        db_factory: Callable[[], PaymentsStore] = payments_db,
+        catchup_sec: float = DEFAULT_CATCHUP_HOURS * 3600,
+        retry_sec: float = DEFAULT_RETRY_SEC,
+        clock: Callable[[], datetime] = lambda: datetime.now(MSK),
+    ):
+        self._send = send
+        self.slots = list(slots)
+        self._db_factory = db_factory
+        self.catchup_sec = catchup_sec
+        self.retry_sec = retry_sec
+        self._clock = clock
+        self._task: Optional[asyncio.Task] = None
+        self.counters = {"sent": 0, "errors": 0}
+
+    @staticmethod
+    def from_env() -> Optional["DigestScheduler"]:
+        """None — дайджест по расписанию не настроен (режим immediate, нет слотов, чата или токена)."""
+        mode = (_env("GROUP_DIGEST_MODE") or "scheduled").strip().lower()
+        slots = digest_slots()
+        token = _env("TELEGRAM_BOT_TOKEN")
+        chat_id = _parse_notify_chat_id(_env("TELEGRAM_GROUP_NOTIFY_CHAT_ID") or "")
+        if mode != "scheduled" or not slots or not token or chat_id is None:
+            return None
+        return DigestScheduler(
+            digest_sender(token, chat_id),
+            slots=slots,
+            catchup_sec=_env_float("GROUP_DIGEST_CATCHUP_HOURS", DEFAULT_CATCHUP_HOURS) * 3600,
+        )
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run(), name="group-digest")
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def run_once(self) -> Optional[int]:
+        sent = await asyncio.to_thread(
+            lambda: run_due_digest(
+                self._db_factory(),
+                self._send,
+                slots=self.slots,
+                catchup_sec=self.catchup_sec,
+                now=self._clock(),
+            )
+        )
+        if sent is not None:
+            self.counters["sent"] += 1
+        return sent
+
+    def seconds_until_next_slot(self) -> float:
+        now = self._clock()
+        upcoming = next_slot(now, self.slots)
+        # Секунда запаса: проснувшись чуть раньше слота, проход его ещё не увидит.
+        return (upcoming - now).total_seconds() + 1 if upcoming is not None else MAX_SLEEP_SEC
+
+    async def _run(self) -> None:
+        while True:
+            delay = None
+            try:
+                await self.run_once()
+            except Exception:
+                self.counters["errors"] += 1
+                logger.exception("Дайджест групповых: ошибка отправки, повтор через %.0f с", self.retry_sec)
+                delay = self.retry_sec
+            if delay is None:
+                delay = self.seconds_until_next_slot()
+            await asyncio.sleep(max(0.0, min(delay, MAX_SLEEP_SEC)))
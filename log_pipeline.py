@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Логирование бота и сервера Robokassa: запись в фоновом потоке, структурированные события, ротация,
+маскирование секретов.
+
+- setup_logging(service=...) — вместо logging.basicConfig: корневой логгер пишет в очередь
+  (QueueHandler), а консоль и файл обслуживает QueueListener в отдельном потоке. Обработчик update
+  или ResultURL не делает файлового ввода-вывода; при переполнении очереди записи отбрасываются
+  и считаются (dropped_records), а не блокируют запрос.
+- Файл (log_file / LOG_FILE) — JSON-строки с ротацией по размеру (LOG_MAX_BYTES, LOG_BACKUP_COUNT).
+  Консоль — текстом, как раньше, или JSON (LOG_FORMAT=json; удобно для Cloud Logging).
+- log_event(logger, "robokassa.result_url", sample=0.1, inv_id=...) — событие с полями; sample — доля
+  событий, которые пишутся (отладочные события на горячем пути не засоряют лог).
+- Секреты маскируются при форматировании (в фоновом потоке): поля с «password», «token», «signature»
+  и т. п. в событиях, токены ботов (123456:AA...) и ключи sk-... в тексте сообщений, в том числе
+  в URL запросов httpx.
+- flush_logs() / @flush_logs_after — дождаться записи очереди (Cloud Functions: экземпляр может быть
+  заморожен сразу после ответа).
+"""
+from __future__ import annotations
+
+import atexit
+import functools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Optional
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 5
+DEFAULT_QUEUE_SIZE = 10000
+
+REDACTED = "***"
+# Поля событий, значения которых не пишутся никогда (сравнение без регистра, по вхождению).
+_SECRET_KEYS = ("password", "token", "secret", "signature", "_sig", "api_key", "apikey", "authorization")
+_SECRET_PATTERNS = (
+    re.compile(r"(?<!\d)\d{6,}:[A-Za-z0-9_-]{30,}"),  # токен Telegram-бота (в т.ч. в /bot<token>/ URL)
+    re.compile(r"\bsk-[A-Za-z0-9]{16,}"),  # ключ DeepSeek/OpenAI
+    re.compile(r"(?i)(SignatureValue=)[0-9a-f]+"),
+)
+
+# Атрибут LogRecord с полями события (log_event).
+_EVENT_ATTR = "event_fields"
+
+
+def redact_text(text: str) -> str:
+    for pattern in _SECRET_PATTERNS:
+        text = pattern.sub(lambda m: (m.group(1) if m.groups() else "") + REDACTED, text)
+    return text
+
+
+def redact_fields(fields: Any) -> Any:
+    if isinstance(fields, dict):
+        return {
+            k: REDACTED if any(s in str(k).lower() for s in _SECRET_KEYS) else redact_fields(v)
+            for k, v in fields.items()
+        }
+    if isinstance(fields, (list, tuple)):
+        return [redact_fields(v) for v in fields]
+    if isinstance(fields, str):
+        return redact_text(fields)
+    return fields
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: ts, level, logger, service, msg, event, поля события, exc."""
+
+    def __init__(self, service: str = ""):
+        super().__init__()
+        self.service = service
+
+    def format(self, record: logging.LogRecord) -> str:
+        doc: dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": redact_text(record.getMessage()),
+        }
+        if self.service:
+            doc["service"] = self.service
+        fields = getattr(record, _EVENT_ATTR, None)
+        if fields:
+            doc.update(redact_fields(fields))
+        if record.exc_info:
+            doc["exc"] = redact_text(self.formatException(record.exc_info))
+        elif record.exc_text:
+            doc["exc"] = redact_text(record.exc_text)
+        return json.dumps(doc, ensure_ascii=False, default=str)
+
+
+class RedactingTextFormatter(logging.Formatter):
+    """Обычный текстовый формат (как в basicConfig) с маскированием секретов и полями событий в конце."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        fields = getattr(record, _EVENT_ATTR, None)
+        if fields:
+            text += " " + json.dumps(redact_fields(fields), ensure_ascii=False, default=str)
+        return redact_text(text)
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Не блокирует вызывающий поток: если очередь полна, запись отбрасывается и считается."""
+
+    dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DroppingQueueHandler.dropped += 1
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue: Optional[queue.Queue] = None
+
+
+def setup_logging(
+    *,
+    service: str,
+    level: int | str | None = None,
+    log_file: Optional[str] = None,
+    max_bytes: Optional[int] = None,
+    backup_count: Optional[int] = None,
+    console: bool = True,
+    console_json: Optional[bool] = None,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+) -> None:
+    """
+    Настраивает корневой логгер процесса (повторный вызов ничего не меняет). Непереданные параметры
+    берутся из окружения: LOG_LEVEL, LOG_FILE, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_FORMAT=json|text.
+    """
+    global _listener, _queue
+    if _listener is not None:
+        return
+    level = level or (os.getenv("LOG_LEVEL") or "INFO").strip().upper()
+    log_file = log_file or (os.getenv("LOG_FILE") or "").strip() or None
+    max_bytes = max_bytes if max_bytes is not None else int(os.getenv("LOG_MAX_BYTES") or DEFAULT_MAX_BYTES)
+    backup_count = (
+        backup_count if backup_count is not None else int(os.getenv("LOG_BACKUP_COUNT") or DEFAULT_BACKUP_COUNT)
+    )
+    if console_json is None:
+        console_json = (os.getenv("LOG_FORMAT") or "").strip().lower() == "json"
+
+    handlers: list[logging.Handler] = []
+    if console:
+        stream = logging.StreamHandler(sys.stderr)
+        stream.setFormatter(JsonFormatter(service) if console_json else RedactingTextFormatter(TEXT_FORMAT))
+        handlers.append(stream)
+    if log_file:
+        rotating = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True
+        )
+        rotating.setFormatter(JsonFormatter(service))
+        handlers.append(rotating)
+
+    _queue = queue.Queue(maxsize=queue_size)
+    root = logging.getLogger()
+    root.addHandler(_DroppingQueueHandler(_queue))
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def flush_logs(timeout: float = 2.0) -> bool:
+    """Ждёт, пока фоновый поток запишет очередь (не дольше timeout). True — очередь пуста."""
+    if _queue is None:
+        return True
+    deadline = time.monotonic() + timeout
+    while _queue.unfinished_tasks:
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+
+def flush_logs_after(func):
+    """Декоратор обработчика Cloud Functions: после вызова дождаться записи логов (flush_logs)."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            flush_logs()
+
+    return wrapper
+
+
+def shutdown_logging() -> None:
+    """Дописывает очередь, останавливает фоновый поток и снимает обработчик очереди с корневого логгера."""
+    global _listener, _queue
+    listener, _listener = _listener, None
+    if listener is None:
+        return
+    listener.stop()
+    for h in listener.handlers:
+        h.close()
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        if isinstance(h, _DroppingQueueHandler):
+            root.removeHandler(h)
+    _queue = None
+
+
+def dropped_records() -> int:
+    return _DroppingQueueHandler.dropped
+
+
+def log_event(
+    logger: logging.Logger,
+    event: str,
+    *,
+    level: int = logging.INFO,
+    sample: float = 1.0,
+    **fields: Any,
+) -> None:
+    """
+    Структурированное событие: msg = event, поля — в JSON (секреты маскируются при записи).
+    sample — доля записываемых событий (0.1 — каждое десятое в среднем).
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if sample < 1.0 and random.random() >= sample:
+        return
+    if sample < 1.0:
+        fields["sample"] = sample
+    logger.log(level, event, extra={_EVENT_ATTR: {"event": event, **fields}})
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Обслуживание таблицы orders: каждое нажатие «Оплатить» создаёт заказ, и брошенные заказы копились бы
+в orders и её индексах навсегда — их читает каждый ResultURL и дайджест.
+
+run_maintenance — один проход, пачками (каждая пачка — короткая транзакция, ResultURL не ждёт):
+- заказы 'draft' (payment_links.py) старше draft_ttl удаляются;
+- неоплаченные заказы старше archive_after (ORDER_ARCHIVE_AFTER_DAYS) переносятся в orders_archive со
+  статусом 'expired'; оплаченные остаются в orders. ResultURL по архивному заказу возвращает его в orders;
+- 'pending' старше pending_ttl (ORDER_PENDING_TTL_HOURS) становятся 'expired' — ожидающими их больше
+  не считают, но оплата по такой ссылке всё равно засчитывается (confirm_payment);
+- incremental_vacuum возвращает ОС до vacuum_pages свободных страниц.
+
+Где запускается: MaintenanceWorker в robokassa_server.py (раз в ORDER_MAINTENANCE_INTERVAL_MIN), функция
+по таймеру в Cloud Functions (deploy/handler_robokassa.handler_maintenance) или вручную/по cron:
+python orders_maintenance.py [--enable-incremental-vacuum]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+from typing import Callable, Optional
+
+from payments_store import PaymentsStore, payments_db
+from robokassa_integration import PaymentsDB
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PENDING_TTL_HOURS = 72
+DEFAULT_ARCHIVE_AFTER_DAYS = 30
+# Заказы 'draft' prefetcher сам удаляет через 2 * PAYMENT_LINK_PREFETCH_TTL_SEC; здесь — с запасом.
+DEFAULT_DRAFT_TTL_SEC = 3600
+DEFAULT_VACUUM_PAGES = 2000
+# Строк на транзакцию: больше — быстрее проход, но дольше ResultURL ждёт блокировку записи (~0.1 с на 2000).
+DEFAULT_BATCH = 2000
+DEFAULT_INTERVAL_MIN = 60
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name) or default)
+    except ValueError:
+        return default
+
+
+def run_maintenance(
+    db: PaymentsStore,
+    *,
+    pending_ttl_sec: Optional[int] = None,
+    archive_after_sec: Optional[int] = None,
+    draft_ttl_sec: int = DEFAULT_DRAFT_TTL_SEC,
+    vacuum_pages: int = DEFAULT_VACUUM_PAGES,
+    batch: int = DEFAULT_BATCH,
+    time_budget: Optional[float] = None,
+) -> dict[str, int]:
+    """
+    Один проход обслуживания. Непереданные сроки — из окружения (ORDER_PENDING_TTL_HOURS,
+    ORDER_ARCHIVE_AFTER_DAYS). time_budget — секунд на проход: оставшееся доделает следующий.
+    """
+    if pending_ttl_sec is None:
+        pending_ttl_sec = _env_int("ORDER_PENDING_TTL_HOURS", DEFAULT_PENDING_TTL_HOURS) * 3600
+    if archive_after_sec is None:
+        archive_after_sec = _env_int("ORDER_ARCHIVE_AFTER_DAYS", DEFAULT_ARCHIVE_AFTER_DAYS) * 86400
+    # В архив попадают и pending — только те, что уже старше срока ожидания оплаты.
+    archive_after_sec = max(archive_after_sec, pending_ttl_sec)
+    deadline = time.monotonic() + time_budget if time_budget is not None else None
+    stats = {"drafts_discarded": 0, "archived": 0, "expired": 0, "vacuum_pages": 0}
+
+    def batches(step: Callable[[], int], key: str) -> None:
+        while deadline is None or time.monotonic() < deadline:
+            n = step()
+            stats[key] += n
+            if n < batch:
+                return
+
+    stats["drafts_discarded"] = db.discard_draft_orders(older_than_sec=draft_ttl_sec)
+    batches(lambda: db.archive_orders(older_than_sec=archive_after_sec, limit=batch), "archived")
+    batches(lambda: db.expire_pending_orders(older_than_sec=pending_ttl_sec, limit=batch), "expired")
+    stats["vacuum_pages"] = db.incremental_vacuum(vacuum_pages)
+    if any(stats.values()):
+        logger.info("Обслуживание orders: %s", stats)
+    return stats
+
+
+class MaintenanceWorker:
+    """Фоновое обслуживание в процессе с циклом asyncio (robokassa_server.py): проход в потоке раз в interval секунд."""
+
+    def __init__(
+        self,
+        *,
+        db_factory: Callable[[], PaymentsStore] = payments_db,
+        interval: Optional[float] = None,
+        **maintenance_kwargs,
+    ):
+        self._db_factory = db_factory
+        self.interval = interval if interval is not None else _env_int("ORDER_MAINTENANCE_INTERVAL_MIN", DEFAULT_INTERVAL_MIN) * 60
+        self._maintenance_kwargs = maintenance_kwargs
+        self._task: Optional[asyncio.Task] = None
+        self.counters = {"drafts_discarded": 0, "archived": 0, "expired": 0, "vacuum_pages": 0, "errors": 0}
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run(), name="orders-maintenance")
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def run_once(self) -> dict[str, int]:
+        stats = await asyncio.to_thread(lambda: run_maintenance(self._db_factory(), **self._maintenance_kwargs))
+        for key, n in stats.items():
+            self.counters[key] += n
+        return stats
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                self.counters["errors"] += 1
+                logger.exception("Обслуживание orders: ошибка прохода")
+            await asyncio.sleep(self.interval)
+
+
+def main() -> None:
+    from dotenv import load_dotenv
+
+    from log_pipeline import setup_logging
+
+    load_dotenv()
+    setup_logging(service="orders_maintenance")
+    parser = argparse.ArgumentParser(description="Обслуживание таблицы orders")
+    parser.add_argument(
+        "--enable-incremental-vacuum",
+        action="store_true",
+        help="перевести существующую базу в auto_vacuum=INCREMENTAL (полный VACUUM, один раз)",
+    )
+    args = parser.parse_args()
+    db = payments_db()
+    if args.enable_incremental_vacuum and isinstance(db, PaymentsDB):
+        db.enable_incremental_vacuum()
+    print(run_maintenance(db))
+    print(db.order_counts())
+
+
+if __name__ == "__main__":
+    main()
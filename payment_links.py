@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Ссылки на оплату Robokassa: подпись ссылки по заказу и подготовка заранее (PaymentLinkPrefetcher).
+
+Когда бот показывает клавиатуру pay_choice («Оплатить» с callback pay:<product>), следующим действием
+почти всегда будет нажатие. Без подготовки нажатие ждёт конфиг, создание заказа в пуле потоков базы
+и подпись ссылки. Prefetcher делает это в фоне сразу после показа клавиатуры:
+
+- prefetch(...) — создаёт заказ со статусом 'draft' (PaymentsDB.create_order(draft=True)) и ссылку;
+  повторный показ той же клавиатуры не создаёт второй заказ, пока подготовленный не устарел.
+- take(...) — при нажатии: дожидается подготовки (если она ещё идёт), переводит заказ в 'pending'
+  (activate_draft_order) и отдаёт ссылку. Выданная ссылка всегда указывает на заказ 'pending': очистка
+  draft (здесь и в orders_maintenance) его уже не удалит. None — подготовки не было, она не удалась,
+  устарела (старше ttl) или заказ не активировался; тогда вызывающий создаёт заказ как раньше.
+- Заказы 'draft' не считаются ожидающими оплаты; неиспользованные (старше 2 * ttl) удаляются
+  discard_draft_orders — из prefetch не чаще раза в reap_interval секунд.
+
+Состояние привязано к циклу asyncio; при новом цикле (webhook с asyncio.run на каждый update) сбрасывается,
+а созданные заказы 'draft' удалит следующая очистка.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from payments_async import AsyncPaymentsDB, payments_db_async
+from robokassa_integration import RobokassaConfig, build_payment_url
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL_SEC = 600.0
+DEFAULT_REAP_INTERVAL_SEC = 300.0
+
+
+def payment_url_for_order(
+    cfg: RobokassaConfig,
+    *,
+    inv_id: int,
+    order_token: str,
+    user_id: int,
+    chat_id: int,
+    product_code: str,
+    amount: str,
+    description: str,
+) -> str:
+    """Подписанная ссылка Robokassa на заказ; Shp_* — для ResultURL (robokassa_server)."""
+    shp = {
+        "Shp_user_id": str(user_id),
+        "Shp_chat_id": str(chat_id),
+        "Shp_product": str(product_code),
+        "Shp_order_token": order_token,
+    }
+    return build_payment_url(cfg=cfg, inv_id=inv_id, out_sum=amount, description=description, shp=shp)
+
+
+@dataclass(frozen=True, slots=True)
+class PreparedLink:
+    inv_id: int
+    order_token: str
+    url: str
+    prepared_at: float  # time.monotonic()
+
+
+class PaymentLinkPrefetcher:
+    """
+    db — фасад базы (AsyncPaymentsDB); config — RobokassaConfig (from_env вызывается при каждой
+    подготовке, как в send_payment_link). ttl — сколько секунд подготовленная ссылка годится для выдачи.
+    """
+
+    def __init__(
+        self,
+        db: Callable[[], AsyncPaymentsDB] = payments_db_async,
+        *,
+        config: Callable[[], RobokassaConfig] = RobokassaConfig.from_env,
+        ttl: float = DEFAULT_TTL_SEC,
+        reap_interval: float = DEFAULT_REAP_INTERVAL_SEC,
+    ):
+        self._db = db
+        self._config = config
+        self.ttl = ttl
+        self.reap_interval = reap_interval
+        self.counters = {"prefetched": 0, "hits": 0, "misses": 0, "stale": 0, "errors": 0, "discarded": 0}
+        self._links: dict[tuple[int, int, str], asyncio.Task] = {}
+        self._last_reap = time.monotonic()
+        self._reaper: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def prefetch(self, *, user_id: int, chat_id: int, product_code: str, amount: str, description: str) -> None:
+        """Запускает подготовку заказа и ссылки в фоне (из async-обработчика; не ждёт её)."""
+        self._check_loop()
+        key = (user_id, chat_id, product_code)
+        task = self._links.get(key)
+        if task is not None and not self._unusable(task):
+            return
+        self._links[key] = asyncio.get_running_loop().create_task(
+            self._prepare(user_id, chat_id, product_code, amount, description)
+        )
+        self.counters["prefetched"] += 1
+        self._maybe_reap()
+
+    async def take(self, *, user_id: int, chat_id: int, product_code: str) -> Optional[str]:
+        """Ссылка, подготовленная для этого пользователя и продукта (None — её нет или она устарела)."""
+        self._check_loop()
+        task = self._links.pop((user_id, chat_id, product_code), None)
+        if task is None or task.cancelled():
+            self.counters["misses"] += 1
+            return None
+        link = await task
+        if link is None:
+            return None
+        if self._stale(link):
+            self.counters["stale"] += 1
+            return None
+        # Перевод в pending до выдачи ссылки: иначе при сбое активации draft удалила бы очистка
+        # (discard_draft_orders), пока пользователь ещё держит подписанную ссылку на него.
+        if not await self._activate(link):
+            return None
+        self.counters["hits"] += 1
+        return link.url
+
+    async def _activate(self, link: PreparedLink) -> bool:
+        try:
+            if await self._db().activate_draft_order(link.inv_id, link.order_token):
+                return True
+            logger.warning("Заранее созданный заказ inv_id=%s не найден в статусе draft", link.inv_id)
+        except Exception:
+            logger.exception("Не удалось активировать заранее созданный заказ inv_id=%s", link.inv_id)
+        self.counters["errors"] += 1
+        return False
+
+    async def _prepare(
+        self, user_id: int, chat_id: int, product_code: str, amount: str, description: str
+    ) -> Optional[PreparedLink]:
+        try:
+            cfg = self._config()
+            inv_id, token = await self._db().create_order(
+                user_id=user_id,
+                chat_id=chat_id,
+                product_code=product_code,
+                amount=amount,
+                description=description,
+                draft=True,
+            )
+            url = payment_url_for_order(
+                cfg,
+                inv_id=inv_id,
+                order_token=token,
+                user_id=user_id,
+                chat_id=chat_id,
+                product_code=product_code,
+                amount=amount,
+                description=description,
+            )
+        except Exception as e:
+            # Без конфига Robokassa, при ошибке базы или подписи нажатие пройдёт обычным путём и покажет
+            # ошибку там; созданный draft удалит очистка.
+            logger.warning("Ссылка на оплату не подготовлена заранее (user_id=%s): %s", user_id, e)
+            self.counters["errors"] += 1
+            return None
+        return PreparedLink(inv_id=inv_id, order_token=token, url=url, prepared_at=time.monotonic())
+
+    def _stale(self, link: PreparedLink) -> bool:
+        return time.monotonic() - link.prepared_at > self.ttl
+
+    def _unusable(self, task: asyncio.Task) -> bool:
+        if not task.done():
+            return False
+        if task.cancelled():
+            return True
+        link = task.result()
+        return link is None or self._stale(link)
+
+    def _maybe_reap(self) -> None:
+        now = time.monotonic()
+        if now - self._last_reap < self.reap_interval:
+            return
+        self._last_reap = now
+        for key, task in list(self._links.items()):
+            if self._unusable(task):
+                del self._links[key]
+        self._reaper = asyncio.get_running_loop().create_task(self._discard_drafts())
+
+    async def _discard_drafts(self) -> None:
+        try:
+            self.counters["discarded"] += await self._db().discard_draft_orders(older_than_sec=int(self.ttl * 2))
+        except Exception:
+            logger.exception("Не удалось удалить устаревшие заказы draft")
+
+    def _check_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._links.clear()
+            self._loop = loop
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Доставка уведомлений Telegram после оплаты из таблицы outbox (transactional outbox).
+
+PaymentsDB.confirm_payment пишет уведомления в outbox в той же транзакции, что и переход заказа
+в paid, поэтому ResultURL отвечает Robokassa сразу, не дожидаясь api.telegram.org, а уведомление
+не теряется при сбое отправки или падении процесса:
+
+- drain_outbox — один проход: забрать пачку «созревших» уведомлений (с арендой, см.
+  PaymentsDB.claim_outbox), отправить, отметить sent или назначить повтор с экспоненциальной паузой.
+  После max_attempts попыток и при постоянных ошибках Telegram (400/403: чат не найден, бот
+  заблокирован) уведомление помечается failed.
+- OutboxWorker — фоновая задача asyncio для robokassa_server.py: проход в потоке, затем ожидание
+  poll_interval или wake() после новой оплаты.
+- В Cloud Functions outbox разбирает отдельная функция по таймеру (deploy/handler_robokassa.handler_outbox).
+
+Доставка «хотя бы один раз»: при падении между отправкой и отметкой sent сообщение уйдёт повторно.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import Callable, Optional
+
+from payments_store import PaymentsStore, payments_db
+from robokassa_integration import _parse_notify_chat_id
+from telegram_api import TelegramAPIError, sync_bot_api
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH = 20
+# Сколько секунд забранное уведомление недоступно другим воркерам (дольше таймаута sendMessage).
+DEFAULT_LEASE_SEC = 60
+DEFAULT_MAX_ATTEMPTS = 8
+# Пауза перед повтором: backoff_base * 2^(попытка-1), не больше backoff_max (5 с, 10 с, 20 с, ... 1 ч).
+DEFAULT_BACKOFF_BASE = 5.0
+DEFAULT_BACKOFF_MAX = 3600.0
+DEFAULT_POLL_INTERVAL = 30.0
+
+# Ответы Telegram, при которых повтор бессмыслен.
+_PERMANENT_ERROR_CODES = (400, 403)
+
+# send(chat_id, text, disable_web_preview) — отправить сообщение или бросить исключение.
+Send = Callable[[int | str, str, bool], None]
+
+
+def telegram_sender(bot_token: str) -> Send:
+    """Отправка через общий клиент Bot API (telegram_api): соединения с api.telegram.org переиспользуются."""
+    api = sync_bot_api(bot_token)
+
+    def send(chat_id: int | str, text: str, disable_web_preview: bool) -> None:
+        api.send_message(chat_id, text, disable_web_page_preview=disable_web_preview)
+
+    return send
+
+
+def backoff_delay(attempts: int, *, base: float = DEFAULT_BACKOFF_BASE, maximum: float = DEFAULT_BACKOFF_MAX) -> float:
+    return min(maximum, base * (2 ** max(0, attempts - 1)))
+
+
+def drain_outbox(
+    db: PaymentsStore,
+    send: Send,
+    *,
+    limit: int = DEFAULT_BATCH,
+    lease_sec: int = DEFAULT_LEASE_SEC,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    backoff_base: float = DEFAULT_BACKOFF_BASE,
+    backoff_max: float = DEFAULT_BACKOFF_MAX,
+) -> dict[str, int]:
+    """Один проход по outbox (не больше limit уведомлений). Возвращает {"sent", "retry", "failed"}."""
+    stats = {"sent": 0, "retry": 0, "failed": 0}
+    for msg in db.claim_outbox(limit=limit, lease_sec=lease_sec):
+        try:
+            send(_parse_notify_chat_id(msg["chat_id"]), msg["text"], bool(msg["disable_web_preview"]))
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"[:500]
+            attempts = int(msg["attempts"])
+            permanent = isinstance(e, TelegramAPIError) and e.error_code in _PERMANENT_ERROR_CODES
+            if permanent or attempts >= max_attempts:
+                db.outbox_retry(msg["id"], error=error, retry_at=None)
+                stats["failed"] += 1
+                logger.error(
+                    "Outbox: уведомление %s (%s, InvId=%s) не доставлено после %s попыток: %s",
+                    msg["id"], msg["kind"], msg["inv_id"], attempts, error,
+                )
+            else:
+                delay = backoff_delay(attempts, base=backoff_base, maximum=backoff_max)
+                db.outbox_retry(msg["id"], error=error, retry_at=int(time.time() + delay))
+                stats["retry"] += 1
+                logger.warning(
+                    "Outbox: уведомление %s (%s, InvId=%s), попытка %s: %s; повтор через %.0f с",
+                    msg["id"], msg["kind"], msg["inv_id"], attempts, error, delay,
+                )
+            continue
+        db.outbox_sent(msg["id"])
+        stats["sent"] += 1
+    return stats
+
+
+class OutboxWorker:
+    """
+    Фоновая доставка outbox в процессе с циклом asyncio. db_factory вызывается в потоке прохода;
+    wake() — разбудить воркер сразу после оплаты, не дожидаясь poll_interval.
+    """
+
+    def __init__(
+        self,
+        send: Send,
+        *,
+        db_factory: Callable[[], PaymentsStore] = payments_db,
+        poll_interval: float = DEFAULT_POLL_INTERVAL,
+        batch: int = DEFAULT_BATCH,
+        **drain_kwargs,
+    ):
+        self._send = send
+        self._db_factory = db_factory
+        self.poll_interval = poll_interval
+        self.batch = batch
+        self._drain_kwargs = drain_kwargs
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.counters = {"sent": 0, "retry": 0, "failed": 0, "errors": 0}
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._wake = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run(), name="payment-outbox")
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    async def drain_once(self) -> dict[str, int]:
+        stats = await asyncio.to_thread(
+            lambda: drain_outbox(self._db_factory(), self._send, limit=self.batch, **self._drain_kwargs)
+        )
+        for key, n in stats.items():
+            self.counters[key] += n
+        return stats
+
+    async def _run(self) -> None:
+        while True:
+            self._wake.clear()
+            try:
+                stats = await self.drain_once()
+            except Exception:
+                self.counters["errors"] += 1
+                logger.exception("Outbox: ошибка прохода")
+                stats = {}
+            if sum(stats.values()) >= self.batch:
+                continue  # пачка полная — в очереди, вероятно, есть ещё
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
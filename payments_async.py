@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Асинхронный доступ к PaymentsDB (AsyncPaymentsDB) для обработчиков бота и robokassa_server.
+
+sqlite3 блокирует поток, а в async-обработчике — весь цикл событий: одна заблокированная база
+(timeout=30) останавливала бы стримы всех пользователей. Фасад выполняет методы PaymentsDB на
+отдельном пуле потоков с ограниченным числом воркеров (у каждого потока своё соединение,
+см. PaymentsDB._conn) и пишет в лог медленные запросы с разбивкой: ожидание свободного потока
+и само выполнение. У PostgreSQL (payments_pg.py, PAYMENTS_DB_URL) запросы и так асинхронные: фасад
+ждёт их через call_async без потока пула, параллельность ограничивает пул соединений asyncpg.
+
+Использование: await payments_db_async().create_order(...) — те же методы и аргументы, что у PaymentsDB.
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from payments_store import PaymentsStore, payments_db
+from robokassa_integration import PRO_ENTITLEMENTS, ProEntitlement
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 4
+# Запросы дольше этого (мс, ожидание + выполнение) пишутся в лог предупреждением.
+DEFAULT_SLOW_QUERY_MS = 200.0
+
+
+class AsyncPaymentsDB:
+    """
+    db_factory — откуда брать хранилище (вызывается в потоке пула, поэтому миграция схемы тоже не
+    блокирует цикл событий); max_workers — сколько запросов к базе выполняется одновременно.
+    """
+
+    def __init__(
+        self,
+        db_factory: Callable[[], PaymentsStore] = payments_db,
+        *,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        slow_query_ms: float = DEFAULT_SLOW_QUERY_MS,
+    ):
+        self._db_factory = db_factory
+        self.slow_query_ms = slow_query_ms
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="payments-db")
+        self.counters = {"queries": 0, "slow": 0, "errors": 0}
+        # Хранилище с call_async (PostgresPaymentsDB) — запоминается при первом запросе.
+        self._native: Optional[Any] = None
+
+    async def call(self, method: str, *args: Any, **kwargs: Any) -> Any:
+        """Выполняет <хранилище>.<method>(*args, **kwargs) в пуле потоков (PostgreSQL — на пуле asyncpg)."""
+        if self._native is not None:
+            return await self._call_native(method, *args, **kwargs)
+        submitted = time.monotonic()
+        started: list[float] = []
+
+        def run() -> Any:
+            started.append(time.monotonic())
+            db = self._db_factory()
+            if hasattr(db, "call_async"):
+                self._native = db
+            return getattr(db, method)(*args, **kwargs)
+
+        loop = asyncio.get_running_loop()
+        self.counters["queries"] += 1
+        try:
+            return await loop.run_in_executor(self._executor, run)
+        except Exception:
+            self.counters["errors"] += 1
+            raise
+        finally:
+            self._log_if_slow(method, submitted, started[0] if started else None)
+
+    async def _call_native(self, method: str, *args: Any, **kwargs: Any) -> Any:
+        submitted = time.monotonic()
+        self.counters["queries"] += 1
+        try:
+            return await self._native.call_async(method, *args, **kwargs)
+        except Exception:
+            self.counters["errors"] += 1
+            raise
+        finally:
+            self._log_if_slow(method, submitted, submitted)
+
+    async def pro_entitlement(self, user_id: int) -> ProEntitlement:
+        """Доступ к Pro: попадание в кэш (PRO_ENTITLEMENTS) — без пула потоков, промах — pro_entitlement хранилища."""
+        cached = PRO_ENTITLEMENTS.get(user_id)
+        if cached is not None:
+            return cached
+        return await self.call("pro_entitlement", user_id, use_cache=False)
+
+    def __getattr__(self, name: str) -> Callable[..., Any]:
+        if name.startswith("_") or not callable(getattr(PaymentsStore, name, None)):
+            raise AttributeError(name)
+        return functools.partial(self.call, name)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+    def _log_if_slow(self, method: str, submitted: float, started: Optional[float]) -> None:
+        now = time.monotonic()
+        total_ms = (now - submitted) * 1000
+        if total_ms < self.slow_query_ms:
+            return
+        self.counters["slow"] += 1
+        wait_ms = ((started or now) - submitted) * 1000
+        logger.warning(
+            "Медленный запрос к базе оплат %s: %.0f мс (ожидание потока %.0f мс, выполнение %.0f мс)",
+            method,
+            total_ms,
+            wait_ms,
+            total_ms - wait_ms,
+        )
+
+
+_shared: Optional[AsyncPaymentsDB] = None
+_shared_lock = threading.Lock()
+
+
+def payments_db_async() -> AsyncPaymentsDB:
+    """Общий на процесс фасад над payments_store.payments_db() (SQLite или PostgreSQL)."""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = AsyncPaymentsDB()
+        return _shared
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Хранилище оплат: интерфейс PaymentsStore (заказы, анкеты клиентов, outbox уведомлений) и выбор
+реализации по окружению — payments_db().
+
+- PaymentsDB (robokassa_integration.py) — SQLite-файл PAYMENTS_DB_PATH. Подходит, когда бот и
+  robokassa_server работают на одной ВМ и видят один файл.
+- PostgresPaymentsDB (payments_pg.py) — PostgreSQL через пул asyncpg, PAYMENTS_DB_URL. Нужен в Cloud
+  Functions: у каждого экземпляра функции свой временный payments.sqlite3, и заказ, созданный ботом,
+  ResultURL в нём не находит.
+
+Методы и их смысл у реализаций одинаковые (tests_bot проверяет обе одним набором проверок);
+SQLite-специфичное (explain_query_plan, enable_incremental_vacuum) в интерфейс не входит.
+"""
+from __future__ import annotations
+
+from typing import Any, Iterable, Mapping, Protocol, Sequence, runtime_checkable
+
+from robokassa_integration import PaidOrder, PaymentConfirmation, PaymentsDB, ProEntitlement, _env
+
+
+@runtime_checkable
+class PaymentsStore(Protocol):
+    # Заказы
+    def create_order(
+        self, *, user_id: int, chat_id: int, product_code: str, amount: str, description: str, draft: bool = False
+    ) -> tuple[int, str]: ...
+
+    def activate_draft_order(self, inv_id: int, order_token: str) -> bool: ...
+
+    def discard_draft_orders(self, *, older_than_sec: int) -> int: ...
+
+    def get_order(self, inv_id: int) -> dict[str, Any] | None: ...
+
+    def mark_paid_if_pending(self, inv_id: int, *, raw_params: dict[str, Any]) -> bool: ...
+
+    def confirm_payment(
+        self, inv_id: int, *, out_sum: str, order_token: str | None, raw_params: dict[str, Any]
+    ) -> PaymentConfirmation: ...
+
+    def get_group_orders_paid_since(self, since_ts: int) -> list[dict[str, Any]]: ...
+
+    def unnotified_group_orders(self, *, limit: int = 100) -> list[dict[str, Any]]: ...
+
+    def mark_group_notified(self, inv_ids: Sequence[int]) -> int: ...
+
+    def paid_orders(self, product_codes: Sequence[str], *, since_ts: int = 0) -> list[PaidOrder]: ...
+
+    def user_paid_orders(self, user_id: int, product_codes: Sequence[str]) -> list[PaidOrder]: ...
+
+    def last_paid_at(self, user_id: int, product_code: str) -> int | None: ...
+
+    def has_paid(self, user_id: int, product_code: str) -> bool: ...
+
+    def paid_user_ids(self, product_code: str) -> list[int]: ...
+
+    def pro_entitlement(self, user_id: int, *, use_cache: bool = True) -> ProEntitlement: ...
+
+    # Обслуживание orders (orders_maintenance.py)
+    def expire_pending_orders(self, *, older_than_sec: int, limit: int = 2000) -> int: ...
+
+    def archive_orders(self, *, older_than_sec: int, limit: int = 2000) -> int: ...
+
+    def incremental_vacuum(self, pages: int = 0) -> int: ...
+
+    def order_counts(self) -> dict[str, int]: ...
+
+    # Клиенты
+    def upsert_client(self, *, user_id: int, **fields: Any) -> None: ...
+
+    def bulk_upsert_clients(self, clients: Iterable[Mapping[str, Any]], *, chunk_size: int = 1000) -> int: ...
+
+    def get_client(self, user_id: int) -> dict[str, Any] | None: ...
+
+    def upsert_client_from_order(self, order: dict[str, Any]) -> None: ...
+
+    def backfill_clients_from_orders(self, *, chunk_size: int = 1000) -> int: ...
+
+    # Outbox уведомлений (payment_outbox.py)
+    def claim_outbox(self, *, limit: int, lease_sec: int) -> list[dict[str, Any]]: ...
+
+    def outbox_sent(self, outbox_id: int) -> None: ...
+
+    def outbox_retry(self, outbox_id: int, *, error: str, retry_at: int | None) -> None: ...
+
+    def outbox_counts(self) -> dict[str, int]: ...
+
+    # Метки заданий по расписанию (group_digest.py)
+    def job_mark(self, name: str) -> int | None: ...
+
+    def set_job_mark(self, name: str, *, expected: int | None, mark: int) -> bool: ...
+
+    def schema_version(self) -> int: ...
+
+    def close(self) -> None: ...
+
+
+def payments_db() -> PaymentsStore:
+    """Общее на процесс хранилище: PostgreSQL, если задан PAYMENTS_DB_URL, иначе SQLite (PAYMENTS_DB_PATH)."""
+    url = _env("PAYMENTS_DB_URL")
+    if url:
+        from payments_pg import PostgresPaymentsDB
+
+        return PostgresPaymentsDB.shared(url)
+    return PaymentsDB.from_env()
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Компилятор системного промпта по этапам диалога.
+
+system_prompt.txt делится на общее ядро (роль, стиль, кнопки, запреты) и секции этапов
+(первое сообщение, базовый контакт, диагностика, конфликт, инсайт, навигация, инфо об услугах,
+формат анкеты). В запрос к модели уходит ядро + только секции, нужные для текущего
+шага [STEP:...], — так меньше входных токенов и быстрее первый токен ответа.
+
+Отчёт по размеру секций (в токенах, оценка без внешних библиотек):
+  python prompt_compiler.py
+"""
+from __future__ import annotations
+
+import math
+import re
+from dataclasses import dataclass
+from typing import Iterable
+
+# Заголовок секции -> ключ. Сравнение по началу строки (вместе с # / ##).
+# Всё, что не попало в таблицу, относится к ядру и отправляется всегда.
+SECTION_HEADINGS: dict[str, str] = {
+    "##ПЕРВОЕ СООБЩЕНИЕ": "first_message",
+    "##БАЗОВЫЙ КОНТАКТ": "contact",
+    "##ФОКУСИРОВКА НА ЗАПРОСЕ": "diagnosis",
+    "##УГЛУБЛЕНИЕ В КОНФЛИКТ": "conflict",
+    "##ФОРМИРОВАНИЕ МИКРО-ИНСАЙТА": "insight",
+    "##ПОЛУЧЕНИЕ ОБРАТНОЙ СВЯЗИ": "insight_feedback",
+    "##НАВИГАЦИЯ": "navigation",
+    "#ИНФО ОБ УСЛУГАХ": "products_info",
+    "#ТЕХНИЧЕСКИЕ ИНСТРУКЦИИ": "anket",
+}
+
+CORE_KEY = "core"
+
+# Последний step_id -> секции этапов, которые нужны модели дальше (текущий этап и следующий,
+# т.к. между кнопками модель проходит несколько вопросов без тегов).
+# None — диалог только начался (тегов ещё не было).
+STAGE_SECTIONS: dict[str | None, tuple[str, ...]] = {
+    None: ("first_message", "contact"),
+    "start_diagnosis": ("first_message", "contact"),
+    "form_address": ("contact", "diagnosis"),
+    "messenger": ("contact", "diagnosis", "conflict"),
+    "conflict": ("conflict", "insight", "insight_feedback", "navigation"),
+    "insight_next": ("insight_feedback", "navigation", "products_info"),
+    "readiness": ("navigation", "products_info"),
+    "products": ("navigation", "products_info"),
+    "vip": ("navigation", "products_info"),
+    "pay_choice": ("navigation", "products_info"),
+    "webinar_offer": ("navigation", "products_info"),
+}
+
+# Секция анкеты (JSON-схема) нужна только для служебного запроса SHOW_JSON.
+ANKET_SECTION = "anket"
+
+
+# ---------- Оценка токенов ----------
+
+_TOKEN_PIECE_REGEX = re.compile(r"[A-Za-z]+|[^\W\d_]+|\d+|[^\w\s]|_", re.UNICODE)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Грубая локальная оценка числа токенов (BPE DeepSeek/OpenAI) без токенизатора:
+    латиница ~4 символа на токен, кириллица ~3, цифры ~3, знак препинания = 1 токен.
+    Погрешность ±15% — достаточно для бюджетов и отчётов.
+    """
+    if not text:
+        return 0
+    total = 0
+    for m in _TOKEN_PIECE_REGEX.finditer(text):
+        piece = m.group()
+        first = piece[0]
+        if first.isascii() and first.isalpha():
+            total += math.ceil(len(piece) / 4)
+        elif first.isalpha():
+            total += math.ceil(len(piece) / 3)
+        elif first.isdigit():
+            total += math.ceil(len(piece) / 3)
+        else:
+            total += 1
+    return total
+
+
+# ---------- Разбор и сборка ----------
+
+
+@dataclass(frozen=True)
+class PromptSection:
+    key: str
+    title: str
+    text: str
+    tokens: int
+
+
+def _section_key(line: str) -> str | None:
+    """Ключ секции, если строка — известный заголовок; иначе None."""
+    s = line.lstrip()
+    for heading, key in SECTION_HEADINGS.items():
+        if s.startswith(heading):
+            return key
+    return None
+
+
+def split_prompt(text: str) -> list[PromptSection]:
+    """
+    Делит промпт на секции по заголовкам «#» / «##».
+    Известный заголовок открывает секцию этапа; любой другой заголовок того же или более
+    высокого уровня закрывает её и возвращает текст в ядро.
+    """
+    sections: list[PromptSection] = []
+    key = CORE_KEY
+    level = 0
+    title = ""
+    buf: list[str] = []
+
+    def flush() -> None:
+        chunk = "\n".join(buf).strip("\n")
+        if chunk.strip():
+            sections.append(PromptSection(key, title, chunk, estimate_tokens(chunk)))
+        buf.clear()
+
+    for line in text.split("\n"):
+        stripped = line.lstrip()
+        if stripped.startswith("#"):
+            line_level = len(stripped) - len(stripped.lstrip("#"))
+            new_key = _section_key(stripped)
+            if new_key is not None:
+                flush()
+                key, level, title = new_key, line_level, stripped.rstrip(":").strip("# ")
+            elif key != CORE_KEY and line_level <= level:
+                flush()
+                key, level, title = CORE_KEY, 0, ""
+        buf.append(line)
+    flush()
+    return sections
+
+
+class PromptCompiler:
+    """Собирает промпт для шага: ядро + секции этапа, в исходном порядке файла."""
+
+    def __init__(self, text: str):
+        self.full_text = text
+        self.sections = split_prompt(text)
+        self._cache: dict[frozenset[str], str] = {}
+        self.full_tokens = estimate_tokens(text)
+
+    @property
+    def section_keys(self) -> set[str]:
+        return {s.key for s in self.sections if s.key != CORE_KEY}
+
+    @staticmethod
+    def stage_for_step(step_id: str | None) -> str | None:
+        """step_id из тега ([STEP:pay_choice:webinar] -> pay_choice); неизвестный шаг -> None."""
+        if not step_id:
+            return None
+        base = step_id.split(":", 1)[0].lower()
+        return base if base in STAGE_SECTIONS else None
+
+    def sections_for_step(self, step_id: str | None, *, include_anket: bool = False) -> frozenset[str]:
+        keys = set(STAGE_SECTIONS[self.stage_for_step(step_id)])
+        if include_anket:
+            keys.add(ANKET_SECTION)
+        return frozenset(keys)
+
+    def compile(self, step_id: str | None, *, include_anket: bool = False) -> str:
+        """Промпт для шага. Если в файле нет ни одной известной секции — весь текст целиком."""
+        if not self.section_keys:
+            return self.full_text
+        keys = self.sections_for_step(step_id, include_anket=include_anket)
+        cached = self._cache.get(keys)
+        if cached is None:
+            cached = "\n\n".join(s.text for s in self.sections if s.key == CORE_KEY or s.key in keys)
+            self._cache[keys] = cached
+        return cached
+
+    def report(self) -> list[tuple[str, int, int]]:
+        """[(ключ секции, символов, токенов)] — ядро суммарно, затем секции этапов."""
+        totals: dict[str, list[int]] = {}
+        for s in self.sections:
+            t = totals.setdefault(s.key, [0, 0])
+            t[0] += len(s.text)
+            t[1] += s.tokens
+        return [(k, v[0], v[1]) for k, v in totals.items()]
+
+    def stage_report(self, steps: Iterable[str | None] = STAGE_SECTIONS) -> list[tuple[str, int]]:
+        """[(step_id, токенов в собранном промпте)]."""
+        return [(str(step), estimate_tokens(self.compile(step))) for step in steps]
+
+    def format_report(self) -> str:
+        lines = [f"Полный промпт: {len(self.full_text)} символов, ~{self.full_tokens} токенов", "", "Секции:"]
+        for key, chars, tokens in self.report():
+            lines.append(f"  {key:<18} {chars:>6} симв. ~{tokens:>5} ток.")
+        lines.append("")
+        lines.append("Собранный промпт по шагам:")
+        for step, tokens in self.stage_report():
+            share = (100 * tokens / self.full_tokens) if self.full_tokens else 0
+            lines.append(f"  {step:<18} ~{tokens:>5} ток. ({share:.0f}% от полного)")
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    import os
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "system_prompt.txt")
+    with open(path, encoding="utf-8") as f:
+        print(PromptCompiler(f.read().strip()).format_report())
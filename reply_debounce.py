@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Склейка «очереди» сообщений пользователя в один ответ (ReplyDebouncer).
+
+Человек в тяжёлом состоянии часто пишет три-четыре коротких сообщения подряд. Без склейки на каждое
+уходит отдельный стрим DeepSeek, отдельная заглушка «…» и отдельная запись в истории.
+
+- Окно тишины: сообщение ждёт window секунд; если за это время пришло следующее, ответ строится
+  только по последнему вызову, а тексты всех сообщений склеиваются в одну реплику пользователя.
+- Вытеснение: если ответ на предыдущие сообщения ещё стоит в очереди или генерируется (не
+  зафиксирован через commit()), его задача отменяется, а тексты возвращаются в начало склейки.
+  Отменённый ответ сам откатывает свою реплику из истории (см. bot._reply_to_user).
+- Тексты склеиваются в порядке order (message_id), а не прихода: голосовое распознаётся дольше текста.
+
+Состояние привязано к циклу asyncio; при новом цикле (webhook с asyncio.run на каждый update) сбрасывается.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+# reply(merged_text) — построить и отправить ответ на склеенный текст.
+Reply = Callable[[str], Awaitable[None]]
+
+
+@dataclass(slots=True)
+class _Burst:
+    # (order, text) ещё не отданных в ответ сообщений.
+    texts: list = field(default_factory=list)
+    seq: int = 0
+    # Задача текущего ответа и тексты, из которых он построен.
+    task: Optional[asyncio.Task] = None
+    task_texts: list = field(default_factory=list)
+    committed: bool = False
+
+
+class ReplyDebouncer:
+    """window — окно тишины в секундах (0 — не ждать, но вытеснять незафиксированный ответ); separator — между текстами."""
+
+    def __init__(self, window: float = 1.0, *, separator: str = "\n"):
+        self.window = window
+        self.separator = separator
+        self.counters = {"submitted": 0, "merged": 0, "superseded": 0, "replies": 0}
+        self._bursts: dict[Hashable, _Burst] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def submit(self, key: Hashable, text: str, reply: Reply, *, order: int = 0) -> bool:
+        """
+        Добавить сообщение пользователя key. Возвращает True, если ответ построен этим вызовом,
+        False — если текст ушёл в склейку с более поздним сообщением (или ответ вытеснен им).
+        """
+        self._check_loop()
+        b = self._bursts.get(key)
+        if b is None:
+            b = self._bursts[key] = _Burst()
+        b.texts.append((order, text))
+        b.seq += 1
+        my_seq = b.seq
+        self.counters["submitted"] += 1
+        self._supersede(key, b)
+        if self.window > 0:
+            await asyncio.sleep(self.window)
+        else:
+            await asyncio.sleep(0)
+        if b.seq != my_seq:
+            self.counters["merged"] += 1
+            return False
+        texts = sorted(b.texts, key=lambda item: item[0])
+        b.texts = []
+        merged = self.separator.join(t for _, t in texts)
+        task = asyncio.get_running_loop().create_task(reply(merged))
+        b.task, b.task_texts, b.committed = task, texts, False
+        self.counters["replies"] += 1
+        try:
+            await asyncio.wait([task])
+        finally:
+            if b.task is task:
+                b.task, b.task_texts = None, []
+            if b.task is None and not b.texts and self._bursts.get(key) is b:
+                del self._bursts[key]
+        if task.cancelled():
+            return False
+        task.result()
+        return True
+
+    def commit(self, key: Hashable) -> None:
+        """Ответ сгенерирован и отправляется — больше не вытесняется. Вызывается из задачи reply."""
+        b = self._bursts.get(key)
+        if b is not None and b.task is not None and b.task is asyncio.current_task():
+            b.committed = True
+
+    def busy(self, key: Hashable) -> bool:
+        """Есть ли у пользователя ожидающие склейки сообщения или незавершённый ответ."""
+        b = self._bursts.get(key)
+        return b is not None and (bool(b.texts) or b.task is not None)
+
+    # ---------- внутреннее ----------
+
+    def _supersede(self, key: Hashable, b: _Burst) -> None:
+        task = b.task
+        if task is None or task.done() or b.committed:
+            return
+        task.cancel()
+        # Тексты отменённого ответа склеиваются с новыми — пользователь ответит на всё сразу.
+        b.texts[:0] = b.task_texts
+        b.task, b.task_texts = None, []
+        self.counters["superseded"] += 1
+        logger.debug("Ответ пользователю %s вытеснен новым сообщением", key)
+
+    def _check_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._bursts.clear()
+            self._loop = loop
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Отчёты (дайджест групповых, выгрузки, статистика) по снимку базы оплат, а не по рабочему файлу.
+
+Дайджест и выгрузки читают тот же SQLite, в который пишет ResultURL; долгое чтение держит WAL
+(checkpoint не может его сбросить, файл -wal растёт, а при checkpoint(TRUNCATE) писатели ждут).
+Снимок снимается sqlite3 backup API за одну короткую транзакцию чтения и копируется в файл-реплику
+(REPORTING_REPLICA_PATH); отчёты открывают реплику только на чтение (query_only, mmap).
+
+- ReportingReplica.refresh() — новый снимок. Метка свежести (replica_meta.snapshot_at — момент
+  начала чтения рабочей базы) пишется в промежуточную копию, и в реплику данные и метка попадают
+  одной транзакцией: отчёт не увидит новые данные со старой меткой.
+- ReportingReplica.db() — ReplicaPaymentsDB с методами PaymentsDB для чтения; снимок старше
+  max_age_sec (REPORTING_REPLICA_MAX_AGE_SEC) сначала обновляется — так работает cron без сервера.
+- ReplicaRefresher — обновление раз в REPORTING_REPLICA_REFRESH_SEC в robokassa_server.py.
+- reporting_db() / report_watermark() — для отчётов: реплика, если она настроена, иначе рабочая база.
+
+Запуск: python reporting_replica.py — обновить снимок и вывести число заказов по статусам.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from payments_store import PaymentsStore, payments_db
+from robokassa_integration import PaymentsDB, _env
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_AGE_SEC = 300
+DEFAULT_REFRESH_SEC = 60
+DEFAULT_MMAP_MB = 256
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name) or default)
+    except ValueError:
+        return default
+
+
+class ReplicaPaymentsDB(PaymentsDB):
+    """Реплика только для чтения: без миграций (схема приходит со снимком), соединения query_only с mmap."""
+
+    def __init__(self, path: str, *, mmap_mb: int = DEFAULT_MMAP_MB):
+        self.path = path
+        self.mmap_mb = mmap_mb
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA query_only=ON;")
+        conn.execute(f"PRAGMA mmap_size={self.mmap_mb * 2**20};")
+        conn.execute("PRAGMA temp_store=MEMORY;")
+        return conn
+
+    def snapshot_at(self) -> Optional[int]:
+        """Момент снимка (unix UTC): в реплике все оплаты, подтверждённые до него. None — снимка ещё нет."""
+        try:
+            row = self._conn().execute("SELECT snapshot_at FROM replica_meta").fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return int(row[0]) if row else None
+
+
+class ReportingReplica:
+    """source_path — рабочая база (PAYMENTS_DB_PATH), replica_path — файл снимка для отчётов."""
+
+    def __init__(
+        self,
+        source_path: str,
+        replica_path: str,
+        *,
+        max_age_sec: int = DEFAULT_MAX_AGE_SEC,
+        mmap_mb: int = DEFAULT_MMAP_MB,
+    ):
+        self.source_path = source_path
+        self.replica_path = replica_path
+        self.max_age_sec = max_age_sec
+        self._db = ReplicaPaymentsDB(replica_path, mmap_mb=mmap_mb)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_env() -> Optional["ReportingReplica"]:
+        """None — REPORTING_REPLICA_PATH не задан (или база — PostgreSQL), отчёты читают рабочую базу."""
+        replica_path = _env("REPORTING_REPLICA_PATH")
+        if not replica_path or _env("PAYMENTS_DB_URL"):
+            return None
+        # Схема рабочей базы — до первого снимка (новая база создаётся миграциями).
+        source = PaymentsDB.from_env()
+        return ReportingReplica(
+            source.path,
+            replica_path,
+            max_age_sec=_env_int("REPORTING_REPLICA_MAX_AGE_SEC", DEFAULT_MAX_AGE_SEC),
+            mmap_mb=_env_int("REPORTING_REPLICA_MMAP_MB", DEFAULT_MMAP_MB),
+        )
+
+    def refresh(self) -> int:
+        """Снимает новый снимок и возвращает его метку (unix UTC)."""
+        with self._lock:
+            started = time.perf_counter()
+            staging = f"{self.replica_path}.{os.getpid()}.tmp"
+            src = sqlite3.connect(self.source_path, timeout=30, isolation_level=None)
+            stage = sqlite3.connect(staging, isolation_level=None)
+            # Промежуточная копия и реплика восстанавливаются следующим снимком — fsync им не нужен.
+            stage.execute("PRAGMA synchronous=OFF;")
+            try:
+                snapshot_at = int(time.time())
+                # Одним шагом: одна транзакция чтения, писатели рабочей базы её не ждут (WAL). По шагам
+                # backup начинался бы заново после каждой записи ResultURL.
+                src.backup(stage)
+                src.close()
+                stage.execute("CREATE TABLE replica_meta (snapshot_at INTEGER NOT NULL)")
+                stage.execute("INSERT INTO replica_meta (snapshot_at) VALUES (?)", (snapshot_at,))
+                dst = sqlite3.connect(self.replica_path, timeout=30, isolation_level=None)
+                dst.execute("PRAGMA synchronous=OFF;")
+                try:
+                    stage.backup(dst)
+                    dst.execute("PRAGMA wal_checkpoint;")
+                finally:
+                    dst.close()
+            finally:
+                src.close()
+                stage.close()
+                for path in (staging, staging + "-wal", staging + "-shm"):
+                    if os.path.exists(path):
+                        os.remove(path)
+            logger.info(
+                "Снимок базы для отчётов: %s, %.0f мс",
+                self.replica_path,
+                (time.perf_counter() - started) * 1000,
+            )
+            return snapshot_at
+
+    def db(self, *, max_age_sec: Optional[int] = None) -> ReplicaPaymentsDB:
+        """Реплика для отчётов; снимок старше max_age_sec (по умолчанию self.max_age_sec) сначала обновляется."""
+        max_age = self.max_age_sec if max_age_sec is None else max_age_sec
+        snapshot_at = self._db.snapshot_at() if os.path.exists(self.replica_path) else None
+        if snapshot_at is None or time.time() - snapshot_at > max_age:
+            self.refresh()
+        return self._db
+
+
+def reporting_db(*, max_age_sec: Optional[int] = None) -> PaymentsStore:
+    """
+    База для отчётов: реплика (REPORTING_REPLICA_PATH), если задана, иначе рабочая база. В PostgreSQL
+    (PAYMENTS_DB_URL) чтение и так не мешает записи (MVCC) — отчёты читают рабочую базу.
+    """
+    replica = ReportingReplica.from_env()
+    if replica is None:
+        return payments_db()
+    return replica.db(max_age_sec=max_age_sec)
+
+
+def report_watermark(db: PaymentsStore) -> int:
+    """По состоянию на какой момент (unix UTC) данные отчёта: метка снимка или «сейчас» для рабочей базы."""
+    if isinstance(db, ReplicaPaymentsDB):
+        snapshot_at = db.snapshot_at()
+        if snapshot_at is not None:
+            return snapshot_at
+    return int(time.time())
+
+
+class ReplicaRefresher:
+    """Обновление снимка в процессе с циклом asyncio (robokassa_server.py): refresh в потоке раз в interval секунд."""
+
+    def __init__(self, replica: ReportingReplica, *, interval: Optional[float] = None):
+        self.replica = replica
+        self.interval = interval if interval is not None else _env_int("REPORTING_REPLICA_REFRESH_SEC", DEFAULT_REFRESH_SEC)
+        self._task: Optional[asyncio.Task] = None
+        self.counters = {"refreshes": 0, "errors": 0}
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run(), name="reporting-replica")
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.replica.refresh)
+                self.counters["refreshes"] += 1
+            except Exception:
+                self.counters["errors"] += 1
+                logger.exception("Снимок базы для отчётов: ошибка обновления")
+            await asyncio.sleep(self.interval)
+
+
+def main() -> None:
+    from datetime import datetime, timezone
+    from zoneinfo import ZoneInfo
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    replica = ReportingReplica.from_env()
+    if replica is None:
+        print("Снимок не используется (REPORTING_REPLICA_PATH не задан или PAYMENTS_DB_URL): отчёты читают рабочую базу.")
+        db: PaymentsStore = payments_db()
+    else:
+        replica.refresh()
+        db = replica.db()
+    watermark = datetime.fromtimestamp(report_watermark(db), tz=timezone.utc).astimezone(ZoneInfo("Europe/Moscow"))
+    print(f"Данные на {watermark:%d.%m.%Y %H:%M:%S} МСК: {db.order_counts()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -16,13 +16,19 @@ import json
 import logging
 import sqlite3
 import secrets
+import dataclasses
+import itertools
+import threading
 from dataclasses import dataclass
 from decimal import Decimal, ROUND_HALF_UP
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
-from typing import Any
+from typing import Any, Callable, Iterable, Mapping, Sequence
 from urllib.parse import urlencode
-from urllib.request import Request, urlopen
+
+from log_pipeline import log_event
+
+logger = logging.getLogger(__name__)
 
 
 def _env(name: str, default: str | None = None) -> str | None:
@@ -101,81 +107,425 @@ class RobokassaConfig:
         )
 
 
+# Профиль SQLite для каждого соединения: WAL (читатели не ждут писателя), synchronous=NORMAL (в WAL
+# это без потери целостности), кэш страниц 8 МБ и mmap 64 МБ под горячие таблицы.
+# auto_vacuum=INCREMENTAL действует только для нового файла базы (существующий переводит
+# PaymentsDB.enable_incremental_vacuum); свободные страницы возвращает incremental_vacuum.
+_SQLITE_PRAGMAS = (
+    "PRAGMA auto_vacuum=INCREMENTAL;",
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA foreign_keys=ON;",
+    "PRAGMA cache_size=-8000;",
+    "PRAGMA mmap_size=67108864;",
+    "PRAGMA temp_store=MEMORY;",
+)
+
+
+def _backfill_pro_access_until(conn: sqlite3.Connection) -> None:
+    """Миграция 4: оплаченным до неё заказам Pro — срок подписки от paid_at (PRO_SUBSCRIPTION_DAYS на момент миграции)."""
+    conn.execute(
+        """
+        UPDATE orders SET access_until = paid_at + ?
+        WHERE product_code = 'pro' AND status = 'paid' AND paid_at IS NOT NULL
+        """,
+        (pro_subscription_days() * 86400,),
+    )
+
+
+# Миграции схемы: (версия, SQL-инструкции). Применяются по порядку один раз на базу,
+# текущая версия — в PRAGMA user_version. Новые изменения схемы — только новой записью в конце.
+# Инструкция-функция получает соединение — для шагов, которым нужны параметры из окружения.
+_MIGRATIONS: tuple[tuple[int, tuple[str | Callable[[sqlite3.Connection], None], ...]], ...] = (
+    (
+        1,
+        (
+            """
+            CREATE TABLE IF NOT EXISTS orders (
+                inv_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                order_token TEXT NOT NULL,
+                user_id INTEGER,
+                chat_id INTEGER,
+                product_code TEXT NOT NULL,
+                amount TEXT NOT NULL,
+                description TEXT NOT NULL,
+                status TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                paid_at INTEGER,
+                raw_result_params TEXT
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status)",
+            """
+            CREATE TABLE IF NOT EXISTS clients (
+                user_id INTEGER PRIMARY KEY,
+                chat_id INTEGER,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                contact_channel TEXT,
+                contact_value TEXT,
+                profile_name TEXT,
+                form_address TEXT,
+                age_group TEXT,
+                focus TEXT,
+                duration TEXT,
+                previous_attempts TEXT,
+                conflict TEXT,
+                self_value_scale INTEGER,
+                insight TEXT,
+                readiness TEXT,
+                product TEXT,
+                tariff TEXT,
+                preferred_contact_time TEXT,
+                preferred_group_start TEXT,
+                anket_json TEXT,
+                updated_at INTEGER NOT NULL
+            )
+            """,
+        ),
+    ),
+    (
+        2,
+        (
+            # Исходящие уведомления Telegram после оплаты (transactional outbox): строка пишется в той же
+            # транзакции, что и переход заказа в paid, отправляет её воркер (payment_outbox.py).
+            """
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                inv_id INTEGER,
+                chat_id TEXT NOT NULL,
+                text TEXT NOT NULL,
+                disable_web_preview INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at INTEGER NOT NULL,
+                last_error TEXT,
+                created_at INTEGER NOT NULL,
+                sent_at INTEGER
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_at)",
+        ),
+    ),
+    (
+        3,
+        (
+            # Покрывающие индексы для запросов _ORDER_QUERIES: выборка оплат по продукту за период
+            # (дайджест, списки участников) и проверки доступа по user_id — без чтения строк таблицы.
+            """
+            CREATE INDEX IF NOT EXISTS idx_orders_product_status_paid
+            ON orders(product_code, status, paid_at, user_id, chat_id, amount)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_orders_user_product_status
+            ON orders(user_id, product_code, status, paid_at)
+            """,
+        ),
+    ),
+    (
+        4,
+        (
+            # Pro: доступ до access_until (unix UTC), DATABASE_DESIGN 3.3. Оплаченным до миграции заказам —
+            # pro_subscription_days() от paid_at.
+            "ALTER TABLE orders ADD COLUMN access_until INTEGER",
+            _backfill_pro_access_until,
+            """
+            CREATE INDEX IF NOT EXISTS idx_orders_pro_access
+            ON orders(user_id, access_until) WHERE product_code = 'pro' AND status = 'paid'
+            """,
+        ),
+    ),
+    (
+        5,
+        (
+            # Обслуживание orders (orders_maintenance.py): pending старше срока -> expired, старые expired
+            # переносятся в orders_archive. (status, created_at) заменяет idx_orders_status для выборок
+            # «статус старше даты». Колонки orders_archive = _ORDER_COLUMNS + archived_at.
+            """
+            CREATE TABLE IF NOT EXISTS orders_archive (
+                inv_id INTEGER PRIMARY KEY,
+                order_token TEXT NOT NULL,
+                user_id INTEGER,
+                chat_id INTEGER,
+                product_code TEXT NOT NULL,
+                amount TEXT NOT NULL,
+                description TEXT NOT NULL,
+                status TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                paid_at INTEGER,
+                raw_result_params TEXT,
+                access_until INTEGER,
+                archived_at INTEGER NOT NULL
+            )
+            """,
+            "DROP INDEX IF EXISTS idx_orders_status",
+            "CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders(status, created_at)",
+        ),
+    ),
+    (
+        6,
+        (
+            # Метки заданий по расписанию (group_digest.py: последний отправленный слот дайджеста). Общие
+            # для всех процессов с этой базой — сервер, cron и воркеры uvicorn не выполнят слот дважды.
+            """
+            CREATE TABLE IF NOT EXISTS job_marks (
+                name TEXT PRIMARY KEY,
+                mark INTEGER NOT NULL,
+                updated_at INTEGER NOT NULL
+            )
+            """,
+        ),
+    ),
+    (
+        7,
+        (
+            # Дайджест групповых по водяному знаку (group_digest.py): в него попадают оплаченные групповые
+            # заказы с group_notified_at IS NULL, после отправки им ставится время. Частичный индекс держит
+            # только ещё не отправленные — выборка дайджеста O(новых оплат). Отправленными считаются
+            # оплаты до последнего отправленного слота (job_marks, миграция 6): их покрыли дайджесты по
+            # окну. Оплаты после него уйдут в ближайший слот. Без метки дайджест не отправлялся по
+            # расписанию — отмечаются все.
+            "ALTER TABLE orders ADD COLUMN group_notified_at INTEGER",
+            "ALTER TABLE orders_archive ADD COLUMN group_notified_at INTEGER",
+            """
+            UPDATE orders SET group_notified_at = paid_at
+            WHERE status = 'paid' AND product_code IN ('group_standard', 'group_vip')
+              AND paid_at <= COALESCE(
+                  (SELECT mark FROM job_marks WHERE name = 'group_digest'), CAST(strftime('%s', 'now') AS INTEGER)
+              )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_orders_group_unnotified ON orders(group_notified_at, paid_at)
+            WHERE status = 'paid' AND product_code IN ('group_standard', 'group_vip') AND group_notified_at IS NULL
+            """,
+        ),
+    ),
+)
+SCHEMA_VERSION = _MIGRATIONS[-1][0]
+
+
+# Колонки orders (после миграции 4) — для переноса строк в orders_archive и обратно.
+_ORDER_COLUMNS = (
+    "inv_id", "order_token", "user_id", "chat_id", "product_code", "amount", "description",
+    "status", "created_at", "paid_at", "raw_result_params", "access_until", "group_notified_at",
+)
+# Список выборки _ORDER_COLUMNS для переноса в orders_archive: статус заменяется на 'expired' по имени
+# колонки, а не подстрокой (иначе задело бы и будущие колонки вроде status_changed_at).
+_ARCHIVED_ORDER_SELECT = ", ".join("'expired'" if c == "status" else c for c in _ORDER_COLUMNS)
+GROUP_PRODUCT_CODES = ("group_standard", "group_vip")
+DEFAULT_PRO_SUBSCRIPTION_DAYS = 30
+
+
+def pro_subscription_days() -> int:
+    """Срок подписки Pro в днях (PRO_SUBSCRIPTION_DAYS); каждая оплата продлевает доступ на этот срок."""
+    try:
+        return max(1, int(_env("PRO_SUBSCRIPTION_DAYS") or DEFAULT_PRO_SUBSCRIPTION_DAYS))
+    except ValueError:
+        return DEFAULT_PRO_SUBSCRIPTION_DAYS
+
+# Запросы к orders по оплатам. Каждый обслуживается индексом из миграции 3; tests_bot проверяет это
+# через EXPLAIN QUERY PLAN (PaymentsDB.explain_query_plan), так что новый запрос — сюда же.
+# {products} — плейсхолдеры для списка product_code (_in_placeholders).
+_ORDER_QUERIES: dict[str, str] = {
+    "paid_by_products_since": """
+        SELECT inv_id, user_id, chat_id, product_code, amount, paid_at
+        FROM orders
+        WHERE product_code IN ({products}) AND status = 'paid' AND paid_at >= ?
+        ORDER BY paid_at ASC
+    """,
+    "user_paid": """
+        SELECT inv_id, user_id, chat_id, product_code, amount, paid_at
+        FROM orders
+        WHERE user_id = ? AND product_code IN ({products}) AND status = 'paid'
+        ORDER BY paid_at DESC
+    """,
+    "user_last_paid_at": """
+        SELECT MAX(paid_at)
+        FROM orders
+        WHERE user_id = ? AND product_code = ? AND status = 'paid'
+    """,
+    "paid_user_ids": """
+        SELECT DISTINCT user_id
+        FROM orders
+        WHERE product_code = ? AND status = 'paid' AND user_id IS NOT NULL
+    """,
+    "user_pro_access_until": """
+        SELECT MAX(access_until)
+        FROM orders
+        WHERE user_id = ? AND product_code = 'pro' AND status = 'paid'
+    """,
+    # Условие повторяет WHERE частичного индекса idx_orders_group_unnotified (миграция 7) буквально:
+    # иначе SQLite его не выберет.
+    "group_unnotified": """
+        SELECT o.inv_id, o.user_id, o.chat_id, o.product_code, o.amount, o.paid_at,
+               c.username, c.first_name, c.last_name, c.contact_channel, c.contact_value, c.preferred_group_start
+        FROM orders AS o
+        LEFT JOIN clients AS c ON c.user_id = o.user_id
+        WHERE o.group_notified_at IS NULL AND o.status = 'paid' AND o.product_code IN ('group_standard', 'group_vip')
+        ORDER BY o.paid_at, o.inv_id
+        LIMIT ?
+    """,
+}
+
+
+def _in_placeholders(sql: str, count: int) -> str:
+    return sql.replace("{products}", ", ".join("?" * count))
+
+
+# Поля анкеты в clients (кроме user_id и updated_at). При вставке отсутствующие текстовые поля
+# хранятся как "", chat_id и self_value_scale — NULL.
+_CLIENT_FIELDS = (
+    "chat_id", "username", "first_name", "last_name", "contact_channel", "contact_value",
+    "profile_name", "form_address", "age_group", "focus", "duration", "previous_attempts",
+    "conflict", "self_value_scale", "insight", "readiness", "product", "tariff",
+    "preferred_contact_time", "preferred_group_start", "anket_json",
+)
+_CLIENT_NULLABLE_FIELDS = ("chat_id", "self_value_scale")
+
+# Параметры _CLIENT_UPSERT_SQL по порядку (?1, ?2, ...): кортеж для executemany дешевле словаря.
+_CLIENT_PARAMS = ("user_id", *_CLIENT_FIELDS, "updated_at", "changed")
+
+
+def _client_param(name: str) -> str:
+    return f"?{_CLIENT_PARAMS.index(name) + 1}"
+
+
+# Один оператор вместо SELECT + UPDATE/INSERT. В DO UPDATE стоит сам параметр, а не excluded.col:
+# в excluded None уже заменён на "", а при обновлении None должен оставлять старое значение.
+# WHERE changed — если передан только user_id, строка (и updated_at) не трогается, как раньше.
+_CLIENT_UPSERT_SQL = """
+    INSERT INTO clients (user_id, {columns}, updated_at)
+    VALUES ({user_id}, {values}, {updated_at})
+    ON CONFLICT(user_id) DO UPDATE SET
+        {updates},
+        updated_at = {updated_at}
+    WHERE {changed}
+""".format(
+    columns=", ".join(_CLIENT_FIELDS),
+    values=", ".join(
+        _client_param(c) if c in _CLIENT_NULLABLE_FIELDS else f"COALESCE({_client_param(c)}, '')"
+        for c in _CLIENT_FIELDS
+    ),
+    updates=", ".join(f"{c} = COALESCE({_client_param(c)}, clients.{c})" for c in _CLIENT_FIELDS),
+    user_id=_client_param("user_id"),
+    updated_at=_client_param("updated_at"),
+    changed=_client_param("changed"),
+)
+
+
+def _client_params(*, user_id: Any = None, **fields: Any) -> tuple[Any, ...]:
+    """Параметры _CLIENT_UPSERT_SQL: user_id, все поля анкеты (отсутствующие — None), updated_at, changed."""
+    unknown = fields.keys() - _CLIENT_FIELDS
+    if unknown:
+        raise ValueError(f"unknown client fields: {sorted(unknown)}")
+    if user_id is None:
+        raise ValueError("client user_id is required")
+    return _client_row(user_id, [fields.get(c) for c in _CLIENT_FIELDS])
+
+
+def _client_int(value: Any) -> int | None:
+    """Целое для chat_id и self_value_scale: "7.5" из анкеты -> 7, нечисловое ("7/10") -> None (не менять)."""
+    if value is None or isinstance(value, int):
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return int(float(value))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def _client_row(user_id: Any, values: list[Any]) -> tuple[Any, ...]:
+    """Кортеж _CLIENT_PARAMS по значениям полей анкеты в порядке _CLIENT_FIELDS."""
+    values = [_client_int(v) if c in _CLIENT_NULLABLE_FIELDS else v for c, v in zip(_CLIENT_FIELDS, values)]
+    return (int(user_id), *values, int(time.time()), any(v is not None for v in values))
+
+
 class PaymentsDB:
     """
     Простой SQLite-реестр заказов.
     Подходит для VPS/VM. Для serverless лучше вынести в внешнюю БД, но это даст
     рабочий "скелет" интеграции без дополнительных сервисов.
+
+    Один экземпляр на процесс (from_env/shared): схема мигрируется один раз при создании,
+    соединение открывается одно на поток и переиспользуется всеми методами.
     """
 
+    _shared: dict[str, "PaymentsDB"] = {}
+    _shared_lock = threading.Lock()
+
     def __init__(self, path: str):
         self.path = path
-        self._init()
+        self._local = threading.local()
+        self._migrate()
 
     @staticmethod
     def from_env() -> "PaymentsDB":
         path = _env("PAYMENTS_DB_PATH", "payments.sqlite3") or "payments.sqlite3"
-        return PaymentsDB(path)
+        return PaymentsDB.shared(path)
+
+    @classmethod
+    def shared(cls, path: str) -> "PaymentsDB":
+        """Общий на процесс экземпляр для path. Если файл базы пропал, схема создаётся заново."""
+        with cls._shared_lock:
+            db = cls._shared.get(path)
+            if db is None or not os.path.exists(path):
+                db = cls._shared[path] = cls(path)
+            return db
 
     def _connect(self) -> sqlite3.Connection:
         conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA foreign_keys=ON;")
+        for pragma in _SQLITE_PRAGMAS:
+            conn.execute(pragma)
         return conn
 
-    def _init(self) -> None:
-        conn = self._connect()
-        try:
-            conn.execute(
-                """
-                CREATE TABLE IF NOT EXISTS orders (
-                    inv_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    order_token TEXT NOT NULL,
-                    user_id INTEGER,
-                    chat_id INTEGER,
-                    product_code TEXT NOT NULL,
-                    amount TEXT NOT NULL,
-                    description TEXT NOT NULL,
-                    status TEXT NOT NULL,
-                    created_at INTEGER NOT NULL,
-                    paid_at INTEGER,
-                    raw_result_params TEXT
-                )
-                """
-            )
-            conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status)")
-            conn.execute(
-                """
-                CREATE TABLE IF NOT EXISTS clients (
-                    user_id INTEGER PRIMARY KEY,
-                    chat_id INTEGER,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    contact_channel TEXT,
-                    contact_value TEXT,
-                    profile_name TEXT,
-                    form_address TEXT,
-                    age_group TEXT,
-                    focus TEXT,
-                    duration TEXT,
-                    previous_attempts TEXT,
-                    conflict TEXT,
-                    self_value_scale INTEGER,
-                    insight TEXT,
-                    readiness TEXT,
-                    product TEXT,
-                    tariff TEXT,
-                    preferred_contact_time TEXT,
-                    preferred_group_start TEXT,
-                    anket_json TEXT,
-                    updated_at INTEGER NOT NULL
-                )
-                """
-            )
-        finally:
+    def _conn(self) -> sqlite3.Connection:
+        """
+        Соединение текущего потока (sqlite3 не разрешает делить соединение между потоками).
+        После fork (воркеры uvicorn) соединение родителя не используется — открываем своё.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = self._connect()
+            self._local.pid = os.getpid()
+        return conn
+
+    def close(self) -> None:
+        """Закрывает соединение текущего потока (следующий вызов откроет новое)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            self._local.conn = None
             conn.close()
 
+    def schema_version(self) -> int:
+        return int(self._conn().execute("PRAGMA user_version").fetchone()[0])
+
+    def _migrate(self) -> None:
+        """Применяет недостающие миграции в одной транзакции; параллельный процесс ждёт на BEGIN IMMEDIATE."""
+        conn = self._conn()
+        if self.schema_version() >= SCHEMA_VERSION:
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            current = self.schema_version()
+            for version, statements in _MIGRATIONS:
+                if version <= current:
+                    continue
+                for sql in statements:
+                    if callable(sql):
+                        sql(conn)
+                    else:
+                        conn.execute(sql)
+                conn.execute(f"PRAGMA user_version={version}")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
     def create_order(
         self,
         *,
@@ -184,34 +534,57 @@ class PaymentsDB:
         product_code: str,
         amount: str,
         description: str,
+        draft: bool = False,
     ) -> tuple[int, str]:
+        """
+        draft=True — заказ, созданный заранее (payment_links.PaymentLinkPrefetcher), пока пользователь
+        не нажал «Оплатить»: статус 'draft', в pending и отчёты не попадает. При нажатии —
+        activate_draft_order, неиспользованные удаляет discard_draft_orders.
+        """
         token = secrets.token_urlsafe(16)
         now = int(time.time())
-        conn = self._connect()
-        try:
-            cur = conn.execute(
-                """
-                INSERT INTO orders (order_token, user_id, chat_id, product_code, amount, description, status, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, 'pending', ?)
-                """,
-                (token, user_id, chat_id, product_code, amount, description, now),
-            )
-            inv_id = int(cur.lastrowid)
-            return inv_id, token
-        finally:
-            conn.close()
+        conn = self._conn()
+        cur = conn.execute(
+            """
+            INSERT INTO orders (order_token, user_id, chat_id, product_code, amount, description, status, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (token, user_id, chat_id, product_code, amount, description, "draft" if draft else "pending", now),
+        )
+        inv_id = int(cur.lastrowid)
+        return inv_id, token
+
+    def activate_draft_order(self, inv_id: int, order_token: str) -> bool:
+        """Заказ 'draft' -> 'pending' (created_at — момент нажатия). False — заказа уже нет (удалён как устаревший)."""
+        cur = self._conn().execute(
+            """
+            UPDATE orders SET status='pending', created_at=?
+            WHERE inv_id=? AND order_token=? AND status='draft'
+            """,
+            (int(time.time()), inv_id, order_token),
+        )
+        return cur.rowcount == 1
+
+    def discard_draft_orders(self, *, older_than_sec: int) -> int:
+        """Удаляет заказы 'draft' старше older_than_sec (ссылку по ним так и не запросили). Возвращает их число."""
+        cur = self._conn().execute(
+            "DELETE FROM orders WHERE status='draft' AND created_at < ?",
+            (int(time.time()) - older_than_sec,),
+        )
+        return cur.rowcount
 
     def get_order(self, inv_id: int) -> dict[str, Any] | None:
-        conn = self._connect()
-        try:
-            cur = conn.execute("SELECT * FROM orders WHERE inv_id=?", (inv_id,))
+        """Заказ по inv_id; если его нет в orders — из orders_archive (с полем archived_at)."""
+        conn = self._conn()
+        cur = conn.execute("SELECT * FROM orders WHERE inv_id=?", (inv_id,))
+        row = cur.fetchone()
+        if not row:
+            cur = conn.execute("SELECT * FROM orders_archive WHERE inv_id=?", (inv_id,))
             row = cur.fetchone()
-            if not row:
-                return None
-            cols = [d[0] for d in cur.description]
-            return dict(zip(cols, row))
-        finally:
-            conn.close()
+        if not row:
+            return None
+        cols = [d[0] for d in cur.description]
+        return dict(zip(cols, row))
 
     def mark_paid_if_pending(self, inv_id: int, *, raw_params: dict[str, Any]) -> bool:
         """
@@ -219,176 +592,537 @@ class PaymentsDB:
         Возвращает True, если статус изменили с pending -> paid.
         """
         now = int(time.time())
-        conn = self._connect()
-        try:
-            cur = conn.execute(
-                """
-                UPDATE orders
-                SET status='paid', paid_at=?, raw_result_params=?
-                WHERE inv_id=? AND status='pending'
-                """,
-                (now, json.dumps(raw_params, ensure_ascii=False), inv_id),
-            )
-            return cur.rowcount > 0
-        finally:
-            conn.close()
+        conn = self._conn()
+        cur = conn.execute(
+            """
+            UPDATE orders
+            SET status='paid', paid_at=?, raw_result_params=?
+            WHERE inv_id=? AND status='pending'
+            """,
+            (now, json.dumps(raw_params, ensure_ascii=False), inv_id),
+        )
+        return cur.rowcount > 0
 
     def get_group_orders_paid_since(self, since_ts: int) -> list[dict[str, Any]]:
         """
         Возвращает заказы по групповым занятиям (group_standard, group_vip) с status='paid'
         и paid_at >= since_ts (unix timestamp UTC). Сортировка по paid_at по возрастанию.
         """
-        conn = self._connect()
+        return [
+            dataclasses.asdict(order) for order in self.paid_orders(GROUP_PRODUCT_CODES, since_ts=since_ts)
+        ]
+
+    def unnotified_group_orders(self, *, limit: int = 100) -> list[dict[str, Any]]:
+        """
+        Оплаченные групповые заказы, ещё не попавшие в дайджест (group_notified_at IS NULL), с анкетой
+        клиента — один запрос (LEFT JOIN clients) по частичному индексу, по возрастанию paid_at.
+        """
+        cur = self._conn().execute(_ORDER_QUERIES["group_unnotified"], (limit,))
+        cols = [d[0] for d in cur.description]
+        return [dict(zip(cols, row)) for row in cur.fetchall()]
+
+    def mark_group_notified(self, inv_ids: Sequence[int]) -> int:
+        """Отмечает заказы отправленными в дайджест (после успешной отправки). Возвращает число отмеченных."""
+        if not inv_ids:
+            return 0
+        cur = self._conn().execute(
+            f"UPDATE orders SET group_notified_at=? WHERE inv_id IN ({', '.join('?' * len(inv_ids))})"
+            " AND group_notified_at IS NULL",
+            (int(time.time()), *inv_ids),
+        )
+        return cur.rowcount
+
+    def paid_orders(self, product_codes: Sequence[str], *, since_ts: int = 0) -> list["PaidOrder"]:
+        """Оплаченные заказы по продуктам с paid_at >= since_ts, по возрастанию paid_at."""
+        sql = _in_placeholders(_ORDER_QUERIES["paid_by_products_since"], len(product_codes))
+        rows = self._conn().execute(sql, (*product_codes, since_ts)).fetchall()
+        return [PaidOrder(*row) for row in rows]
+
+    def user_paid_orders(self, user_id: int, product_codes: Sequence[str]) -> list["PaidOrder"]:
+        """Оплаченные заказы пользователя по продуктам, новые первыми (проверки доступа, DATABASE_DESIGN 3.3–3.5)."""
+        sql = _in_placeholders(_ORDER_QUERIES["user_paid"], len(product_codes))
+        rows = self._conn().execute(sql, (user_id, *product_codes)).fetchall()
+        return [PaidOrder(*row) for row in rows]
+
+    def last_paid_at(self, user_id: int, product_code: str) -> int | None:
+        """paid_at последней оплаты продукта пользователем (unix UTC) или None — основа доступа Pro по времени."""
+        row = self._conn().execute(_ORDER_QUERIES["user_last_paid_at"], (user_id, product_code)).fetchone()
+        return int(row[0]) if row and row[0] is not None else None
+
+    def has_paid(self, user_id: int, product_code: str) -> bool:
+        """Есть ли у пользователя оплаченный заказ продукта (например, доступ на вебинар)."""
+        return self.last_paid_at(user_id, product_code) is not None
+
+    def paid_user_ids(self, product_code: str) -> list[int]:
+        """user_id всех оплативших продукт (список участников вебинара)."""
+        rows = self._conn().execute(_ORDER_QUERIES["paid_user_ids"], (product_code,)).fetchall()
+        return [int(r[0]) for r in rows]
+
+    def explain_query_plan(self, name: str, *, products: int = 2) -> list[str]:
+        """
+        Строки EXPLAIN QUERY PLAN для запроса _ORDER_QUERIES[name] (products — длина списка product_code).
+        План строится при подготовке запроса и от значений параметров не зависит, поэтому они NULL.
+        """
+        sql = _in_placeholders(_ORDER_QUERIES[name], products)
+        cur = self._conn().execute("EXPLAIN QUERY PLAN " + sql, (None,) * sql.count("?"))
+        return [row[3] for row in cur.fetchall()]
+
+    def expire_pending_orders(self, *, older_than_sec: int, limit: int = 2000) -> int:
+        """
+        Одна пачка обслуживания (orders_maintenance.py): до limit заказов 'pending' старше older_than_sec
+        (ссылку не оплатили) -> 'expired'. Возвращает их число.
+        """
+        cur = self._conn().execute(
+            """
+            UPDATE orders SET status='expired'
+            WHERE inv_id IN (SELECT inv_id FROM orders WHERE status='pending' AND created_at < ? LIMIT ?)
+            """,
+            (int(time.time()) - older_than_sec, limit),
+        )
+        return cur.rowcount
+
+    def archive_orders(self, *, older_than_sec: int, limit: int = 2000) -> int:
+        """
+        Одна пачка (одна транзакция): до limit неоплаченных заказов ('expired' и 'pending') старше older_than_sec
+        переносятся из orders в orders_archive со статусом 'expired' — старый pending сразу в архив, без
+        лишнего обновления индексов. older_than_sec — не меньше срока ожидания оплаты (orders_maintenance).
+        Оплаченные остаются в orders — по ним проверяется доступ. Возвращает число строк.
+        """
+        cols = ", ".join(_ORDER_COLUMNS)
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            cur = conn.execute(
-                """
-                SELECT inv_id, user_id, chat_id, product_code, amount, description, paid_at
-                FROM orders
-                WHERE product_code IN ('group_standard', 'group_vip')
-                  AND status = 'paid'
-                  AND paid_at >= ?
-                ORDER BY paid_at ASC
-                """,
-                (since_ts,),
-            )
-            cols = [d[0] for d in cur.description]
-            return [dict(zip(cols, row)) for row in cur.fetchall()]
-        finally:
-            conn.close()
+            ids = [
+                r[0]
+                for r in conn.execute(
+                    "SELECT inv_id FROM orders WHERE status IN ('expired', 'pending') AND created_at < ? LIMIT ?",
+                    (int(time.time()) - older_than_sec, limit),
+                )
+            ]
+            if ids:
+                in_ids = ", ".join("?" * len(ids))
+                conn.execute(
+                    f"""
+                    INSERT OR REPLACE INTO orders_archive ({cols}, archived_at)
+                    SELECT {_ARCHIVED_ORDER_SELECT}, ? FROM orders WHERE inv_id IN ({in_ids})
+                    """,
+                    (int(time.time()), *ids),
+                )
+                conn.execute(f"DELETE FROM orders WHERE inv_id IN ({in_ids})", ids)
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        return len(ids)
+
+    @staticmethod
+    def _restore_archived_order(conn: sqlite3.Connection, inv_id: int) -> bool:
+        """Возвращает заказ из orders_archive в orders (внутри транзакции confirm_payment)."""
+        cols = ", ".join(_ORDER_COLUMNS)
+        cur = conn.execute(
+            f"INSERT INTO orders ({cols}) SELECT {cols} FROM orders_archive WHERE inv_id=?", (inv_id,)
+        )
+        if cur.rowcount != 1:
+            return False
+        conn.execute("DELETE FROM orders_archive WHERE inv_id=?", (inv_id,))
+        return True
+
+    def incremental_vacuum(self, pages: int = 0) -> int:
+        """
+        Возвращает ОС до pages свободных страниц файла (0 — все). Только для базы с auto_vacuum=INCREMENTAL,
+        иначе ничего не делает. Возвращает число освобождённых страниц.
+        """
+        conn = self._conn()
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+        before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        return before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    def enable_incremental_vacuum(self) -> None:
+        """Переводит существующую базу в auto_vacuum=INCREMENTAL: полный VACUUM, запись на это время блокируется."""
+        conn = self._conn()
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+
+    def order_counts(self) -> dict[str, int]:
+        """Число заказов по статусам и в архиве (archived) — для мониторинга обслуживания."""
+        conn = self._conn()
+        counts = {status: n for status, n in conn.execute("SELECT status, COUNT(*) FROM orders GROUP BY status")}
+        counts["archived"] = conn.execute("SELECT COUNT(*) FROM orders_archive").fetchone()[0]
+        return counts
+
+    def upsert_client(self, *, user_id: int, **fields: Any) -> None:
+        """
+        Создаёт или обновляет запись клиента (анкета). По user_id, одним оператором (_CLIENT_UPSERT_SQL).
+        Поля — из _CLIENT_FIELDS, неизвестное поле — ValueError (как в bulk_upsert_clients).
+        Пустые значения не перезаписывают существующие (при обновлении).
+        """
+        self._conn().execute(_CLIENT_UPSERT_SQL, _client_params(user_id=user_id, **fields))
+
+    def bulk_upsert_clients(self, clients: Iterable[Mapping[str, Any]], *, chunk_size: int = 1000) -> int:
+        """
+        Массовый upsert анкет (импорт выгрузки CRM, backfill_clients_from_orders): тот же оператор, что
+        в upsert_client, через executemany, по chunk_size строк в транзакции BEGIN IMMEDIATE.
+        Ключи словаря — user_id и поля из _CLIENT_FIELDS; неизвестный ключ — ValueError до записи чанка.
+        Возвращает число обработанных строк. Повторы user_id допустимы: применяются по порядку.
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be positive")
+        conn = self._conn()
+        total = 0
+        it = iter(clients)
+        while True:
+            chunk = [_client_params(**row) for row in itertools.islice(it, chunk_size)]
+            if not chunk:
+                return total
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(_CLIENT_UPSERT_SQL, chunk)
+                conn.execute("COMMIT")
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+            total += len(chunk)
+
+    def get_client(self, user_id: int) -> dict[str, Any] | None:
+        """Запись клиента (анкета) по user_id или None."""
+        cur = self._conn().execute("SELECT * FROM clients WHERE user_id=?", (user_id,))
+        row = cur.fetchone()
+        return dict(zip([d[0] for d in cur.description], row)) if row else None
+
+    def upsert_client_from_order(self, order: dict[str, Any]) -> None:
+        """
+        Создаёт или обновляет запись клиента по данным заказа (после оплаты).
+        Идентификация только по user_id — один клиент = одна строка.
+        """
+        fields = _client_fields_from_order(order)
+        if fields is None:
+            return
+        user_id, chat_id, product = fields
+        self.upsert_client(user_id=user_id, chat_id=chat_id, product=product)
+
+    def backfill_clients_from_orders(self, *, chunk_size: int = 1000) -> int:
+        """
+        Записи клиентов по всем оплаченным заказам (как upsert_client_from_order после оплаты) —
+        для базы, где clients заполнялась не всегда. Заказы по paid_at: у клиента остаётся продукт
+        последней оплаты. Возвращает число обработанных заказов с user_id.
+        """
+        orders = self._conn().execute(
+            "SELECT user_id, chat_id, product_code FROM orders WHERE status = 'paid' ORDER BY paid_at, inv_id"
+        ).fetchall()
+        rows = (_client_fields_from_order(dict(zip(("user_id", "chat_id", "product_code"), r))) for r in orders)
+        return self.bulk_upsert_clients(
+            (
+                {"user_id": f[0], "chat_id": f[1], "product": f[2]}
+                for f in rows
+                if f is not None
+            ),
+            chunk_size=chunk_size,
+        )
 
-    def upsert_client(
+    def confirm_payment(
         self,
+        inv_id: int,
         *,
-        user_id: int,
-        chat_id: int | None = None,
-        username: str | None = None,
-        first_name: str | None = None,
-        last_name: str | None = None,
-        contact_channel: str | None = None,
-        contact_value: str | None = None,
-        profile_name: str | None = None,
-        form_address: str | None = None,
-        age_group: str | None = None,
-        focus: str | None = None,
-        duration: str | None = None,
-        previous_attempts: str | None = None,
-        conflict: str | None = None,
-        self_value_scale: int | None = None,
-        insight: str | None = None,
-        readiness: str | None = None,
-        product: str | None = None,
-        tariff: str | None = None,
-        preferred_contact_time: str | None = None,
-        preferred_group_start: str | None = None,
-        anket_json: str | None = None,
-    ) -> None:
-        """
-        Создаёт или обновляет запись клиента (анкета). По user_id.
-        Пустые значения не перезаписывают существующие (при обновлении).
+        out_sum: str,
+        order_token: str | None,
+        raw_params: dict[str, Any],
+    ) -> "PaymentConfirmation":
         """
-        now = int(time.time())
-        conn = self._connect()
+        Обработка ResultURL одной транзакцией (BEGIN IMMEDIATE): проверка суммы и токена заказа,
+        переход pending -> paid, запись клиента, уведомления Telegram в outbox, итоговая строка заказа (RETURNING).
+        Повторные уведомления Robokassa по уже оплаченному заказу возвращают ok=True, newly_paid=False.
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            existing = conn.execute(
-                "SELECT user_id FROM clients WHERE user_id = ?", (user_id,)
-            ).fetchone()
-            if existing:
-                updates = []
-                params = []
-                for key, val in [
-                    ("chat_id", chat_id),
-                    ("username", username),
-                    ("first_name", first_name),
-                    ("last_name", last_name),
-                    ("contact_channel", contact_channel),
-                    ("contact_value", contact_value),
-                    ("profile_name", profile_name),
-                    ("form_address", form_address),
-                    ("age_group", age_group),
-                    ("focus", focus),
-                    ("duration", duration),
-                    ("previous_attempts", previous_attempts),
-                    ("conflict", conflict),
-                    ("self_value_scale", self_value_scale),
-                    ("insight", insight),
-                    ("readiness", readiness),
-                    ("product", product),
-                    ("tariff", tariff),
-                    ("preferred_contact_time", preferred_contact_time),
-                    ("preferred_group_start", preferred_group_start),
-                    ("anket_json", anket_json),
-                ]:
-                    if val is not None:
-                        updates.append(f"{key} = ?")
-                        params.append(val)
-                if updates:
-                    updates.append("updated_at = ?")
-                    params.append(now)
-                    params.append(user_id)
+            cur = conn.execute("SELECT * FROM orders WHERE inv_id=?", (inv_id,))
+            row = cur.fetchone()
+            if not row and self._restore_archived_order(conn, inv_id):
+                # Оплата по давно брошенной ссылке: заказ уже в архиве, возвращаем его в orders.
+                cur = conn.execute("SELECT * FROM orders WHERE inv_id=?", (inv_id,))
+                row = cur.fetchone()
+            if not row:
+                conn.execute("ROLLBACK")
+                return PaymentConfirmation(ok=False, error="unknown_order")
+            order = dict(zip([d[0] for d in cur.description], row))
+            if str(order.get("amount")) != str(out_sum):
+                conn.execute("ROLLBACK")
+                return PaymentConfirmation(ok=False, order=order, error="amount_mismatch")
+            token_expected = str(order.get("order_token") or "")
+            if token_expected and order_token and token_expected != order_token:
+                conn.execute("ROLLBACK")
+                return PaymentConfirmation(ok=False, order=order, error="token_mismatch")
+
+            # ResultURL по заказу 'draft' (ссылку не выдавали) или 'expired' (оплатили после срока)
+            # тоже засчитывается: деньги уже списаны.
+            cur = conn.execute(
+                """
+                UPDATE orders
+                SET status='paid', paid_at=?, raw_result_params=?
+                WHERE inv_id=? AND status IN ('pending', 'draft', 'expired')
+                RETURNING *
+                """,
+                (int(time.time()), json.dumps(raw_params, ensure_ascii=False), inv_id),
+            )
+            paid = cur.fetchone()
+            newly_paid = paid is not None
+            if newly_paid:
+                order = dict(zip([d[0] for d in cur.description], paid))
+                if order.get("product_code") == "pro" and order.get("user_id") is not None:
+                    order["access_until"] = self._extend_pro_access(conn, order)
+                fields = _client_fields_from_order(order)
+                if fields is not None:
                     conn.execute(
-                        "UPDATE clients SET " + ", ".join(updates) + " WHERE user_id = ?",
-                        params,
+                        """
+                        INSERT INTO clients (user_id, chat_id, product, updated_at)
+                        VALUES (?, ?, ?, ?)
+                        ON CONFLICT(user_id) DO UPDATE SET
+                            chat_id = COALESCE(excluded.chat_id, clients.chat_id),
+                            product = COALESCE(excluded.product, clients.product),
+                            updated_at = excluded.updated_at
+                        """,
+                        (*fields, int(time.time())),
                     )
-            else:
-                conn.execute(
+                now = int(time.time())
+                notifications = payment_notifications(order, raw_params)
+                if any(kind == "group_notify" for kind, *_ in notifications):
+                    # GROUP_DIGEST_MODE=immediate: строка в чат уходит через outbox, в дайджест заказ не попадёт.
+                    conn.execute("UPDATE orders SET group_notified_at=? WHERE inv_id=?", (now, inv_id))
+                    order["group_notified_at"] = now
+                conn.executemany(
                     """
-                    INSERT INTO clients (
-                        user_id, chat_id, username, first_name, last_name,
-                        contact_channel, contact_value, profile_name, form_address, age_group,
-                        focus, duration, previous_attempts, conflict, self_value_scale,
-                        insight, readiness, product, tariff, preferred_contact_time, preferred_group_start,
-                        anket_json, updated_at
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    INSERT INTO outbox (kind, inv_id, chat_id, text, disable_web_preview, status, next_attempt_at, created_at)
+                    VALUES (?, ?, ?, ?, ?, 'pending', ?, ?)
                     """,
-                    (
-                        user_id,
-                        chat_id,
-                        username or "",
-                        first_name or "",
-                        last_name or "",
-                        contact_channel or "",
-                        contact_value or "",
-                        profile_name or "",
-                        form_address or "",
-                        age_group or "",
-                        focus or "",
-                        duration or "",
-                        previous_attempts or "",
-                        conflict or "",
-                        self_value_scale,
-                        insight or "",
-                        readiness or "",
-                        product or "",
-                        tariff or "",
-                        preferred_contact_time or "",
-                        preferred_group_start or "",
-                        anket_json or "",
-                        now,
-                    ),
+                    [
+                        (kind, inv_id, str(chat_id), text, int(no_preview), now, now)
+                        for kind, chat_id, text, no_preview in notifications
+                    ],
                 )
-        finally:
-            conn.close()
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        if newly_paid and order.get("access_until") is not None:
+            # Кэш доступа этого процесса сразу видит оплату; другие процессы — через PRO_ACCESS_NEGATIVE_TTL_SEC.
+            PRO_ENTITLEMENTS.invalidate(int(order["user_id"]))
+        return PaymentConfirmation(ok=True, newly_paid=newly_paid, order=order)
 
-    def upsert_client_from_order(self, order: dict[str, Any]) -> None:
+    @staticmethod
+    def _extend_pro_access(conn: sqlite3.Connection, order: dict[str, Any]) -> int:
         """
-        Создаёт или обновляет запись клиента по данным заказа (после оплаты).
-        Идентификация только по user_id — один клиент = одна строка.
+        access_until оплаченного заказа Pro: pro_subscription_days() от конца текущей подписки, если она
+        ещё действует, иначе от paid_at. Вызывается внутри транзакции confirm_payment.
         """
-        user_id = order.get("user_id")
-        if user_id is None:
-            return
+        row = conn.execute(_ORDER_QUERIES["user_pro_access_until"], (order["user_id"],)).fetchone()
+        paid_at = int(order["paid_at"])
+        start = max(paid_at, int(row[0] or 0)) if row else paid_at
+        access_until = start + pro_subscription_days() * 86400
+        conn.execute("UPDATE orders SET access_until = ? WHERE inv_id = ?", (access_until, order["inv_id"]))
+        return access_until
+
+    def pro_entitlement(self, user_id: int, *, use_cache: bool = True) -> "ProEntitlement":
+        """
+        Доступ пользователя к Pro. Сначала кэш процесса (PRO_ENTITLEMENTS), при промахе (или use_cache=False) —
+        запрос user_pro_access_until (частичный индекс idx_orders_pro_access) и запись в кэш.
+        """
+        if use_cache:
+            cached = PRO_ENTITLEMENTS.get(user_id)
+            if cached is not None:
+                return cached
+        row = self._conn().execute(_ORDER_QUERIES["user_pro_access_until"], (user_id,)).fetchone()
+        access_until = int(row[0]) if row and row[0] is not None else None
+        return PRO_ENTITLEMENTS.put(user_id, access_until)
+
+    def claim_outbox(self, *, limit: int, lease_sec: int) -> list[dict[str, Any]]:
+        """
+        Забирает до limit уведомлений, которым пора уходить, и сдвигает их next_attempt_at на lease_sec:
+        параллельный воркер их не возьмёт, а если процесс упадёт до отметки — по истечении аренды
+        уведомление уйдёт снова (доставка «хотя бы один раз»). attempts увеличивается здесь же.
+        """
+        now = int(time.time())
+        cur = self._conn().execute(
+            """
+            UPDATE outbox
+            SET attempts = attempts + 1, next_attempt_at = ?
+            WHERE id IN (
+                SELECT id FROM outbox
+                WHERE status='pending' AND next_attempt_at <= ?
+                ORDER BY next_attempt_at, id
+                LIMIT ?
+            )
+            RETURNING *
+            """,
+            (now + lease_sec, now, limit),
+        )
+        cols = [d[0] for d in cur.description]
+        return sorted((dict(zip(cols, r)) for r in cur.fetchall()), key=lambda m: m["id"])
+
+    def outbox_sent(self, outbox_id: int) -> None:
+        self._conn().execute(
+            "UPDATE outbox SET status='sent', sent_at=?, last_error=NULL WHERE id=?",
+            (int(time.time()), outbox_id),
+        )
+
+    def outbox_retry(self, outbox_id: int, *, error: str, retry_at: int | None) -> None:
+        """Неудачная попытка: повтор в retry_at или, если None, уведомление больше не отправляется (failed)."""
+        if retry_at is None:
+            self._conn().execute(
+                "UPDATE outbox SET status='failed', last_error=? WHERE id=?", (error, outbox_id)
+            )
+        else:
+            self._conn().execute(
+                "UPDATE outbox SET next_attempt_at=?, last_error=? WHERE id=?", (retry_at, error, outbox_id)
+            )
+
+    def outbox_counts(self) -> dict[str, int]:
+        """Число уведомлений по статусам (pending/sent/failed) — для мониторинга очереди."""
+        rows = self._conn().execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+        return {status: int(n) for status, n in rows}
+
+    def job_mark(self, name: str) -> int | None:
+        """Метка задания name (job_marks) или None, если задание ещё не отмечалось."""
+        row = self._conn().execute("SELECT mark FROM job_marks WHERE name=?", (name,)).fetchone()
+        return int(row[0]) if row else None
+
+    def set_job_mark(self, name: str, *, expected: int | None, mark: int) -> bool:
+        """
+        Ставит метку mark, только если текущая равна expected (None — метки ещё нет). False — метку
+        уже сменил другой процесс: так из нескольких процессов слот забирает ровно один.
+        """
+        now = int(time.time())
+        if expected is None:
+            cur = self._conn().execute(
+                "INSERT INTO job_marks (name, mark, updated_at) VALUES (?, ?, ?) ON CONFLICT(name) DO NOTHING",
+                (name, mark, now),
+            )
+        else:
+            cur = self._conn().execute(
+                "UPDATE job_marks SET mark=?, updated_at=? WHERE name=? AND mark=?", (mark, now, name, expected)
+            )
+        return cur.rowcount > 0
+
+
+@dataclass(frozen=True, slots=True)
+class PaidOrder:
+    """Оплаченный заказ из запросов _ORDER_QUERIES (paid_at — unix UTC)."""
+
+    inv_id: int
+    user_id: int | None
+    chat_id: int | None
+    product_code: str
+    amount: str
+    paid_at: int
+
+
+@dataclass(frozen=True, slots=True)
+class ProEntitlement:
+    """Доступ к Pro: active — access_until (unix UTC) ещё не наступил."""
+
+    user_id: int
+    active: bool
+    access_until: int | None
+
+
+class EntitlementCache:
+    """
+    Кэш доступа к Pro в памяти процесса: user_id -> access_until. Проверка на каждое сообщение Pro-бота
+    стоит обращения к словарю, а не запроса к базе.
+
+    Активный доступ хранится ttl секунд, но не дольше access_until; отсутствие доступа — negative_ttl
+    секунд: оплата в этом процессе сбрасывает запись сразу (invalidate из confirm_payment), а оплата,
+    прошедшая через другой процесс (robokassa_server при боте на той же ВМ), видна не позже negative_ttl.
+    """
+
+    def __init__(self, *, ttl: float = 300.0, negative_ttl: float = 10.0, max_size: int = 100_000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.counters = {"hits": 0, "misses": 0, "invalidations": 0}
+        self._entries: dict[int, tuple[float, int | None]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> ProEntitlement | None:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] <= now:
+                self.counters["misses"] += 1
+                return None
+            self.counters["hits"] += 1
+        access_until = entry[1]
+        return ProEntitlement(user_id, access_until is not None and access_until > now, access_until)
+
+    def put(self, user_id: int, access_until: int | None) -> ProEntitlement:
+        now = time.time()
+        active = access_until is not None and access_until > now
+        expires = min(now + self.ttl, float(access_until)) if active else now + self.negative_ttl
+        with self._lock:
+            if user_id not in self._entries and len(self._entries) >= self.max_size:
+                self._entries.pop(next(iter(self._entries)))
+            self._entries[user_id] = (expires, access_until)
+        return ProEntitlement(user_id, active, access_until)
+
+    def last_known(self, user_id: int) -> ProEntitlement | None:
+        """Последняя запись о доступе, даже устаревшая (база недоступна); None — пользователя не проверяли."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        access_until = entry[1]
+        return ProEntitlement(user_id, access_until is not None and access_until > time.time(), access_until)
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self.counters["invalidations"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+PRO_ENTITLEMENTS = EntitlementCache(
+    ttl=float(_env("PRO_ACCESS_CACHE_TTL_SEC", "300") or 300),
+    negative_ttl=float(_env("PRO_ACCESS_NEGATIVE_TTL_SEC", "10") or 10),
+)
+
+
+@dataclass(frozen=True)
+class PaymentConfirmation:
+    """
+    Результат PaymentsDB.confirm_payment. ok=False — уведомление отклонено, error: unknown_order,
+    amount_mismatch или token_mismatch. order — строка заказа после транзакции.
+    """
+
+    ok: bool
+    newly_paid: bool = False
+    order: dict[str, Any] | None = None
+    error: str | None = None
+
+
+def _client_fields_from_order(order: dict[str, Any]) -> tuple[int, int | None, str | None] | None:
+    """(user_id, chat_id, product) для записи клиента по заказу; None — в заказе нет user_id."""
+    user_id = order.get("user_id")
+    if user_id is None:
+        return None
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    chat_id = order.get("chat_id")
+    if chat_id is not None:
         try:
-            user_id = int(user_id)
+            chat_id = int(chat_id)
         except (TypeError, ValueError):
-            return
-        chat_id = order.get("chat_id")
-        if chat_id is not None:
-            try:
-                chat_id = int(chat_id)
-            except (TypeError, ValueError):
-                chat_id = None
-        product = (order.get("product_code") or "").strip() or None
-        self.upsert_client(user_id=user_id, chat_id=chat_id, product=product)
+            chat_id = None
+    product = (order.get("product_code") or "").strip() or None
+    return user_id, chat_id, product
 
 
 def build_payment_url(
@@ -401,34 +1135,16 @@ def build_payment_url(
     email: str | None = None,
 ) -> str:
     out_sum_s = _to_amount_str(out_sum)
-    # #region agent log
-    try:
-        _log_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "debug-15b236.log")
-        _shp_keys = sorted(shp.keys()) if shp else []
-        with open(_log_path, "a", encoding="utf-8") as _f:
-            _f.write(
-                json.dumps(
-                    {
-                        "id": "build_payment_url",
-                        "timestamp": time.time(),
-                        "location": "robokassa_integration.build_payment_url",
-                        "message": "Payment URL built",
-                        "data": {
-                            "is_test": cfg.is_test,
-                            "merchant_login": cfg.merchant_login,
-                            "inv_id": inv_id,
-                            "out_sum": out_sum_s,
-                            "shp_keys": _shp_keys,
-                        },
-                        "hypothesisId": "H1",
-                    },
-                    ensure_ascii=False,
-                )
-                + "\n"
-            )
-    except Exception:
-        pass
-    # #endregion
+    log_event(
+        logger,
+        "robokassa.payment_url",
+        level=logging.DEBUG,
+        is_test=cfg.is_test,
+        merchant_login=cfg.merchant_login,
+        inv_id=inv_id,
+        out_sum=out_sum_s,
+        shp_keys=sorted(shp) if shp else [],
+    )
     sig_str = f"{cfg.merchant_login}:{out_sum_s}:{inv_id}:{cfg.password1}{_shp_signature_part(shp)}"
     signature = _md5_hex(sig_str)
 
@@ -445,7 +1161,7 @@ def build_payment_url(
         params["IsTest"] = "1"
         # При IsTest=1 Робокасса принимает только ТЕСТОВУЮ пару паролей из раздела «Технические настройки».
         # Использование боевых паролей приводит к ошибке 29 и сообщению «Форма оплаты не работает».
-        logging.getLogger(__name__).warning(
+        logger.warning(
             "Robokassa: is_test=1. Убедитесь, что в .env указаны ТЕСТОВЫЕ Пароль №1 и Пароль №2 "
             "из вкладки «Технические настройки» личного кабинета Robokassa, а не боевые пароли."
         )
@@ -475,34 +1191,17 @@ def verify_result_url(params: dict[str, Any], *, cfg: RobokassaConfig) -> dict[s
     # Строка для подписи: OutSum и InvId в том формате, как в запросе
     sig_str = f"{out_sum_raw}:{inv_id_i}:{cfg.password2}{_shp_signature_part(shp)}"
     expected = _md5_hex(sig_str)
-    # #region agent log
-    try:
-        _log_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "debug-15b236.log")
-        with open(_log_path, "a", encoding="utf-8") as _f:
-            _f.write(
-                json.dumps(
-                    {
-                        "id": "verify_result_url",
-                        "timestamp": time.time(),
-                        "message": "ResultURL signature check",
-                        "data": {
-                            "out_sum_raw": out_sum_raw,
-                            "out_sum_normalized": out_sum_s,
-                            "inv_id": inv_id_i,
-                            "shp_keys": sorted(shp.keys()) if shp else [],
-                            "expected_sig": expected,
-                            "received_sig": str(sig),
-                            "match": str(sig).lower() == expected.lower(),
-                        },
-                        "hypothesisId": "H-outsum",
-                    },
-                    ensure_ascii=False,
-                )
-                + "\n"
-            )
-    except Exception:
-        pass
-    # #endregion
+    # Подписи (ожидаемая и присланная) в лог не пишутся — только результат сравнения.
+    log_event(
+        logger,
+        "robokassa.result_signature",
+        level=logging.DEBUG,
+        out_sum_raw=out_sum_raw,
+        out_sum_normalized=out_sum_s,
+        inv_id=inv_id_i,
+        shp_keys=sorted(shp) if shp else [],
+        match=str(sig).lower() == expected.lower(),
+    )
     if str(sig).lower() != expected.lower():
         raise ValueError("Неверная подпись Robokassa (ResultURL)")
 
@@ -565,18 +1264,11 @@ def telegram_send_message(
     text: str,
     disable_web_preview: bool = False,
 ) -> None:
-    url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-    payload = urlencode(
-        {
-            "chat_id": str(chat_id),
-            "text": text,
-            "disable_web_page_preview": "true" if disable_web_preview else "false",
-        }
-    ).encode("utf-8")
-    req = Request(url, data=payload, method="POST")
-    req.add_header("Content-Type", "application/x-www-form-urlencoded")
-    with urlopen(req, timeout=10) as resp:
-        _ = resp.read()
+    """Синхронная отправка через общий клиент Bot API (telegram_api.sync_bot_api): соединение переиспользуется."""
+    # httpx импортируется только при отправке — ResultURL в Cloud Functions стартует без него.
+    from telegram_api import sync_bot_api
+
+    sync_bot_api(bot_token).send_message(chat_id, text, disable_web_page_preview=disable_web_preview)
 
 
 def build_access_message(product_code: str) -> str:
@@ -632,23 +1324,43 @@ def build_access_message(product_code: str) -> str:
 MSK = ZoneInfo("Europe/Moscow")
 
 
-def send_group_payment_notify_immediate(bot_token: str, order: dict[str, Any]) -> None:
+def payment_notifications(
+    order: dict[str, Any], raw_params: dict[str, Any] | None = None
+) -> list[tuple[str, int | str, str, bool]]:
     """
-    Если GROUP_DIGEST_MODE=immediate и задан TELEGRAM_GROUP_NOTIFY_CHAT_ID,
-    отправляет в чат дайджеста одну строку о только что оплаченном групповом заказе.
-    Иначе ничего не делает.
+    Уведомления Telegram после оплаты заказа: (kind, chat_id, text, disable_web_preview).
+    access — пользователю доступ по продукту (chat_id из заказа или Shp_chat_id), group_notify — строка
+    в чат дайджеста (см. group_payment_notify_message).
+    """
+    notifications: list[tuple[str, int | str, str, bool]] = []
+    try:
+        chat_id = int(order.get("chat_id") or (raw_params or {}).get("Shp_chat_id") or 0)
+    except (TypeError, ValueError):
+        chat_id = 0
+    if chat_id:
+        notifications.append(("access", chat_id, build_access_message(str(order.get("product_code") or "")), True))
+    group = group_payment_notify_message(order)
+    if group is not None:
+        notifications.append(("group_notify", group[0], group[1], False))
+    return notifications
+
+
+def group_payment_notify_message(order: dict[str, Any]) -> tuple[int | str, str] | None:
+    """
+    Если GROUP_DIGEST_MODE=immediate и задан TELEGRAM_GROUP_NOTIFY_CHAT_ID — (chat_id, text) одной строки
+    о только что оплаченном групповом заказе для чата дайджеста. Иначе None.
     """
     if (order.get("product_code") or "") not in ("group_standard", "group_vip"):
-        return
+        return None
     mode = (_env("GROUP_DIGEST_MODE") or "").strip().lower()
     if mode != "immediate":
-        return
+        return None
     chat_id_str = (_env("TELEGRAM_GROUP_NOTIFY_CHAT_ID") or "").strip()
     if not chat_id_str:
-        return
+        return None
     notify_chat_id = _parse_notify_chat_id(chat_id_str)
     if notify_chat_id is None:
-        return
+        return None
     paid_at = order.get("paid_at")
     if paid_at:
         dt = datetime.fromtimestamp(paid_at, tz=timezone.utc).astimezone(MSK)
@@ -664,7 +1376,17 @@ def send_group_payment_notify_immediate(bot_token: str, order: dict[str, Any]) -
         product = "VIP"
     amount = order.get("amount") or "—"
     text = f"Групповые (сразу): {time_str} МСК | user_id {user_id} | chat_id {chat_id} | {product} | {amount} ₽"
+    return notify_chat_id, text
+
+
+def send_group_payment_notify_immediate(bot_token: str, order: dict[str, Any]) -> None:
+    """
+    Отправляет group_payment_notify_message(order) сразу, минуя outbox. Если сообщения нет — ничего не делает.
+    """
+    message = group_payment_notify_message(order)
+    if message is None:
+        return
     try:
-        telegram_send_message(bot_token=bot_token, chat_id=notify_chat_id, text=text)
+        telegram_send_message(bot_token=bot_token, chat_id=message[0], text=message[1])
     except Exception:
-        logging.getLogger(__name__).exception("Групповой дайджест (immediate): не удалось отправить в Telegram")
+        logger.exception("Групповой дайджест (immediate): не удалось отправить в Telegram")
@@ -7,6 +7,7 @@ HTTP-сервер Robokassa для развёртывания на ВМ (Yandex
   GET/POST /robokassa/result — ResultURL (server-to-server); метод задаётся в настройках магазина Робокассы. Возвращает "OK{InvId}" или "ERROR"
   GET  /robokassa/success — SuccessURL (редирект после оплаты)
   GET  /robokassa/fail    — FailURL (отмена/ошибка оплаты)
+  GET  /access/{user_id}  — доступ к Pro для отдельного Pro-бота (только с ACCESS_API_TOKEN, см. ниже)
 
 Запуск (в venv на ВМ, пример):
   uvicorn robokassa_server:app --host 0.0.0.0 --port 8000 --http h11
@@ -29,34 +30,82 @@ HTTP-сервер Robokassa для развёртывания на ВМ (Yandex
 
 Тестовый режим (IsTest=1): на тестовой странице оплаты выберите блок
 «Успешное проведение платежа» — иначе попадёте на Fail URL и ResultURL не вызовется.
+
+Фоновые задачи сервера: отправка уведомлений из outbox, обслуживание orders, снимок базы для отчётов
+(REPORTING_REPLICA_PATH) и дайджест групповых по расписанию (GROUP_DIGEST_MODE=scheduled, group_digest.py).
 """
 
+import hmac
 import os
-import time
 import json
 import logging
-from typing import Any, Dict
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
 
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import PlainTextResponse, HTMLResponse
 
+from group_digest import DigestScheduler
+from log_pipeline import log_event, setup_logging
+from orders_maintenance import MaintenanceWorker
+from payment_outbox import OutboxWorker, telegram_sender
+from payments_async import payments_db_async
+from reporting_replica import ReplicaRefresher, ReportingReplica
 from robokassa_integration import (
-    PaymentsDB,
     RobokassaConfig,
-    build_access_message,
-    telegram_send_message,
     verify_result_url,
     verify_success_url,
-    send_group_payment_notify_immediate,
 )
 
 logger = logging.getLogger("robokassa_server")
-logging.basicConfig(
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
-)
+# Запись логов — в фоновом потоке (log_pipeline.py); файл с ротацией — если задан LOG_FILE.
+setup_logging(service="robokassa_server")
+
+# Доставка уведомлений об оплате из outbox (payment_outbox.py); без TELEGRAM_BOT_TOKEN не запускается.
+_outbox_worker: Optional[OutboxWorker] = None
+# Истечение брошенных заказов и архив (orders_maintenance.py), раз в ORDER_MAINTENANCE_INTERVAL_MIN.
+_maintenance_worker: Optional[MaintenanceWorker] = None
+# Снимок базы для отчётов (reporting_replica.py), если задан REPORTING_REPLICA_PATH.
+_replica_refresher: Optional[ReplicaRefresher] = None
+# Дайджест групповых в слоты GROUP_DIGEST_TIME_* (group_digest.py) вместо cron.
+_digest_scheduler: Optional[DigestScheduler] = None
+
+
+@asynccontextmanager
+async def _lifespan(_app: FastAPI):
+    global _outbox_worker, _maintenance_worker, _replica_refresher, _digest_scheduler
+    bot_token = os.getenv("TELEGRAM_BOT_TOKEN") or ""
+    if bot_token:
+        _outbox_worker = OutboxWorker(telegram_sender(bot_token))
+        _outbox_worker.start()
+    else:
+        logger.warning("TELEGRAM_BOT_TOKEN не задан: уведомления об оплате копятся в outbox и не отправляются")
+    _maintenance_worker = MaintenanceWorker()
+    _maintenance_worker.start()
+    replica = ReportingReplica.from_env()
+    if replica is not None:
+        _replica_refresher = ReplicaRefresher(replica)
+        _replica_refresher.start()
+    _digest_scheduler = DigestScheduler.from_env()
+    if _digest_scheduler is not None:
+        _digest_scheduler.start()
+    try:
+        yield
+    finally:
+        if _digest_scheduler is not None:
+            await _digest_scheduler.stop()
+            _digest_scheduler = None
+        if _replica_refresher is not None:
+            await _replica_refresher.stop()
+            _replica_refresher = None
+        await _maintenance_worker.stop()
+        _maintenance_worker = None
+        if _outbox_worker is not None:
+            await _outbox_worker.stop()
+            _outbox_worker = None
+
 
-app = FastAPI()
+app = FastAPI(lifespan=_lifespan)
 
 
 @app.middleware("http")
@@ -170,81 +219,35 @@ async def robokassa_result(request: Request) -> PlainTextResponse:
     Должен вернуть "OK{InvId}" при успешной проверке подписи.
     """
     params = await _collect_params(request)
-    # #region agent log
-    try:
-        _log_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "debug-15b236.log")
-        with open(_log_path, "a", encoding="utf-8") as _f:
-            _f.write(
-                json.dumps(
-                    {
-                        "id": "robokassa_result_called",
-                        "timestamp": time.time(),
-                        "location": "robokassa_server.robokassa_result",
-                        "message": "ResultURL hit",
-                        "data": {"InvId": params.get("InvId"), "OutSum": params.get("OutSum")},
-                        "hypothesisId": "H3",
-                    },
-                    ensure_ascii=False,
-                )
-                + "\n"
-            )
-    except Exception:
-        pass
-    # #endregion
+    log_event(logger, "robokassa.result_url", inv_id=params.get("InvId"), out_sum=params.get("OutSum"))
     try:
         cfg = RobokassaConfig.from_env()
-        db = PaymentsDB.from_env()
+        # Запросы к SQLite — в пуле потоков (payments_async.py), цикл событий uvicorn не блокируется.
+        db = payments_db_async()
         parsed = verify_result_url(params, cfg=cfg)
 
         inv_id = int(parsed["inv_id"])
-        out_sum = str(parsed["out_sum"])
-        order = db.get_order(inv_id)
-        if not order:
-            logger.warning("Robokassa (VM): unknown InvId=%s", inv_id)
-            return PlainTextResponse("ERROR")
-
-        if str(order.get("amount")) != out_sum:
+        shp = parsed.get("shp") or {}
+        # Проверка суммы и токена, перевод в paid, запись клиента и уведомлений — одна транзакция (PaymentsDB.confirm_payment).
+        result = await db.confirm_payment(
+            inv_id,
+            out_sum=str(parsed["out_sum"]),
+            order_token=str(shp.get("Shp_order_token") or "") or None,
+            raw_params=parsed.get("raw") or {},
+        )
+        if not result.ok:
             logger.warning(
-                "Robokassa (VM): amount mismatch InvId=%s %s != %s",
+                "Robokassa (VM): %s InvId=%s (OutSum=%s, в заказе %s)",
+                result.error,
                 inv_id,
-                order.get("amount"),
-                out_sum,
+                parsed["out_sum"],
+                (result.order or {}).get("amount"),
             )
             return PlainTextResponse("ERROR")
 
-        shp = parsed.get("shp") or {}
-        token_expected = str(order.get("order_token") or "")
-        token_got = str(shp.get("Shp_order_token") or "")
-        if token_expected and token_got and token_expected != token_got:
-            logger.warning("Robokassa (VM): token mismatch InvId=%s", inv_id)
-            return PlainTextResponse("ERROR")
-
-        newly_paid = db.mark_paid_if_pending(inv_id, raw_params=parsed.get("raw") or {})
-        if newly_paid:
-            order = db.get_order(inv_id)
-            if order:
-                try:
-                    db.upsert_client_from_order(order)
-                except Exception as e:
-                    logger.exception("Robokassa (VM): upsert_client_from_order failed: %s", e)
-            bot_token = os.getenv("TELEGRAM_BOT_TOKEN") or ""
-            if bot_token and order:
-                chat_id = int(order.get("chat_id") or shp.get("Shp_chat_id") or 0)
-                if chat_id:
-                    text = build_access_message(str(order.get("product_code") or ""))
-                    try:
-                        telegram_send_message(
-                            bot_token=bot_token,
-                            chat_id=chat_id,
-                            text=text,
-                            disable_web_preview=True,
-                        )
-                    except Exception as e:
-                        logger.exception("Robokassa (VM): Telegram sendMessage failed: %s", e)
-                try:
-                    send_group_payment_notify_immediate(bot_token, db.get_order(inv_id))
-                except Exception as e:
-                    logger.exception("Robokassa (VM): group digest immediate notify failed: %s", e)
+        # Уведомления пользователю и в чат дайджеста записаны в outbox той же транзакцией — отправит воркер.
+        if result.newly_paid and _outbox_worker is not None:
+            _outbox_worker.wake()
 
         return PlainTextResponse(f"OK{inv_id}")
     except Exception as e:
@@ -277,3 +280,18 @@ async def robokassa_success(request: Request) -> HTMLResponse:
 async def robokassa_fail(request: Request) -> HTMLResponse:  # noqa: ARG001
     return HTMLResponse(_fail_html())
 
+
+@app.get("/access/{user_id}")
+async def pro_access(user_id: int, request: Request) -> Dict[str, Any]:
+    """
+    Доступ пользователя к Pro (DATABASE_DESIGN 3.3) для Pro-бота на другой машине. Ответ — из кэша
+    процесса; ResultURL этого же процесса сбрасывает запись сразу при оплате Pro.
+    Требует заголовок Authorization: Bearer <ACCESS_API_TOKEN>; без ACCESS_API_TOKEN эндпоинт выключен.
+    """
+    token = (os.getenv("ACCESS_API_TOKEN") or "").strip()
+    if not token:
+        raise HTTPException(status_code=404)
+    if not hmac.compare_digest(request.headers.get("authorization") or "", f"Bearer {token}"):
+        raise HTTPException(status_code=401)
+    ent = await payments_db_async().pro_entitlement(user_id)
+    return {"user_id": ent.user_id, "product": "pro", "active": ent.active, "access_until": ent.access_until}
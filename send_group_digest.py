@@ -1,22 +1,26 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-Дайджест по оплатившим групповые занятия: выборка из БД за последние N часов (МСК),
+Дайджест по оплатившим групповые занятия: новые с прошлого дайджеста оплаты с анкетой клиента,
 таблица в Telegram на указанный chat_id.
 
 Режимы (GROUP_DIGEST_MODE в .env):
   - immediate — уведомления уходят сразу при каждой оплате (из ResultURL); этот скрипт по cron не нужен.
   - scheduled — отправка по расписанию в моменты GROUP_DIGEST_TIME_1/2/3 (пустые слоты пропускаются, от 1 до 3 раз в сутки).
 
-Запуск (для режима scheduled):
-  python send_group_digest.py [--since-hours 12]
-  По умолчанию --since-hours берётся из GROUP_DIGEST_SINCE_HOURS или 12.
+В режиме scheduled дайджест отправляет сам robokassa_server (group_digest.DigestScheduler). Скрипт —
+для ручной отправки и для cron, если сервер не запущен:
+  python send_group_digest.py [--force | --since-hours [12]]
 
-В режиме scheduled скрипт при запуске проверяет текущее время (МСК): если оно совпадает с одним из
-заданных непустых GROUP_DIGEST_TIME_* (формат HH:MM), отправляет дайджест; иначе выходит без отправки.
-Cron лучше запускать каждые 5–10 минут; отправка произойдёт только в заданные часы.
+Без ключей скрипт отправляет дайджест за последний наступивший слот, если его ещё не отправили
+(сервер или прошлый запуск) — метка слота хранится в базе оплат (group_digest.run_due_digest). Cron
+можно запускать с любым шагом, например каждые 10 минут: слот не потеряется и не уйдёт дважды.
+В дайджест попадают оплаты, ещё не отправленные ни одним дайджестом (orders.group_notified_at).
+--force — отправить новые оплаты сейчас, без проверки слотов; следующий слот их не повторит.
+--since-hours N — отчёт за последние N часов (без N — GROUP_DIGEST_SINCE_HOURS или 12): только
+  чтение, оплаты не отмечаются; читается снимок REPORTING_REPLICA_PATH, если настроен.
 
-Требуется в .env: TELEGRAM_BOT_TOKEN, TELEGRAM_GROUP_NOTIFY_CHAT_ID, PAYMENTS_DB_PATH;
+Требуется в .env: TELEGRAM_BOT_TOKEN, TELEGRAM_GROUP_NOTIFY_CHAT_ID, PAYMENTS_DB_PATH (или PAYMENTS_DB_URL);
 для scheduled — хотя бы один из GROUP_DIGEST_TIME_1, GROUP_DIGEST_TIME_2, GROUP_DIGEST_TIME_3.
 """
 from __future__ import annotations
@@ -24,10 +28,6 @@ from __future__ import annotations
 import argparse
 import os
 import sys
-import urllib.parse
-from datetime import datetime, timezone
-from urllib.request import Request, urlopen
-from zoneinfo import ZoneInfo
 
 # родительская папка в пути, чтобы подтянуть robokassa_integration
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -36,77 +36,49 @@ from dotenv import load_dotenv
 
 load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"))
 
-from robokassa_integration import PaymentsDB, _parse_notify_chat_id
-
-MSK = ZoneInfo("Europe/Moscow")
-
-
-def format_digest(rows: list[dict]) -> str:
-    """Форматирует список заказов в текстовую таблицу. Даты в МСК."""
-    if not rows:
-        return "За выбранный период оплат по групповым нет."
-    lines = ["Дата и время (МСК) | user_id | chat_id | Тариф | Сумма"]
-    for r in rows:
-        paid_at = r.get("paid_at")
-        if paid_at:
-            dt = datetime.fromtimestamp(paid_at, tz=timezone.utc).astimezone(MSK)
-            time_str = dt.strftime("%d.%m.%Y %H:%M")
-        else:
-            time_str = "—"
-        user_id = r.get("user_id") or "—"
-        chat_id = r.get("chat_id") or "—"
-        product = (r.get("product_code") or "").replace("group_", "").capitalize()
-        if product == "Standard":
-            product = "Стандарт"
-        elif product == "Vip":
-            product = "VIP"
-        amount = r.get("amount") or "—"
-        lines.append(f"{time_str} | {user_id} | {chat_id} | {product} | {amount} ₽")
-    return "\n".join(lines)
+from group_digest import (
+    DEFAULT_CATCHUP_HOURS,
+    DEFAULT_SINCE_HOURS,
+    _env_float,
+    digest_sender,
+    digest_slots,
+    digest_text,
+    run_due_digest,
+    send_new_orders,
+)
+from payments_store import payments_db
+from reporting_replica import reporting_db
+from robokassa_integration import _parse_notify_chat_id
 
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Дайджест оплат по групповым занятиям в Telegram")
-    parser.add_argument(
+    manual = parser.add_mutually_exclusive_group()
+    manual.add_argument(
         "--since-hours",
         type=float,
+        nargs="?",
+        const=-1.0,
         default=None,
-        help="За сколько часов от текущего момента выбирать оплаты (по UTC). По умолчанию — из GROUP_DIGEST_SINCE_HOURS или 12.",
+        help="Отчёт за последние N часов без отметки оплат. Без N — из GROUP_DIGEST_SINCE_HOURS или 12.",
     )
+    manual.add_argument("--force", action="store_true", help="отправить новые оплаты сейчас, без проверки слотов GROUP_DIGEST_TIME_*")
     args = parser.parse_args()
+    on_demand = args.force or args.since_hours is not None
 
     mode = (os.getenv("GROUP_DIGEST_MODE") or "scheduled").strip().lower()
-    if mode == "immediate":
+    if mode == "immediate" and not on_demand:
         print("Режим GROUP_DIGEST_MODE=immediate: уведомления отправляются при каждой оплате, скрипт не нужен.", file=sys.stderr)
         sys.exit(0)
 
-    # Режим scheduled: только если текущее время (МСК) совпадает с одним из заданных слотов
-    time1 = (os.getenv("GROUP_DIGEST_TIME_1") or "").strip()
-    time2 = (os.getenv("GROUP_DIGEST_TIME_2") or "").strip()
-    time3 = (os.getenv("GROUP_DIGEST_TIME_3") or "").strip()
-    scheduled_times = [t for t in (time1, time2, time3) if t]
-    # Нормализуем HH:MM (допускаем H:MM; секунды отбрасываем)
-    def norm(s: str) -> str:
-        s = s.strip()
-        parts = s.split(":")
-        if len(parts) >= 2 and parts[0].strip().isdigit() and parts[1].strip().isdigit():
-            return f"{int(parts[0]):02d}:{int(parts[1]):02d}"
-        return s
-    scheduled_times = [norm(t) for t in scheduled_times]
-    if not scheduled_times:
+    slots = digest_slots()
+    if not slots and not on_demand:
         print("Режим scheduled: не задано ни одного времени (GROUP_DIGEST_TIME_1/2/3). Выход.", file=sys.stderr)
         sys.exit(0)
-    now_msk = datetime.now(MSK)
-    current_slot = now_msk.strftime("%H:%M")
-    if current_slot not in scheduled_times:
-        sys.exit(0)
 
     since_hours = args.since_hours
-    if since_hours is None:
-        try:
-            since_hours = float((os.getenv("GROUP_DIGEST_SINCE_HOURS") or "12").strip())
-        except ValueError:
-            since_hours = 12.0
+    if since_hours is not None and since_hours < 0:
+        since_hours = _env_float("GROUP_DIGEST_SINCE_HOURS", DEFAULT_SINCE_HOURS)
 
     token = (os.getenv("TELEGRAM_BOT_TOKEN") or "").strip()
     chat_id_str = (os.getenv("TELEGRAM_GROUP_NOTIFY_CHAT_ID") or "").strip()
@@ -121,29 +93,28 @@ def main() -> None:
         print("Ошибка: TELEGRAM_GROUP_NOTIFY_CHAT_ID задан некорректно (ожидается число или @username).", file=sys.stderr)
         sys.exit(1)
 
-    db = PaymentsDB.from_env()
-    since_ts = int(datetime.now(timezone.utc).timestamp() - since_hours * 3600)
-    rows = db.get_group_orders_paid_since(since_ts)
-
-    now_msk_str = datetime.now(MSK).strftime("%d.%m.%Y %H:%M")
-    title = f"Групповые занятия: оплаты за последние {int(since_hours)} ч (на {now_msk_str} МСК)"
-    body = format_digest(rows)
-    text = f"{title}\n\n<pre>{body}</pre>"
-
+    send = digest_sender(token, chat_id)
     try:
-        url = f"https://api.telegram.org/bot{token}/sendMessage"
-        payload = urllib.parse.urlencode(
-            {
-                "chat_id": str(chat_id),
-                "text": text,
-                "parse_mode": "HTML",
-            }
-        ).encode("utf-8")
-        req = Request(url, data=payload, method="POST")
-        req.add_header("Content-Type", "application/x-www-form-urlencoded")
-        with urlopen(req, timeout=15) as resp:
-            resp.read()
-        print(f"Отправлено: {len(rows)} записей в chat_id={chat_id}")
+        if since_hours is not None:
+            # Снимок базы (REPORTING_REPLICA_PATH), если настроен: выборка не держит WAL рабочей базы.
+            text, count = digest_text(reporting_db(), since_hours=since_hours)
+            send(text)
+        elif args.force:
+            count = send_new_orders(payments_db(), send)
+            if count is None:
+                print("Новые оплаты сейчас отправляет другой процесс (сервер или cron).")
+                return
+        else:
+            count = run_due_digest(
+                payments_db(),
+                send,
+                slots=slots,
+                catchup_sec=_env_float("GROUP_DIGEST_CATCHUP_HOURS", DEFAULT_CATCHUP_HOURS) * 3600,
+            )
+            if count is None:
+                print("Слот уже отправлен или ещё не наступил.")
+                return
+        print(f"Отправлено: {count} записей в chat_id={chat_id}")
     except Exception as e:
         print(f"Ошибка отправки в Telegram: {e}", file=sys.stderr)
         sys.exit(1)
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+Инкрементальный рендер потокового ответа модели для Telegram.
+
+StreamRenderer получает фрагменты (delta) по мере стрима и за один проход по каждому
+фрагменту поддерживает готовый к показу текст: служебные теги [...] скрываются (в том числе
+ещё не закрытые), текст после последнего [STEP:...] придерживается (как в _parse_step_from_reply),
+повторные пробелы схлопываются. Работа на ответ — O(длина ответа), а не O(длина²), как при
+повторном разборе всего накопленного текста на каждом фрагменте.
+
+Условия остановки (StopCondition) проверяются после каждого фрагмента по состоянию рендера;
+первое сработавшее закрывает стрим DeepSeek — не платим за токены, которые всё равно не покажем.
+"""
+from __future__ import annotations
+
+import re
+from abc import ABC, abstractmethod
+from typing import Optional
+
+# Лимит текста сообщения при стриме (финальный текст обрезается отдельно, до 4096).
+STREAM_DISPLAY_LIMIT = 4090
+
+_STEP_TAG_BODY = re.compile(r"STEP:\s*([\w:]+)\s*$", re.IGNORECASE)
+_BUTTONS_TAG_BODY = re.compile(r"BUTTONS:", re.IGNORECASE)
+_SENTENCE_END = frozenset(".!?…")
+_MULTI_SPACE = re.compile(r"  +")
+# Сколько последних сырых символов держать для детектора повторов.
+RAW_TAIL_CHARS = 800
+# Содержимое незакрытого тега длиннее этого — не тег, а текст с «[»; дальше не копим.
+_MAX_TAG_LEN = 512
+
+
+class StreamRenderer:
+    """
+    feed(delta) — добавить фрагмент; dirty — видимый текст изменился с последнего display();
+    display() — текущий текст для edit_text (и сброс dirty); step_id — последний увиденный [STEP:...].
+    """
+
+    def __init__(self, limit: int = STREAM_DISPLAY_LIMIT):
+        self.limit = limit
+        self.step_id: Optional[str] = None
+        self.dirty = False
+        self.truncated = False
+        self.raw_len = 0
+        # [BUTTONS: ...] закрыт после [STEP:custom] — ответ с кнопками завершён.
+        self.buttons_closed = False
+        self._raw_tail = ""
+        self._parts: list[str] = []
+        self._len = 0
+        self._pending_ws = ""
+        self._in_tag = False
+        self._tag: list[str] = []
+        self._tag_len = 0
+        # Текст после последнего не-custom [STEP:...]: покажем, только если за ним будет ещё один STEP.
+        self._holding = False
+        self._held: list[str] = []
+
+    # ---------- вход ----------
+
+    def feed(self, delta: str) -> bool:
+        """Добавляет фрагмент стрима. Возвращает True, если видимый текст изменился."""
+        if not delta:
+            return False
+        self.raw_len += len(delta)
+        self._raw_tail = (self._raw_tail + delta)[-RAW_TAIL_CHARS:]
+        before = self._len
+        i, n = 0, len(delta)
+        while i < n:
+            if self._in_tag:
+                j = delta.find("]", i)
+                if j == -1:
+                    self._tag_append(delta[i:])
+                    break
+                self._tag_append(delta[i:j])
+                i = j + 1
+                self._close_tag()
+            else:
+                j = delta.find("[", i)
+                if j == -1:
+                    self._visible(delta[i:])
+                    break
+                self._visible(delta[i:j])
+                self._in_tag = True
+                self._tag = []
+                self._tag_len = 0
+                i = j + 1
+        changed = self._len != before
+        if changed:
+            self.dirty = True
+        return changed
+
+    def _tag_append(self, s: str) -> None:
+        if self._tag_len + len(s) > _MAX_TAG_LEN:
+            # Не похоже на служебный тег — возвращаем «[» и накопленное в видимый текст.
+            text = "[" + "".join(self._tag) + s
+            self._in_tag = False
+            self._tag = []
+            self._tag_len = 0
+            self._visible(text)
+            return
+        self._tag.append(s)
+        self._tag_len += len(s)
+
+    def _close_tag(self) -> None:
+        body = "".join(self._tag).strip()
+        self._in_tag = False
+        self._tag = []
+        self._tag_len = 0
+        m = _STEP_TAG_BODY.match(body)
+        if not m:
+            # [BUTTONS: ...] и любые другие [...] при стриме не показываем.
+            if self.step_id == "custom" and _BUTTONS_TAG_BODY.match(body):
+                self.buttons_closed = True
+            return
+        self.step_id = m.group(1).lower()
+        if self._holding and self._held:
+            held, self._held = "".join(self._held), []
+            self._holding = False
+            self._emit(held)
+        # Для [STEP:custom] хвост (кнопки) остаётся в тексте — как в _parse_step_from_reply.
+        self._holding = self.step_id != "custom"
+
+    def _visible(self, s: str) -> None:
+        if not s:
+            return
+        if self._holding:
+            self._held.append(s)
+        else:
+            self._emit(s)
+
+    def _emit(self, s: str) -> None:
+        if self.truncated:
+            return
+        core = s.strip()
+        if not core:
+            self._pending_ws += s
+            return
+        start = s.index(core[0])
+        ws = self._pending_ws + s[:start]
+        self._pending_ws = s[start + len(core):]
+        if "  " in core:
+            core = _MULTI_SPACE.sub(" ", core)
+        if self._len and ws:
+            ws = _MULTI_SPACE.sub(" ", ws)
+            self._parts.append(ws)
+            self._len += len(ws)
+        room = self.limit - self._len
+        if len(core) > room:
+            if room > 0:
+                self._parts.append(core[:room])
+                self._len += room
+            self.truncated = True
+            return
+        self._parts.append(core)
+        self._len += len(core)
+
+    # ---------- выход ----------
+
+    @property
+    def visible_len(self) -> int:
+        return self._len
+
+    @property
+    def in_tag(self) -> bool:
+        return self._in_tag
+
+    @property
+    def raw_tail(self) -> str:
+        """Последние RAW_TAIL_CHARS символов сырого ответа (с тегами)."""
+        return self._raw_tail
+
+    @property
+    def at_sentence_end(self) -> bool:
+        """Видимый текст сейчас заканчивается концом предложения (. ! ? …)."""
+        if self._in_tag or not self._parts:
+            return False
+        last = self._parts[-1]
+        return bool(last) and last[-1] in _SENTENCE_END
+
+    def text(self) -> str:
+        """Видимый текст без «…»-заглушки (пусто, если ещё ничего не показано)."""
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        out = self._parts[0] if self._parts else ""
+        return out + "..." if self.truncated else out
+
+    def display(self) -> str:
+        """Текст для edit_text; сбрасывает dirty."""
+        self.dirty = False
+        return self.text() or "…"
+
+
+# ---------- Условия остановки стрима ----------
+
+
+class StopCondition(ABC):
+    """Базовый класс: check(renderer) -> True, если стрим пора закрыть; reason попадает в timings."""
+
+    reason = "stop"
+
+    @abstractmethod
+    def check(self, renderer: StreamRenderer) -> bool: ...
+
+
+class TerminalStepStop(StopCondition):
+    """Закрыт финальный тег: [STEP:step_id] (кроме custom) или [BUTTONS: ...] после [STEP:custom]."""
+
+    reason = "terminal_step"
+
+    def check(self, renderer: StreamRenderer) -> bool:
+        if renderer.in_tag or not renderer.step_id:
+            return False
+        if renderer.step_id == "custom":
+            return renderer.buttons_closed
+        return True
+
+
+class CharBudgetStop(StopCondition):
+    """Видимый текст превысил бюджет символов — обрываем на ближайшей границе предложения."""
+
+    reason = "char_budget"
+
+    def __init__(self, budget: int):
+        self.budget = budget
+
+    def check(self, renderer: StreamRenderer) -> bool:
+        return self.budget > 0 and renderer.visible_len > self.budget and renderer.at_sentence_end
+
+
+class RepetitionStop(StopCondition):
+    """
+    Вырожденный повтор: хвост ответа — один и тот же фрагмент длиной min_period..max_period,
+    повторённый repeats раз подряд. Проверяем не чаще, чем раз в check_every новых символов.
+    """
+
+    reason = "repetition"
+
+    def __init__(self, min_period: int = 12, max_period: int = 200, repeats: int = 3, check_every: int = 32):
+        self.min_period = min_period
+        self.max_period = max_period
+        self.repeats = repeats
+        self.check_every = check_every
+        self._checked_at = 0
+
+    def check(self, renderer: StreamRenderer) -> bool:
+        if renderer.raw_len - self._checked_at < self.check_every:
+            return False
+        self._checked_at = renderer.raw_len
+        tail = renderer.raw_tail
+        max_period = min(self.max_period, len(tail) // self.repeats)
+        for p in range(self.min_period, max_period + 1):
+            unit = tail[-p:]
+            if not unit.strip():
+                continue
+            if all(tail[-(k + 1) * p: -k * p] == unit for k in range(1, self.repeats)):
+                return True
+        return False
+
+
+def default_stop_conditions(char_budget: int) -> list[StopCondition]:
+    """Набор условий для ответа психолога: финальный тег, бюджет символов, повторы."""
+    return [TerminalStepStop(), CharBudgetStop(char_budget), RepetitionStop()]
+
+
+def first_fired(conditions: list[StopCondition], renderer: StreamRenderer) -> Optional[str]:
+    """reason первого сработавшего условия или None."""
+    for cond in conditions:
+        if cond.check(renderer):
+            return cond.reason
+    return None
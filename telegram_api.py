@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Клиент Telegram Bot API для отправок вне python-telegram-bot: уведомления об оплате (outbox),
+дайджест по групповым, рассылки.
+
+Раньше каждое сообщение открывало новое TLS-соединение (urllib.request.urlopen). Здесь:
+- TelegramBotAPI — async-клиент на httpx.AsyncClient с пулом keep-alive соединений к api.telegram.org
+  (HTTP/2, если установлен пакет h2); ответ 429 (RetryAfter) — пауза retry_after и повтор.
+- bot_api(token) — общий на процесс клиент для текущего цикла событий.
+- SyncTelegramBotAPI / sync_bot_api(token) — синхронная обёртка для cron, Cloud Functions и потоков:
+  свой цикл событий в фоновом потоке, пул соединений живёт между вызовами.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+from typing import Any, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+API_BASE_URL = "https://api.telegram.org"
+DEFAULT_TIMEOUT = 15.0
+# Сколько раз повторять запрос после 429 и какую паузу из retry_after готовы ждать.
+DEFAULT_MAX_RETRIES = 3
+MAX_RETRY_AFTER_SEC = 60.0
+
+try:
+    import h2  # noqa: F401
+
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+
+class TelegramAPIError(Exception):
+    """Ответ Bot API с ok=false. error_code — HTTP-код Telegram (400, 403, 429...), retry_after — для 429."""
+
+    def __init__(self, method: str, error_code: int, description: str, retry_after: Optional[float] = None):
+        super().__init__(f"{method}: {error_code} {description}")
+        self.method = method
+        self.error_code = error_code
+        self.description = description
+        self.retry_after = retry_after
+
+
+class TelegramBotAPI:
+    """
+    Async-клиент Bot API одного бота. Соединения переиспользуются, пока клиент не закрыт (aclose).
+    max_connections — предел одновременных соединений (и запросов) к api.telegram.org.
+    """
+
+    def __init__(
+        self,
+        bot_token: str,
+        *,
+        timeout: float = DEFAULT_TIMEOUT,
+        max_connections: int = 8,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        base_url: str = API_BASE_URL,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.max_retries = max_retries
+        self.counters = {"requests": 0, "retry_after": 0, "errors": 0}
+        self._client = httpx.AsyncClient(
+            base_url=f"{base_url}/bot{bot_token}/",
+            timeout=timeout,
+            http2=_HTTP2 and transport is None,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            transport=transport,
+        )
+
+    async def call(self, method: str, **params: Any) -> Any:
+        """Вызов метода Bot API; возвращает result или бросает TelegramAPIError / httpx.HTTPError."""
+        payload = {k: v for k, v in params.items() if v is not None}
+        attempt = 0
+        while True:
+            self.counters["requests"] += 1
+            resp = await self._client.post(method, json=payload)
+            try:
+                data = resp.json()
+            except ValueError:
+                self.counters["errors"] += 1
+                resp.raise_for_status()
+                raise TelegramAPIError(method, resp.status_code, "ответ не JSON")
+            if data.get("ok"):
+                return data.get("result")
+            retry_after = (data.get("parameters") or {}).get("retry_after")
+            error = TelegramAPIError(
+                method, int(data.get("error_code") or resp.status_code), str(data.get("description") or ""), retry_after
+            )
+            if error.error_code == 429 and retry_after is not None and attempt < self.max_retries:
+                attempt += 1
+                self.counters["retry_after"] += 1
+                delay = min(float(retry_after), MAX_RETRY_AFTER_SEC)
+                logger.warning("Telegram %s: 429, повтор через %.0f с (попытка %s)", method, delay, attempt)
+                await asyncio.sleep(delay)
+                continue
+            self.counters["errors"] += 1
+            raise error
+
+    async def send_message(
+        self,
+        chat_id: int | str,
+        text: str,
+        *,
+        parse_mode: Optional[str] = None,
+        disable_web_page_preview: bool = False,
+    ) -> dict[str, Any]:
+        return await self.call(
+            "sendMessage",
+            chat_id=chat_id,
+            text=text,
+            parse_mode=parse_mode,
+            disable_web_page_preview=disable_web_page_preview,
+        )
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+
+# Общие клиенты по токену; httpx.AsyncClient привязан к циклу событий, поэтому при новом цикле — новый клиент.
+_shared: dict[str, tuple[asyncio.AbstractEventLoop, TelegramBotAPI]] = {}
+
+
+def bot_api(bot_token: str) -> TelegramBotAPI:
+    """Общий async-клиент для bot_token в текущем цикле событий."""
+    loop = asyncio.get_running_loop()
+    entry = _shared.get(bot_token)
+    if entry is None or entry[0] is not loop or entry[0].is_closed():
+        entry = _shared[bot_token] = (loop, TelegramBotAPI(bot_token))
+    return entry[1]
+
+
+class SyncTelegramBotAPI:
+    """
+    Синхронная обёртка над TelegramBotAPI. Запросы выполняются в собственном цикле событий в фоновом
+    потоке, поэтому методы можно вызывать из любого потока (в том числе при уже запущенном цикле),
+    а соединения переиспользуются между вызовами.
+    """
+
+    def __init__(self, bot_token: str, **client_kwargs: Any):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="telegram-api", daemon=True)
+        self._thread.start()
+        self._api = self._run(self._make_client(bot_token, client_kwargs))
+
+    @staticmethod
+    async def _make_client(bot_token: str, client_kwargs: dict[str, Any]) -> TelegramBotAPI:
+        return TelegramBotAPI(bot_token, **client_kwargs)
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    @property
+    def counters(self) -> dict[str, int]:
+        return self._api.counters
+
+    def call(self, method: str, **params: Any) -> Any:
+        return self._run(self._api.call(method, **params))
+
+    def send_message(
+        self,
+        chat_id: int | str,
+        text: str,
+        *,
+        parse_mode: Optional[str] = None,
+        disable_web_page_preview: bool = False,
+    ) -> dict[str, Any]:
+        return self._run(
+            self._api.send_message(
+                chat_id, text, parse_mode=parse_mode, disable_web_page_preview=disable_web_page_preview
+            )
+        )
+
+    def close(self) -> None:
+        if self._loop.is_closed():
+            return
+        self._run(self._api.aclose())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+_shared_sync: dict[str, SyncTelegramBotAPI] = {}
+_shared_sync_lock = threading.Lock()
+
+
+def sync_bot_api(bot_token: str) -> SyncTelegramBotAPI:
+    """Общий на процесс синхронный клиент для bot_token."""
+    with _shared_sync_lock:
+        api = _shared_sync.get(bot_token)
+        if api is None:
+            api = _shared_sync[bot_token] = SyncTelegramBotAPI(bot_token)
+        return api
@@ -94,8 +94,1443 @@ def test_7_load_prompt_file():
     return True
 
 
+def test_8_prompt_compiler_stages():
+    """Промпт по этапам: ядро всегда, секции этапа — только для нужного шага, размер меньше полного."""
+    import bot
+    from prompt_compiler import PromptCompiler, estimate_tokens
+    c = PromptCompiler(bot.SYSTEM_PROMPT)
+    assert {'first_message', 'contact', 'diagnosis', 'navigation', 'products_info', 'anket'} <= c.section_keys
+    start = c.compile(None)
+    pay = c.compile('pay_choice:webinar')
+    for text in (start, pay):
+        assert 'Владима Энхель' in text and 'ОДИН ВОПРОС' in text and '#ЗАПРЕТЫ' in text
+        assert estimate_tokens(text) < c.full_tokens
+    assert '##ПЕРВОЕ СООБЩЕНИЕ' in start and '#ИНФО ОБ УСЛУГАХ' not in start
+    assert '#ИНФО ОБ УСЛУГАХ' in pay and '##БАЗОВЫЙ КОНТАКТ' not in pay
+    assert '"$schema"' not in pay and '"$schema"' in c.compile('pay_choice', include_anket=True)
+    assert [k for k, _, _ in c.report()][0] == 'core'
+    return True
+
+
+def test_9_prompt_routing_follows_last_step():
+    """get_history_messages берёт секции по последнему step_id; custom этап не меняет; сброс — к началу."""
+    import bot
+    uid = -901
+    bot.clear_history(uid)
+    bot.add_to_history(uid, 'user', 'Начать')
+    assert bot.get_history_messages(uid)[0]['content'] == bot.PROMPT_COMPILER.compile(None)
+    bot._remember_step(uid, 'products')
+    bot._remember_step(uid, 'custom')
+    assert bot.get_history_messages(uid)[0]['content'] == bot.PROMPT_COMPILER.compile('products')
+    bot.clear_history(uid)
+    assert bot.user_history.stage(uid) is None
+    return True
+
+
+def test_10_history_token_budget_and_summary():
+    """История: бюджет по токенам, вытесненные реплики сжимаются в сводку в фоне, сброс отменяет сводку."""
+    import asyncio
+    from conversation import ConversationHistory
+    from prompt_compiler import estimate_tokens
+
+    calls = []
+
+    async def summarizer(prev, turns):
+        calls.append((prev, [t['content'] for t in turns]))
+        return (prev + ' ' if prev else '') + '/'.join(t['content'][:5] for t in turns)
+
+    async def scenario():
+        h = ConversationHistory(60, summarizer=summarizer)
+        long_text = 'Очень длинный рассказ о моём состоянии ' * 10
+        h.add(1, 'user', 'Анна')
+        h.add(1, 'assistant', 'Приятно познакомиться')
+        h.add(1, 'user', long_text)
+        assert h.token_count(1) <= max(60, estimate_tokens(long_text) + estimate_tokens('Приятно познакомиться'))
+        # Пока сводка считается, вытесненное отдаётся как есть
+        assert h.messages(1)[0]['content'] == 'Анна'
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        msgs = h.messages(1)
+        assert msgs[0]['role'] == 'system' and 'Анна' in msgs[0]['content']
+        assert [m['content'] for m in msgs[1:]][-1] == long_text
+        for _ in range(20):
+            h.add(1, 'user', '1')
+        assert h.token_count(1) <= 60
+        h.add(2, 'user', long_text)
+        h.add(2, 'user', long_text)
+        h.add(2, 'user', 'ok')
+        h.clear(2)
+        await asyncio.sleep(0)
+        assert h.messages(2) == [] and not h.has_history(2)
+
+    asyncio.run(scenario())
+    assert calls and calls[0][0] == ''
+    return True
+
+
+def test_11_stream_renderer_matches_parse():
+    """Инкрементальный рендер стрима: теги скрыты (и незакрытые), хвост после STEP придерживается, dirty только при изменении."""
+    import re
+    import bot
+    from streaming import StreamRenderer
+
+    def render(text, size):
+        r = StreamRenderer()
+        for i in range(0, len(text), size):
+            r.feed(text[i:i + size])
+        return r
+
+    cases = [
+        'Привет. Я Владима Энхель. Готовы?  [STEP:start_diagnosis]',
+        'Выбери вариант [STEP:custom] [BUTTONS: Коротко | Долго]',
+        'Текст [STEP:form_address] середина [STEP:messenger] хвост',
+        'Без тегов,   просто   текст ',
+    ]
+    for text in cases:
+        expected, step = bot._parse_step_from_reply(text)
+        expected = bot._strip_step_tags_for_display(expected)
+        expected = re.sub(r"\[[^\]]*\]", "", expected)
+        expected = re.sub(r"\s+", " ", expected).strip()
+        for size in (1, 3, 7, len(text)):
+            r = render(text, size)
+            assert r.text() == expected, (text, size, r.text())
+            assert r.step_id == step
+    r = StreamRenderer()
+    assert r.feed('Ответ ') and r.dirty
+    assert r.display() == 'Ответ' and not r.dirty
+    assert not r.feed('[STEP:pay_ch')
+    assert r.in_tag and r.display() == 'Ответ'
+    assert not r.feed('oice:webinar]\n')
+    assert r.step_id == 'pay_choice:webinar' and not r.dirty
+    long = render('а' * 5000, 50)
+    assert long.truncated and len(long.display()) == 4093
+    return True
+
+
+def test_12_edit_scheduler_coalescing_and_retry_after():
+    """Планировщик правок: latest-wins, интервал на чат, RetryAfter переотправляет последнюю версию, finalize отбрасывает ожидающую."""
+    import asyncio
+    from telegram.error import RetryAfter
+    from edit_scheduler import EditScheduler
+
+    class FakeMessage:
+        def __init__(self, chat_id, message_id, flood_once=False):
+            self.chat_id, self.message_id = chat_id, message_id
+            self.sent = []
+            self.flood_once = flood_once
+
+        async def edit_text(self, text, **kwargs):
+            if self.flood_once:
+                self.flood_once = False
+                raise RetryAfter(0)
+            self.sent.append(text)
+
+    async def scenario():
+        sched = EditScheduler(global_rate=1000, chat_interval=0.05)
+        a = FakeMessage(1, 10)
+        sched.submit(a, 'a1')
+        await asyncio.sleep(0.01)
+        for t in ('a2', 'a3', 'a4'):
+            sched.submit(a, t)
+        await asyncio.sleep(0.1)
+        assert a.sent == ['a1', 'a4'], a.sent
+        assert sched.counters['coalesced'] == 2
+
+        b = FakeMessage(2, 20, flood_once=True)
+        sched.submit(b, lambda: 'b-latest')
+        await asyncio.sleep(0.15)
+        assert b.sent == ['b-latest'] and sched.counters['retry_after'] == 1
+
+        c = FakeMessage(3, 30)
+        sched.submit(c, 'c1')
+        await asyncio.sleep(0.01)
+        sched.submit(c, 'c-stream')
+        assert await sched.finalize(c, 'c-final')
+        assert c.sent == ['c1', 'c-final'] and sched.counters['dropped'] == 1
+        stats = sched.stats()
+        assert stats['final_sent'] == 1 and stats['pending'] == 0
+
+        # Потоковая правка в полёте получает RetryAfter уже после finalize: итог и клавиатура остаются.
+        class InFlight(FakeMessage):
+            async def edit_text(self, text, **kwargs):
+                if text == 'd-stream':
+                    await release.wait()
+                    raise RetryAfter(0)
+                self.sent.append((text, kwargs.get('reply_markup')))
+
+        release = asyncio.Event()
+        d = InFlight(4, 40)
+        sched.submit(d, lambda: 'd-stream')
+        await asyncio.sleep(0.01)
+        final = asyncio.create_task(sched.finalize(d, 'd-final', reply_markup='kb'))
+        await asyncio.sleep(0.01)
+        release.set()
+        assert await final
+        await asyncio.sleep(0.1)
+        sched.submit(d, 'd-late')
+        await asyncio.sleep(0.1)
+        assert d.sent == [('d-final', 'kb')], d.sent
+
+        # Потоковая правка ещё в полёте, когда вызван finalize: итог уходит после неё, а не до.
+        class Slow(FakeMessage):
+            async def edit_text(self, text, **kwargs):
+                if text == 'e-stream':
+                    await release_e.wait()
+                self.sent.append((text, kwargs.get('reply_markup')))
+
+        release_e = asyncio.Event()
+        e = Slow(5, 50)
+        sched.submit(e, 'e-stream')
+        await asyncio.sleep(0.01)
+        final = asyncio.create_task(sched.finalize(e, 'e-final', reply_markup='kb'))
+        await asyncio.sleep(0.15)  # дольше интервала чата: finalize ждёт правку в полёте, а не бюджет
+        assert e.sent == [] and not final.done()
+        release_e.set()
+        assert await final
+        assert e.sent == [('e-stream', None), ('e-final', 'kb')], e.sent
+
+        slow = EditScheduler(global_rate=10, chat_interval=0.01)
+        msgs = [FakeMessage(100 + i, 1) for i in range(20)]
+        for m in msgs:
+            slow.submit(m, 'x')
+        assert slow.stats()['chat_interval_sec'] >= 2.0
+
+    asyncio.run(scenario())
+    return True
+
+
+def test_13_stream_stop_conditions():
+    """Ранняя остановка стрима: финальный STEP, бюджет символов на конце предложения, повторы; стрим закрывается."""
+    import asyncio
+    from types import SimpleNamespace
+    import bot
+    from streaming import CharBudgetStop, RepetitionStop, StreamRenderer, TerminalStepStop, first_fired
+
+    def feed_until(conditions, text, size=5):
+        r = StreamRenderer()
+        for i in range(0, len(text), size):
+            r.feed(text[i:i + size])
+            fired = first_fired(conditions, r)
+            if fired:
+                return fired, i + size
+        return None, len(text)
+
+    fired, _ = feed_until([TerminalStepStop()], 'Готовы начать? [STEP:start_diagnosis] лишний хвост')
+    assert fired == 'terminal_step'
+    fired, at = feed_until([TerminalStepStop()], 'Выбери [STEP:custom] [BUTTONS: Да | Нет] хвост')
+    assert fired == 'terminal_step' and at >= len('Выбери [STEP:custom] [BUTTONS: Да | Нет]')
+    assert feed_until([TerminalStepStop()], 'Без тегов. Просто текст.')[0] is None
+    fired, at = feed_until([CharBudgetStop(20)], 'Первое предложение тут, второе длиннее. Третье.', size=1)
+    assert fired == 'char_budget' and at == len('Первое предложение тут, второе длиннее.')
+    fired, _ = feed_until([RepetitionStop()], 'Начало. ' + 'Я вас слышу и понимаю. ' * 10)
+    assert fired == 'repetition'
+    assert feed_until([RepetitionStop()], 'Обычный ответ без повторов, где каждая фраза своя. ' * 1)[0] is None
+
+    class FakeStream:
+        def __init__(self, text):
+            self.chunks = [text[i:i + 4] for i in range(0, len(text), 4)]
+            self.closed = False
+            self.consumed = 0
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            if self.closed or self.consumed >= len(self.chunks):
+                raise StopAsyncIteration
+            self.consumed += 1
+            delta = SimpleNamespace(content=self.chunks[self.consumed - 1])
+            return SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=None)])
+
+        async def close(self):
+            self.closed = True
+
+    fake = FakeStream('Как к вам обращаться? [STEP:form_address]' + ' лишнее' * 100)
+
+    async def create(**kwargs):
+        assert kwargs['stream'] is True
+        return fake
+
+    saved = bot.client
+    bot.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    try:
+        stats = {}
+        reply = asyncio.run(bot._generate_reply(
+            [], stop_conditions=bot.default_stop_conditions(1000), stats=stats,
+        ))
+    finally:
+        bot.client = saved
+    assert fake.closed and fake.consumed < len(fake.chunks)
+    assert stats['stop_reason'] == 'terminal_step'
+    assert bot._parse_step_from_reply(reply) == ('Как к вам обращаться?', 'form_address')
+    assert bot._stop_conditions_for('SHOW_JSON') is None
+    return True
+
+
+def test_14_sqlite_conversation_store():
+    """История в SQLite: запись отложенная и пачками, LRU горячих диалогов, после «рестарта» история и этап на месте."""
+    import os
+    import tempfile
+    from conversation import ConversationHistory
+    from conversation_store import SQLiteConversationStore
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'conv.sqlite3')
+        store = SQLiteConversationStore(path, flush_interval=60)
+        h = ConversationHistory(0, store=store, max_cached_users=2)
+        for uid in (1, 2, 3):
+            h.add(uid, 'user', f'привет {uid}')
+            h.add(uid, 'assistant', f'ответ {uid}')
+        h.set_stage(1, 'products')
+        # Ничего ещё не записано, но вытесненный из кэша диалог читается из очереди записи.
+        assert store.counters['written'] == 0 and h.cached_users() == 2
+        assert h.messages(1)[0]['content'] == 'привет 1' and h.stage(1) == 'products'
+        assert store.counters['coalesced'] >= 3
+        h.clear(2)
+        h.close()
+        assert store.pending_count() == 0 and store.counters['batches'] == 1
+
+        h2 = ConversationHistory(0, store=SQLiteConversationStore(path), max_cached_users=2)
+        assert [m['content'] for m in h2.messages(1)] == ['привет 1', 'ответ 1']
+        assert h2.stage(1) == 'products' and h2.token_count(1) > 0
+        assert not h2.has_history(2) and h2.last(3)['content'] == 'ответ 3'
+        h2.close()
+
+        # Пачка в записи (до COMMIT) читается из памяти; неудачная запись возвращает её в очередь.
+        import sqlite3
+        store = SQLiteConversationStore(path, flush_interval=60)
+        store.save(7, {'v': 1})
+        seen = []
+
+        class FailingConn:
+            in_transaction = False
+
+            def execute(self, sql, *args):
+                seen.append(store.load(7))
+                raise sqlite3.OperationalError('database is locked')
+
+        real_conn, store._conn = store._conn, lambda: FailingConn()
+        store.flush()
+        store._conn = real_conn
+        assert seen == [{'v': 1}] and store.load(7) == {'v': 1} and store.pending_count() == 1
+        store.close()
+        reopened = SQLiteConversationStore(path)
+        assert reopened.load(7) == {'v': 1}
+        reopened.close()
+    return True
+
+
+def test_15_tiered_history_idle_compaction():
+    """Простаивающие диалоги без хранилища сжимаются в памяти и разворачиваются при обращении; LRU ограничивает горячие."""
+    from conversation import ConversationHistory
+
+    h = ConversationHistory(0, max_cached_users=3, idle_after=60)
+    for uid in range(5):
+        h.add(uid, 'user', f'привет {uid}')
+        h.add(uid, 'assistant', f'ответ {uid}')
+    h.set_stage(4, 'products')
+    stats = h.memory_stats()
+    assert stats['hot_users'] == 3 and stats['cold_users'] == 2 and stats['cold_bytes'] > 0
+    # Холодный диалог разворачивается целиком, с этапом и токенами.
+    assert [m['content'] for m in h.messages(0)] == ['привет 0', 'ответ 0']
+    assert h.token_count(0) > 0 and h.memory_stats()['cold_users'] == 2
+    import time
+    assert h.compact_idle(time.monotonic() + 61) == 3
+    assert h.cached_users() == 0 and h.memory_stats()['cold_users'] == 5
+    assert h.stage(4) == 'products' and h.last(4)['content'] == 'ответ 4'
+    h.clear(1)
+    assert not h.has_history(1) and h.memory_stats()['cold_users'] == 3
+    return True
+
+
+def test_16_user_dispatcher_orders_per_user():
+    """Очередь по пользователю: один пользователь — строго по порядку, разные — параллельно; отмена ожидания не ломает очередь."""
+    import asyncio
+    from user_dispatch import UserDispatcher
+
+    async def scenario():
+        d = UserDispatcher()
+        log = []
+        running = {'now': 0, 'max': 0}
+
+        async def handler(uid, n, delay):
+            running['now'] += 1
+            running['max'] = max(running['max'], running['now'])
+            log.append((uid, n, 'start'))
+            await asyncio.sleep(delay)
+            log.append((uid, n, 'end'))
+            running['now'] -= 1
+
+        tasks = [asyncio.create_task(d.run(1, handler, 1, n, 0.02 if n == 0 else 0.001)) for n in range(3)]
+        tasks.append(asyncio.create_task(d.run(2, handler, 2, 0, 0.001)))
+        waiting = asyncio.create_task(d.run(1, handler, 1, 99, 0))
+        await asyncio.sleep(0.005)
+        assert d.pending(1) == 4 and d.pending(2) == 0
+        waiting.cancel()
+        await asyncio.gather(*tasks)
+        assert [e for e in log if e[0] == 1] == [(1, n, k) for n in range(3) for k in ('start', 'end')]
+        # Пользователь 2 не ждал, пока закончится долгий обработчик пользователя 1.
+        assert log.index((2, 0, 'end')) < log.index((1, 0, 'end')) and running['max'] == 2
+        assert d.active_keys() == 0 and d.counters['cancelled'] == 1
+        return True
+
+    assert asyncio.run(scenario())
+    return True
+
+
+def test_17_reply_debouncer_merges_bursts():
+    """Склейка сообщений подряд: одна реплика на серию, незафиксированный ответ вытесняется, зафиксированный — нет."""
+    import asyncio
+    from reply_debounce import ReplyDebouncer
+
+    async def scenario():
+        d = ReplyDebouncer(0.02)
+        replies, started = [], []
+
+        async def reply(text):
+            started.append(text)
+            await asyncio.sleep(0.05)
+            if text.startswith('commit'):
+                d.commit(1)
+                await asyncio.sleep(0.05)
+            replies.append(text)
+
+        # Серия из трёх сообщений (голосовое с меньшим message_id распознано позже) — один ответ.
+        results = await asyncio.gather(
+            d.submit(1, 'a', reply, order=1),
+            d.submit(1, 'c', reply, order=3),
+            d.submit(1, 'b', reply, order=2),
+        )
+        assert results.count(True) == 1 and replies == ['a\nb\nc']
+
+        # Новое сообщение во время генерации: старый ответ отменён, тексты склеены.
+        first = asyncio.create_task(d.submit(1, 'x', reply))
+        await asyncio.sleep(0.04)
+        assert started[-1] == 'x'
+        assert await d.submit(1, 'y', reply) and not await first
+        assert replies[-1] == 'x\ny' and d.counters['superseded'] == 1
+
+        # Ответ уже зафиксирован (commit) — не вытесняется, новое сообщение отвечается отдельно.
+        first = asyncio.create_task(d.submit(1, 'commit', reply))
+        await asyncio.sleep(0.1)
+        assert await d.submit(1, 'z', reply) and await first
+        assert replies[-2:] == ['commit', 'z'] and not d.busy(1)
+        return True
+
+    assert asyncio.run(scenario())
+    return True
+
+
+def test_18_payments_db_shared_and_migrated():
+    """PaymentsDB: общий экземпляр на путь, миграция по PRAGMA user_version один раз, соединение на поток."""
+    import os
+    import tempfile
+    import threading
+    from robokassa_integration import SCHEMA_VERSION, PaymentsDB
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'payments.sqlite3')
+        db = PaymentsDB.shared(path)
+        assert PaymentsDB.shared(path) is db and db.schema_version() == SCHEMA_VERSION
+        assert db._conn() is db._conn()
+        other = []
+        t = threading.Thread(target=lambda: other.append(db._conn()))
+        t.start()
+        t.join()
+        assert other[0] is not db._conn()
+
+        inv_id, token = db.create_order(user_id=1, chat_id=2, product_code='webinar', amount='2990.00', description='x')
+        assert db.get_order(inv_id)['order_token'] == token
+        assert db.mark_paid_if_pending(inv_id, raw_params={}) and not db.mark_paid_if_pending(inv_id, raw_params={})
+        # Повторное открытие той же базы не пересоздаёт схему и видит данные.
+        reopened = PaymentsDB(path)
+        assert reopened.schema_version() == SCHEMA_VERSION and reopened.get_order(inv_id)['status'] == 'paid'
+        reopened.close()
+        db.close()
+        PaymentsDB._shared.pop(path, None)
+    return True
+
+
+def test_19_async_payments_db_offloads_queries():
+    """AsyncPaymentsDB: запросы идут в пуле потоков (цикл событий не блокируется), медленные считаются."""
+    import asyncio
+    import os
+    import tempfile
+    import threading
+    import time
+    from payments_async import AsyncPaymentsDB
+    from robokassa_integration import PaymentsDB
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = PaymentsDB(os.path.join(tmp, 'payments.sqlite3'))
+        threads = set()
+
+        class SlowDB:
+            def get_order(self, inv_id):
+                threads.add(threading.get_ident())
+                time.sleep(0.05)
+                return db.get_order(inv_id)
+
+        async def scenario():
+            adb = AsyncPaymentsDB(lambda: db, max_workers=2, slow_query_ms=40)
+            inv_id, _ = await adb.create_order(user_id=1, chat_id=1, product_code='pro', amount='990.00', description='x')
+            slow = AsyncPaymentsDB(lambda: SlowDB(), max_workers=2, slow_query_ms=40)
+            ticks = 0
+            task = asyncio.gather(*(slow.call('get_order', inv_id) for _ in range(4)))
+            while not task.done():
+                ticks += 1
+                await asyncio.sleep(0.005)
+            orders = await task
+            assert all(o['inv_id'] == inv_id for o in orders)
+            # Пока база «думала», цикл событий продолжал работать; воркеров не больше max_workers.
+            assert ticks > 5 and len(threads) <= 2 and threading.get_ident() not in threads
+            assert slow.counters['slow'] == 4 and adb.counters['queries'] == 1
+            try:
+                adb.no_such_method
+                raise AssertionError('ожидали AttributeError')
+            except AttributeError:
+                pass
+            adb.shutdown()
+            slow.shutdown()
+            return True
+
+        assert asyncio.run(scenario())
+        db.close()
+    return True
+
+
+def test_20_confirm_payment_single_transaction_under_retries():
+    """confirm_payment: дубли ResultURL от Robokassa параллельно — оплачивается ровно один раз, клиент записан."""
+    import os
+    import tempfile
+    import threading
+    from robokassa_integration import PaymentsDB
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = PaymentsDB(os.path.join(tmp, 'payments.sqlite3'))
+        inv_id, token = db.create_order(user_id=7, chat_id=70, product_code='group_vip', amount='45990.00', description='x')
+        assert db.confirm_payment(inv_id + 1, out_sum='45990.00', order_token=token, raw_params={}).error == 'unknown_order'
+        assert db.confirm_payment(inv_id, out_sum='1.00', order_token=token, raw_params={}).error == 'amount_mismatch'
+        assert db.confirm_payment(inv_id, out_sum='45990.00', order_token='bad', raw_params={}).error == 'token_mismatch'
+        assert db.get_order(inv_id)['status'] == 'pending'
+
+        results = []
+        barrier = threading.Barrier(8)
+
+        def retry():
+            barrier.wait()
+            results.append(db.confirm_payment(inv_id, out_sum='45990.00', order_token=token, raw_params={'InvId': inv_id}))
+            db.close()
+
+        threads = [threading.Thread(target=retry) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(results) == 8 and all(r.ok for r in results)
+        assert sum(r.newly_paid for r in results) == 1
+        assert all(r.order['status'] == 'paid' and r.order['paid_at'] for r in results)
+        row = db._conn().execute('SELECT chat_id, product FROM clients WHERE user_id = 7').fetchall()
+        assert row == [(70, 'group_vip')]
+        db.close()
+    return True
+
+
+def test_21_payment_outbox_retries_until_delivered():
+    """Outbox: уведомления об оплате пишутся вместе с paid, доставляются с повтором, 403 — без повторов."""
+    import asyncio
+    import os
+    import tempfile
+    from payment_outbox import OutboxWorker, drain_outbox
+    from robokassa_integration import PaymentsDB
+    from telegram_api import TelegramAPIError
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = PaymentsDB(os.path.join(tmp, 'payments.sqlite3'))
+        inv_id, token = db.create_order(user_id=5, chat_id=50, product_code='webinar', amount='2990.00', description='x')
+        for _ in range(2):
+            assert db.confirm_payment(inv_id, out_sum='2990.00', order_token=token, raw_params={}).ok
+        assert db.outbox_counts() == {'pending': 1}
+
+        sent, failures = [], [ConnectionError('telegram down')]
+
+        def send(chat_id, text, no_preview):
+            if failures:
+                raise failures.pop()
+            sent.append((chat_id, no_preview))
+
+        assert drain_outbox(db, send, backoff_base=60) == {'sent': 0, 'retry': 1, 'failed': 0}
+        # До конца паузы повторный проход уведомление не берёт.
+        assert drain_outbox(db, send) == {'sent': 0, 'retry': 0, 'failed': 0}
+        db._conn().execute('UPDATE outbox SET next_attempt_at = 0')
+        assert drain_outbox(db, send) == {'sent': 1, 'retry': 0, 'failed': 0}
+        assert sent == [(50, True)] and db.outbox_counts() == {'sent': 1}
+        row = db._conn().execute('SELECT attempts, sent_at FROM outbox').fetchone()
+        assert row[0] == 2 and row[1]
+
+        inv2, token2 = db.create_order(user_id=6, chat_id=60, product_code='pro', amount='990.00', description='x')
+        db.confirm_payment(inv2, out_sum='990.00', order_token=token2, raw_params={})
+        failures.append(TelegramAPIError('sendMessage', 403, 'Forbidden: bot was blocked by the user'))
+
+        async def scenario():
+            worker = OutboxWorker(send, db_factory=lambda: db, poll_interval=10)
+            worker.start()
+            for _ in range(200):
+                if worker.counters['failed']:
+                    break
+                await asyncio.sleep(0.01)
+            await worker.stop()
+            return worker.counters
+
+        counters = asyncio.run(scenario())
+        assert counters['failed'] == 1 and db.outbox_counts() == {'sent': 1, 'failed': 1}
+        db.close()
+    return True
+
+
+def test_22_telegram_api_client_pools_and_retries():
+    """telegram_api: один пул соединений на клиент, 429 — пауза retry_after и повтор, ошибки — TelegramAPIError."""
+    import asyncio
+    import json
+    import httpx
+    from telegram_api import SyncTelegramBotAPI, TelegramAPIError, TelegramBotAPI
+
+    calls = []
+
+    def handler(request):
+        body = json.loads(request.content)
+        calls.append((request.url.path, body))
+        if body['chat_id'] == 429 and sum(1 for _, b in calls if b['chat_id'] == 429) == 1:
+            return httpx.Response(429, json={'ok': False, 'error_code': 429, 'description': 'Too Many Requests', 'parameters': {'retry_after': 0}})
+        if body['chat_id'] == 403:
+            return httpx.Response(403, json={'ok': False, 'error_code': 403, 'description': 'Forbidden'})
+        return httpx.Response(200, json={'ok': True, 'result': {'message_id': len(calls)}})
+
+    async def scenario():
+        api = TelegramBotAPI('123:abc', transport=httpx.MockTransport(handler))
+        assert (await api.send_message(1, 'hi', disable_web_page_preview=True))['message_id'] == 1
+        assert (await api.send_message(429, 'again'))['message_id'] == 3
+        try:
+            await api.send_message(403, 'x')
+            raise AssertionError('ожидали TelegramAPIError')
+        except TelegramAPIError as e:
+            assert e.error_code == 403
+        assert api.counters == {'requests': 4, 'retry_after': 1, 'errors': 1}
+        await api.aclose()
+
+    asyncio.run(scenario())
+    assert calls[0] == ('/bot123:abc/sendMessage', {'chat_id': 1, 'text': 'hi', 'disable_web_page_preview': True})
+
+    api = SyncTelegramBotAPI('123:abc', transport=httpx.MockTransport(handler))
+    try:
+        # Синхронная обёртка работает и изнутри запущенного цикла событий.
+        async def inside_loop():
+            return api.send_message(7, 'sync', parse_mode='HTML')
+
+        assert asyncio.run(inside_loop())['message_id'] == len(calls)
+        assert calls[-1][1]['parse_mode'] == 'HTML'
+    finally:
+        api.close()
+    return True
+
+
+def test_23_log_pipeline_background_rotation_redaction():
+    """log_pipeline: запись в фоновом потоке, JSON-события с маскированием секретов, сэмплирование, ротация."""
+    import glob
+    import json
+    import logging
+    import os
+    import tempfile
+    import threading
+    import log_pipeline
+
+    root = logging.getLogger()
+    old_level = root.level
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'app.log')
+        log_pipeline.setup_logging(service='test', level='INFO', log_file=path, max_bytes=2000, backup_count=2, console=False)
+        try:
+            writers = []
+            handler = log_pipeline._listener.handlers[0]
+            emit = handler.emit
+            handler.emit = lambda record: (writers.append(threading.get_ident()), emit(record))
+            log = logging.getLogger('test_pipeline')
+            log.info('GET https://api.telegram.org/bot123456789:AAHdqTcvCH1vGWJxfSeofSAs0K5PALDsaw/getMe')
+            log_pipeline.log_event(log, 'robokassa.result_signature', inv_id=7, expected_sig='abc', password2='p', match=True)
+            log_pipeline.log_event(log, 'never', sample=0.0)
+            for i in range(20):
+                log_pipeline.log_event(log, 'filler', i=i, text='x' * 50)
+            assert log_pipeline.flush_logs()
+            assert writers and threading.get_ident() not in writers
+        finally:
+            log_pipeline.shutdown_logging()
+            root.setLevel(old_level)
+        files = sorted(glob.glob(path + '*'))
+        assert len(files) == 3  # app.log + 2 ротированных
+        lines = [json.loads(line) for f in files for line in open(f, encoding='utf-8')]
+        text = json.dumps(lines, ensure_ascii=False)
+        assert 'AAHdqTcvCH1vGWJxfSeofSAs0K5PALDsaw' not in text and 'never' not in text
+        assert all(r['service'] == 'test' for r in lines)
+        sig = next(r for r in lines if r.get('event') == 'robokassa.result_signature')
+        assert sig['expected_sig'] == sig['password2'] == '***' and sig['inv_id'] == 7 and sig['match'] is True
+    return True
+
+
+def test_24_order_queries_use_indexes():
+    """Запросы по оплатам (_ORDER_QUERIES): без полного сканирования orders, результаты верные."""
+    import os
+    import tempfile
+    from robokassa_integration import _ORDER_QUERIES, PaymentsDB
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = PaymentsDB(os.path.join(tmp, 'payments.sqlite3'))
+        for name in _ORDER_QUERIES:
+            plan = db.explain_query_plan(name)
+            assert not any(step.startswith('SCAN') for step in plan), (name, plan)
+            assert any('USING' in step and 'INDEX' in step for step in plan), (name, plan)
+
+        for user_id, product in ((1, 'webinar'), (1, 'pro'), (2, 'group_vip'), (3, 'pro')):
+            inv_id, token = db.create_order(user_id=user_id, chat_id=user_id * 10, product_code=product, amount='10.00', description='x')
+            if user_id != 3:
+                db.confirm_payment(inv_id, out_sum='10.00', order_token=token, raw_params={})
+        assert db.has_paid(1, 'webinar') and not db.has_paid(2, 'webinar') and not db.has_paid(3, 'pro')
+        assert db.last_paid_at(1, 'pro') and db.last_paid_at(3, 'pro') is None
+        assert [o.product_code for o in db.user_paid_orders(1, ('webinar', 'pro'))] in (['webinar', 'pro'], ['pro', 'webinar'])
+        assert db.paid_user_ids('pro') == [1]
+        group = db.get_group_orders_paid_since(0)
+        assert [(r['user_id'], r['chat_id'], r['product_code']) for r in group] == [(2, 20, 'group_vip')]
+        db.close()
+    return True
+
+
+def test_25_pro_entitlement_cache_and_gate():
+    """Pro: access_until при оплате и продлении, кэш доступа сбрасывается оплатой, гейт бота останавливает update."""
+    import asyncio
+    import os
+    import tempfile
+    import time
+    from types import SimpleNamespace
+    from telegram.ext import ApplicationHandlerStop
+    import bot
+    from robokassa_integration import PRO_ENTITLEMENTS, PaymentsDB, pro_subscription_days
+
+    PRO_ENTITLEMENTS.clear()
+    with tempfile.TemporaryDirectory() as tmp:
+        db = PaymentsDB(os.path.join(tmp, 'payments.sqlite3'))
+        assert not db.pro_entitlement(9).active  # промах, отрицательная запись в кэше
+        hits = PRO_ENTITLEMENTS.counters['hits']
+        assert not db.pro_entitlement(9).active and PRO_ENTITLEMENTS.counters['hits'] == hits + 1
+
+        inv_id, token = db.create_order(user_id=9, chat_id=9, product_code='pro', amount='990.00', description='x')
+        first = db.confirm_payment(inv_id, out_sum='990.00', order_token=token, raw_params={}).order
+        period = pro_subscription_days() * 86400
+        assert first['access_until'] == first['paid_at'] + period
+        # Оплата сбросила запись кэша — доступ виден сразу, без ожидания negative_ttl.
+        ent = db.pro_entitlement(9)
+        assert ent.active and ent.access_until == first['access_until']
+        inv2, token2 = db.create_order(user_id=9, chat_id=9, product_code='pro', amount='990.00', description='x')
+        second = db.confirm_payment(inv2, out_sum='990.00', order_token=token2, raw_params={}).order
+        assert second['access_until'] == first['access_until'] + period  # продление от конца подписки
+        assert db.pro_entitlement(9).access_until == second['access_until']
+
+        # Миграция 4 проставляет оплаченным раньше заказам срок из PRO_SUBSCRIPTION_DAYS, а не 30 дней.
+        from robokassa_integration import _backfill_pro_access_until
+        saved_days = os.environ.get('PRO_SUBSCRIPTION_DAYS')
+        os.environ['PRO_SUBSCRIPTION_DAYS'] = '7'
+        try:
+            conn = db._conn()
+            conn.execute('UPDATE orders SET access_until = NULL WHERE inv_id = ?', (inv_id,))
+            _backfill_pro_access_until(conn)
+        finally:
+            if saved_days is None:
+                os.environ.pop('PRO_SUBSCRIPTION_DAYS', None)
+            else:
+                os.environ['PRO_SUBSCRIPTION_DAYS'] = saved_days
+        assert db.get_order(inv_id)['access_until'] == first['paid_at'] + 7 * 86400
+        db.close()
+
+    replies = []
+
+    def update_for(user_id, text):
+        async def reply_text(t):
+            replies.append((user_id, t))
+        message = SimpleNamespace(text=text, reply_text=reply_text)
+        return SimpleNamespace(effective_user=SimpleNamespace(id=user_id), effective_message=message, callback_query=None)
+
+    from robokassa_integration import ProEntitlement
+
+    # База бота: 103 оплатил через robokassa_server (другой процесс), пока в кэше бота «нет доступа».
+    paid_elsewhere = {103: int(time.time()) + 3600}
+    db_down = [False]
+
+    class FakeDB:
+        async def call(self, method, user_id, use_cache=True):
+            assert method == 'pro_entitlement' and not use_cache
+            if db_down[0]:
+                raise ConnectionError('db down')
+            return PRO_ENTITLEMENTS.put(user_id, paid_elsewhere.get(user_id))
+
+    PRO_ENTITLEMENTS.put(101, int(time.time()) + 3600)
+    PRO_ENTITLEMENTS.put(102, None)
+    PRO_ENTITLEMENTS.put(103, None)
+
+    async def denied(user_id):
+        try:
+            await bot.pro_access_gate(update_for(user_id, 'привет'), None)
+        except ApplicationHandlerStop:
+            return True
+        return False
+
+    async def scenario():
+        assert not await denied(101)
+        await bot.pro_access_gate(update_for(102, '/privacy'), None)
+        assert await denied(102)
+        assert not await denied(103)  # отрицательная запись перепроверена в базе
+        # База недоступна: решает последняя запись кэша (даже устаревшая), без неё — отказ.
+        db_down[0] = True
+        PRO_ENTITLEMENTS._entries[103] = (0.0, paid_elsewhere[103])
+        assert not await denied(103) and await denied(104)
+
+    saved_db, bot.payments_db_async = bot.payments_db_async, FakeDB
+    errors = dict(bot.PRO_GATE_COUNTERS)
+    try:
+        asyncio.run(scenario())
+    finally:
+        bot.payments_db_async = saved_db
+    assert replies == [(102, bot.PRO_ACCESS_DENIED_TEXT), (104, bot.PRO_ACCESS_DENIED_TEXT)]
+    assert bot.PRO_GATE_COUNTERS['db_errors'] == errors['db_errors'] + 2
+    assert bot.PRO_GATE_COUNTERS['stale_served'] == errors['stale_served'] + 1
+    assert isinstance(PRO_ENTITLEMENTS.last_known(103), ProEntitlement)
+    PRO_ENTITLEMENTS.clear()
+    return True
+
+
+def test_26_bulk_upsert_clients():
+    """upsert_client одним оператором и bulk_upsert_clients: None не перезаписывает, чанки, backfill из orders."""
+    import os
+    import tempfile
+    from robokassa_integration import PaymentsDB
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = PaymentsDB(os.path.join(tmp, 'payments.sqlite3'))
+        conn = db._conn()
+        db.upsert_client(user_id=1, username='ann', self_value_scale=7)
+        row = conn.execute('SELECT chat_id, username, first_name, self_value_scale FROM clients WHERE user_id=1').fetchone()
+        assert row == (None, 'ann', '', 7), row
+        conn.execute('UPDATE clients SET updated_at = 1 WHERE user_id = 1')
+        db.upsert_client(user_id=1)
+        assert conn.execute('SELECT updated_at FROM clients WHERE user_id=1').fetchone()[0] == 1
+        db.upsert_client(user_id=1, chat_id=10, first_name='Anna')
+        row = conn.execute('SELECT chat_id, username, first_name, self_value_scale FROM clients WHERE user_id=1').fetchone()
+        assert row == (10, 'ann', 'Anna', 7), row
+
+        rows = [{'user_id': i, 'focus': f'f{i}'} for i in range(2, 2502)] + [{'user_id': 1, 'tariff': 'vip'}]
+        assert db.bulk_upsert_clients(iter(rows), chunk_size=1000) == len(rows)
+        assert conn.execute('SELECT COUNT(*) FROM clients').fetchone()[0] == 2501
+        row = conn.execute('SELECT username, tariff FROM clients WHERE user_id=1').fetchone()
+        assert row == ('ann', 'vip'), row
+        try:
+            db.bulk_upsert_clients([{'user_id': 3000}, {'user_id': 3001, 'no_such_field': 'x'}])
+            assert False, 'ожидался ValueError'
+        except ValueError:
+            pass
+        assert conn.execute('SELECT COUNT(*) FROM clients WHERE user_id >= 3000').fetchone()[0] == 0
+
+        for user_id, product in ((5000, 'webinar'), (5000, 'pro'), (5001, 'group_vip')):
+            inv_id, token = db.create_order(user_id=user_id, chat_id=user_id + 1, product_code=product, amount='10.00', description='x')
+            conn.execute("UPDATE orders SET status='paid', paid_at=? WHERE inv_id=?", (inv_id, inv_id))
+        db.create_order(user_id=5002, chat_id=1, product_code='pro', amount='10.00', description='x')
+        assert db.backfill_clients_from_orders(chunk_size=2) == 3
+        got = conn.execute('SELECT user_id, chat_id, product FROM clients WHERE user_id >= 5000 ORDER BY user_id').fetchall()
+        assert got == [(5000, 5001, 'pro'), (5001, 5002, 'group_vip')], got
+        db.close()
+    return True
+
+
 # ---- Тесты тестового UI (test_dialog_ui.py): проверка, что весь функционал доступен без auto_dialog.py ----
 
+def test_27_payment_link_prefetch():
+    """Ссылка на оплату готовится при показе «Оплатить»: заказ draft -> pending по нажатию, устаревшие удаляются."""
+    import asyncio
+    import os
+    import tempfile
+    import time
+    from types import SimpleNamespace
+    import bot
+    import payment_links
+    from payment_links import PaymentLinkPrefetcher
+    from payments_async import AsyncPaymentsDB
+    from robokassa_integration import PaymentsDB, RobokassaConfig
+
+    cfg = RobokassaConfig(merchant_login='shop', password1='p1', password2='p2', merchant_url='https://pay.test/', is_test=False)
+    edits = []
+
+    async def edit_message_text(text, reply_markup=None, **kwargs):
+        edits.append(reply_markup.inline_keyboard[0][0].url if reply_markup else text)
+
+    update = SimpleNamespace(
+        effective_chat=SimpleNamespace(id=70),
+        effective_user=SimpleNamespace(id=7),
+        callback_query=SimpleNamespace(edit_message_text=edit_message_text),
+    )
+    context = SimpleNamespace(user_data={})
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = PaymentsDB(os.path.join(tmp, 'payments.sqlite3'))
+        adb = AsyncPaymentsDB(lambda: db)
+        links = PaymentLinkPrefetcher(lambda: adb, config=lambda: cfg, ttl=60)
+        statuses = lambda: [r[0] for r in db._conn().execute('SELECT status FROM orders ORDER BY inv_id')]
+        saved = bot.PAYMENT_LINKS
+        bot.PAYMENT_LINKS = links
+
+        async def scenario():
+            keyboard = bot._keyboard_for_step('pay_choice:webinar', context)
+            bot._prefetch_payment_link(update, keyboard)
+            bot._prefetch_payment_link(update, keyboard)  # повторный показ — тот же заказ
+            await asyncio.sleep(0.2)
+            assert statuses() == ['draft'] and links.counters['prefetched'] == 1
+            await bot.send_payment_link(update, context, product_code_override='webinar')
+            assert links.counters['hits'] == 1 and statuses() == ['pending']  # pending уже к выдаче ссылки
+            # Ссылка выдана — повторное нажатие идёт обычным путём (новый заказ в send_payment_link).
+            assert await links.take(user_id=7, chat_id=70, product_code='webinar') is None
+            assert links.counters['misses'] == 1
+
+            # Draft удалён до нажатия (очистка) — ссылку на него не выдаём, нажатие идёт обычным путём.
+            links.prefetch(user_id=9, chat_id=90, product_code='pro', amount='990.00', description='x')
+            await asyncio.sleep(0.2)
+            db._conn().execute("DELETE FROM orders WHERE status = 'draft'")
+            assert await links.take(user_id=9, chat_id=90, product_code='pro') is None
+            assert links.counters['errors'] == 1 and links.counters['hits'] == 1
+            # Ошибка подписи ссылки — тоже откат на обычный путь, а не исключение из задачи подготовки.
+            saved_url = payment_links.payment_url_for_order
+            payment_links.payment_url_for_order = lambda cfg, **kw: 1 / 0
+            try:
+                links.prefetch(user_id=9, chat_id=90, product_code='pro', amount='990.00', description='x')
+                assert await links.take(user_id=9, chat_id=90, product_code='pro') is None
+            finally:
+                payment_links.payment_url_for_order = saved_url
+            assert links.counters['errors'] == 2
+            db._conn().execute("DELETE FROM orders WHERE status = 'draft'")
+
+            links.ttl = 0
+            links.prefetch(user_id=8, chat_id=80, product_code='pro', amount='990.00', description='x')
+            await asyncio.sleep(0.2)
+            assert await links.take(user_id=8, chat_id=80, product_code='pro') is None
+            assert links.counters['stale'] == 1
+
+        try:
+            asyncio.run(scenario())
+        finally:
+            bot.PAYMENT_LINKS = saved
+            adb.shutdown()
+        assert len(edits) == 1 and edits[0].startswith('https://pay.test/?') and 'InvId=1&' in edits[0], edits
+        assert statuses() == ['pending', 'draft']
+        # Устаревший draft не считается ожидающим и удаляется; оплата по нему всё же засчитывается.
+        inv3, token3 = db.create_order(user_id=9, chat_id=9, product_code='webinar', amount='10.00', description='x', draft=True)
+        assert db.confirm_payment(inv3, out_sum='10.00', order_token=token3, raw_params={}).newly_paid
+        db._conn().execute("UPDATE orders SET created_at = ? WHERE status = 'draft'", (int(time.time()) - 120,))
+        assert db.discard_draft_orders(older_than_sec=60) == 1
+        assert statuses() == ['pending', 'paid']
+        db.close()
+    return True
+
+
+def test_28_orders_maintenance():
+    """Обслуживание orders: pending -> expired, перенос в архив, оплата по архивному заказу, incremental vacuum."""
+    import os
+    import tempfile
+    import time
+    from orders_maintenance import run_maintenance
+    from robokassa_integration import PaymentsDB
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = PaymentsDB(os.path.join(tmp, 'payments.sqlite3'))
+        conn = db._conn()
+        assert conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+        now = int(time.time())
+        ages = {'fresh': 60, 'stale': 5 * 86400, 'old': 40 * 86400, 'old_paid': 40 * 86400}
+        orders = {}
+        for name, age in ages.items():
+            orders[name] = db.create_order(user_id=1, chat_id=1, product_code='webinar', amount='10.00', description=name)
+            conn.execute('UPDATE orders SET created_at = ? WHERE inv_id = ?', (now - age, orders[name][0]))
+        inv, token = orders['old_paid']
+        assert db.confirm_payment(inv, out_sum='10.00', order_token=token, raw_params={}).newly_paid
+
+        stats = run_maintenance(db, pending_ttl_sec=72 * 3600, archive_after_sec=30 * 86400, batch=1)
+        assert (stats['archived'], stats['expired']) == (1, 1), stats
+        assert db.order_counts() == {'pending': 1, 'expired': 1, 'paid': 1, 'archived': 1}, db.order_counts()
+        assert db.get_order(orders['stale'][0])['status'] == 'expired'
+        archived = db.get_order(orders['old'][0])
+        assert archived['status'] == 'expired' and archived['description'] == 'old', archived
+        assert run_maintenance(db, pending_ttl_sec=72 * 3600, archive_after_sec=30 * 86400)['archived'] == 0
+
+        # ResultURL по архивному и по просроченному заказу: оплата засчитывается.
+        inv, token = orders['old']
+        assert db.confirm_payment(inv, out_sum='10.00', order_token=token, raw_params={}).newly_paid
+        inv, token = orders['stale']
+        assert db.confirm_payment(inv, out_sum='10.00', order_token=token, raw_params={}).newly_paid
+        assert db.order_counts() == {'pending': 1, 'paid': 3, 'archived': 0}, db.order_counts()
+        assert db.confirm_payment(999, out_sum='10.00', order_token=None, raw_params={}).error == 'unknown_order'
+
+        assert db.incremental_vacuum() >= 0
+        db.close()
+    return True
+
+
+def test_29_reporting_replica():
+    """Отчёты по снимку базы: метка снимка, реплика только на чтение, обновление по возрасту, выбор через env."""
+    import os
+    import sqlite3
+    import tempfile
+    import time
+    from robokassa_integration import PaymentsDB
+    from reporting_replica import ReplicaPaymentsDB, ReportingReplica, report_watermark, reporting_db
+
+    def pay(db, user_id):
+        inv, token = db.create_order(user_id=user_id, chat_id=1, product_code='group_vip', amount='10.00', description='x')
+        assert db.confirm_payment(inv, out_sum='10.00', order_token=token, raw_params={}).newly_paid
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = PaymentsDB(os.path.join(tmp, 'payments.sqlite3'))
+        pay(db, 1)
+        replica = ReportingReplica(db.path, os.path.join(tmp, 'report.sqlite3'), max_age_sec=3600)
+        before = int(time.time())
+        rdb = replica.db()
+        assert rdb.snapshot_at() >= before and report_watermark(rdb) == rdb.snapshot_at()
+        assert [r['user_id'] for r in rdb.get_group_orders_paid_since(0)] == [1]
+        pay(db, 2)
+        assert len(replica.db().get_group_orders_paid_since(0)) == 1  # снимок ещё свежий
+        assert len(replica.db(max_age_sec=-1).get_group_orders_paid_since(0)) == 2
+        assert rdb.order_counts() == {'paid': 2, 'archived': 0}
+        try:
+            rdb.create_order(user_id=3, chat_id=1, product_code='pro', amount='1.00', description='x')
+            assert False, 'реплика должна быть только для чтения'
+        except sqlite3.OperationalError:
+            pass
+        assert not [f for f in os.listdir(tmp) if f.endswith('.tmp')]
+        assert 'replica_meta' not in {r[0] for r in db._conn().execute("SELECT name FROM sqlite_master")}
+
+        saved = {k: os.environ.get(k) for k in ('PAYMENTS_DB_PATH', 'REPORTING_REPLICA_PATH')}
+        try:
+            os.environ['PAYMENTS_DB_PATH'] = db.path
+            os.environ.pop('REPORTING_REPLICA_PATH', None)
+            primary = reporting_db()
+            assert not isinstance(primary, ReplicaPaymentsDB) and report_watermark(primary) >= before
+            os.environ['REPORTING_REPLICA_PATH'] = os.path.join(tmp, 'env_report.sqlite3')
+            assert isinstance(reporting_db(), ReplicaPaymentsDB)
+            assert len(reporting_db().get_group_orders_paid_since(0)) == 2
+        finally:
+            for k, v in saved.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+        rdb.close()
+        db.close()
+    return True
+
+
+def _payments_store_contract(db):
+    """Общие проверки PaymentsStore: одни и те же для SQLite и PostgreSQL."""
+    from payments_store import PaymentsStore
+    from robokassa_integration import PRO_ENTITLEMENTS, pro_subscription_days
+
+    PRO_ENTITLEMENTS.clear()
+    assert isinstance(db, PaymentsStore) and db.schema_version() >= 1
+    inv_id, token = db.create_order(user_id=7, chat_id=70, product_code='group_vip', amount='45990.00', description='x')
+    assert isinstance(inv_id, int) and db.get_order(inv_id)['status'] == 'pending'
+    assert db.confirm_payment(inv_id + 1000, out_sum='45990.00', order_token=token, raw_params={}).error == 'unknown_order'
+    assert db.confirm_payment(inv_id, out_sum='1.00', order_token=token, raw_params={}).error == 'amount_mismatch'
+    assert db.confirm_payment(inv_id, out_sum='45990.00', order_token='bad', raw_params={}).error == 'token_mismatch'
+    assert db.get_order(inv_id)['status'] == 'pending'
+    first = db.confirm_payment(inv_id, out_sum='45990.00', order_token=token, raw_params={'InvId': inv_id})
+    again = db.confirm_payment(inv_id, out_sum='45990.00', order_token=token, raw_params={'InvId': inv_id})
+    assert first.newly_paid and again.ok and not again.newly_paid
+    assert first.order['status'] == 'paid' and first.order['paid_at'] and again.order['paid_at'] == first.order['paid_at']
+    client = db.get_client(7)
+    assert (client['chat_id'], client['product']) == (70, 'group_vip'), client
+    assert [o['user_id'] for o in db.get_group_orders_paid_since(0)] == [7]
+    assert [o.inv_id for o in db.paid_orders(['group_vip', 'group_standard'])] == [inv_id]
+    assert db.has_paid(7, 'group_vip') and not db.has_paid(7, 'webinar')
+    assert db.last_paid_at(7, 'group_vip') == first.order['paid_at'] and db.paid_user_ids('group_vip') == [7]
+    assert [o.product_code for o in db.user_paid_orders(7, ['group_vip'])] == ['group_vip']
+
+    # Outbox: уведомление покупателю записано вместе с оплатой, аренда не даёт взять его дважды.
+    claimed = db.claim_outbox(limit=10, lease_sec=60)
+    assert [c['inv_id'] for c in claimed if c['chat_id'] == '70'] == [inv_id]
+    assert db.claim_outbox(limit=10, lease_sec=60) == []
+    db.outbox_retry(claimed[0]['id'], error='telegram down', retry_at=None)
+    for item in claimed[1:]:
+        db.outbox_sent(item['id'])
+    counts = db.outbox_counts()
+    assert counts.get('failed') == 1 and sum(counts.values()) == len(claimed), counts
+
+    period = pro_subscription_days() * 86400
+    orders = [db.create_order(user_id=9, chat_id=9, product_code='pro', amount='990.00', description='x') for _ in range(2)]
+    paid = [db.confirm_payment(i, out_sum='990.00', order_token=t, raw_params={}).order for i, t in orders]
+    assert paid[0]['access_until'] == paid[0]['paid_at'] + period
+    assert paid[1]['access_until'] == paid[0]['access_until'] + period
+    ent = db.pro_entitlement(9, use_cache=False)
+    assert ent.active and ent.access_until == paid[1]['access_until']
+    assert not db.pro_entitlement(10, use_cache=False).active
+
+    draft, draft_token = db.create_order(user_id=11, chat_id=11, product_code='webinar', amount='2990.00', description='x', draft=True)
+    assert db.get_order(draft)['status'] == 'draft'
+    assert db.activate_draft_order(draft, draft_token) and not db.activate_draft_order(draft, draft_token)
+    stale, _ = db.create_order(user_id=12, chat_id=12, product_code='webinar', amount='2990.00', description='x', draft=True)
+    assert db.discard_draft_orders(older_than_sec=-10) == 1 and db.get_order(stale) is None
+    marked, _ = db.create_order(user_id=13, chat_id=13, product_code='webinar', amount='2990.00', description='x')
+    assert db.mark_paid_if_pending(marked, raw_params={}) and not db.mark_paid_if_pending(marked, raw_params={})
+
+    # Брошенный заказ: expired -> архив; оплата по старой ссылке возвращает его в orders.
+    assert db.expire_pending_orders(older_than_sec=-10) == 1 and db.get_order(draft)['status'] == 'expired'
+    assert db.archive_orders(older_than_sec=-10) == 1
+    archived = db.get_order(draft)
+    assert archived['status'] == 'expired' and archived['archived_at'], archived
+    assert (archived['order_token'], archived['user_id'], archived['amount']) == (draft_token, 11, '2990.00'), archived
+    assert db.order_counts() == {'paid': 4, 'archived': 1}, db.order_counts()
+    restored = db.confirm_payment(draft, out_sum='2990.00', order_token=draft_token, raw_params={})
+    assert restored.newly_paid and db.order_counts() == {'paid': 5, 'archived': 0}
+    assert db.incremental_vacuum(10) >= 0
+
+    db.upsert_client(user_id=1, username='ann', self_value_scale=7)
+    db.upsert_client(user_id=1, chat_id=10, first_name='Anna')
+    client = db.get_client(1)
+    assert (client['chat_id'], client['username'], client['first_name'], client['self_value_scale']) == (10, 'ann', 'Anna', 7)
+    # self_value_scale из анкеты строкой: дробь округляется, нечисловое значение не затирает прежнее.
+    db.upsert_client(user_id=1, self_value_scale='8.5')
+    assert db.get_client(1)['self_value_scale'] == 8
+    db.upsert_client(user_id=1, self_value_scale='7/10')
+    assert db.get_client(1)['self_value_scale'] == 8
+    rows = [{'user_id': i, 'focus': f'f{i}'} for i in range(100, 1100)] + [{'user_id': 1, 'tariff': 'vip'}]
+    assert db.bulk_upsert_clients(iter(rows), chunk_size=300) == len(rows)
+    assert db.get_client(1)['tariff'] == 'vip' and db.get_client(1)['username'] == 'ann'
+    assert db.get_client(1099)['focus'] == 'f1099' and db.get_client(5000) is None
+    try:
+        db.bulk_upsert_clients([{'user_id': 3000}, {'user_id': 3001, 'no_such_field': 'x'}])
+        assert False, 'ожидался ValueError'
+    except ValueError:
+        pass
+    assert db.get_client(3000) is None
+    try:
+        db.upsert_client(user_id=3002, no_such_field='x')
+        assert False, 'ожидался ValueError'
+    except ValueError:
+        pass
+    assert db.get_client(3002) is None
+    assert db.backfill_clients_from_orders(chunk_size=2) == 5  # оплаченные заказы: 7, 9 (дважды), 11, 13
+
+    # Дайджест групповых: новые оплаты с анкетой клиента одним запросом, отметка ставится один раз.
+    db.upsert_client(user_id=1, contact_channel='telegram', contact_value='@ann', preferred_group_start='апрель')
+    group, group_token = db.create_order(user_id=1, chat_id=10, product_code='group_standard', amount='100.00', description='x')
+    assert db.confirm_payment(group, out_sum='100.00', order_token=group_token, raw_params={}).newly_paid
+    assert [o['inv_id'] for o in db.unnotified_group_orders(limit=1)] == [inv_id]
+    new = db.unnotified_group_orders()
+    assert [o['inv_id'] for o in new] == [inv_id, group], new
+    assert (new[1]['username'], new[1]['contact_value'], new[1]['preferred_group_start']) == ('ann', '@ann', 'апрель')
+    assert db.mark_group_notified([inv_id, group]) == 2 and db.mark_group_notified([inv_id]) == 0
+    assert db.unnotified_group_orders() == [] and db.mark_group_notified([]) == 0
+    PRO_ENTITLEMENTS.clear()
+
+
+def test_30_payments_store_sqlite():
+    """PaymentsStore на SQLite: общий набор проверок хранилища оплат."""
+    import os
+    import tempfile
+    from payments_store import payments_db
+    from robokassa_integration import PaymentsDB
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = PaymentsDB(os.path.join(tmp, 'payments.sqlite3'))
+        _payments_store_contract(db)
+        db.close()
+        saved = {k: os.environ.get(k) for k in ('PAYMENTS_DB_PATH', 'PAYMENTS_DB_URL')}
+        try:
+            os.environ['PAYMENTS_DB_PATH'] = db.path
+            os.environ.pop('PAYMENTS_DB_URL', None)
+            assert isinstance(payments_db(), PaymentsDB)
+        finally:
+            for k, v in saved.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+    return True
+
+
+def test_31_payments_store_postgres():
+    """PaymentsStore на PostgreSQL (PAYMENTS_TEST_PG_DSN): те же проверки, гонка ResultURL, нативный async-путь."""
+    import asyncio
+    import threading
+    import uuid
+    from urllib.parse import urlsplit, urlunsplit
+
+    dsn = os.getenv('PAYMENTS_TEST_PG_DSN')
+    if not dsn:
+        print('   пропущен: PAYMENTS_TEST_PG_DSN не задан')
+        return True
+    import asyncpg
+    from payments_async import AsyncPaymentsDB
+    from payments_pg import PostgresPaymentsDB
+
+    # Отдельная временная база: тест не трогает таблицы базы из DSN.
+    name = f'payments_test_{uuid.uuid4().hex[:12]}'
+    parts = urlsplit(dsn)
+    test_dsn = urlunsplit(parts._replace(path='/' + name))
+
+    async def admin(sql):
+        conn = await asyncpg.connect(dsn)
+        try:
+            await conn.execute(sql)
+        finally:
+            await conn.close()
+
+    asyncio.run(admin(f'CREATE DATABASE {name}'))
+    db = None
+    try:
+        db = PostgresPaymentsDB(test_dsn, pool_size=4)
+        _payments_store_contract(db)
+        PostgresPaymentsDB(test_dsn, pool_size=1).close()  # повторная миграция — без изменений
+
+        inv_id, token = db.create_order(user_id=20, chat_id=200, product_code='group_vip', amount='10.00', description='x')
+        results = []
+        barrier = threading.Barrier(8)
+
+        def retry():
+            barrier.wait()
+            results.append(db.confirm_payment(inv_id, out_sum='10.00', order_token=token, raw_params={}))
+
+        threads = [threading.Thread(target=retry) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert all(r.ok for r in results) and sum(r.newly_paid for r in results) == 1
+
+        async def scenario():
+            adb = AsyncPaymentsDB(db_factory=lambda: db, max_workers=2)
+            assert (await adb.get_order(inv_id))['status'] == 'paid'
+            assert adb._native is db  # дальше — на пуле asyncpg, без потоков фасада
+            found = await asyncio.gather(*(adb.get_order(inv_id) for _ in range(20)))
+            assert all(o['status'] == 'paid' for o in found) and adb.counters['queries'] == 21
+            adb.shutdown()
+
+        asyncio.run(scenario())
+
+        # Миграция 3: отправленными считаются только оплаты до метки последнего слота (job_marks).
+        async def downgrade():
+            conn = await asyncpg.connect(test_dsn)
+            try:
+                await conn.execute('DROP INDEX idx_orders_group_unnotified')
+                await conn.execute('ALTER TABLE orders DROP COLUMN group_notified_at')
+                await conn.execute('ALTER TABLE orders_archive DROP COLUMN group_notified_at')
+                await conn.execute('UPDATE orders SET paid_at = 999000 WHERE paid_at IS NOT NULL AND inv_id != $1', inv_id)
+                await conn.execute('UPDATE orders SET paid_at = 1001000 WHERE inv_id = $1', inv_id)
+                await conn.execute("INSERT INTO job_marks (name, mark, updated_at) VALUES ('group_digest', 1000000, 0)")
+                await conn.execute('UPDATE schema_version SET version = 2')
+            finally:
+                await conn.close()
+
+        asyncio.run(downgrade())
+        PostgresPaymentsDB(test_dsn, pool_size=1).close()
+        assert db.schema_version() == 3 and [o['inv_id'] for o in db.unnotified_group_orders()] == [inv_id]
+    finally:
+        if db is not None:
+            db.close()
+        asyncio.run(admin(f'DROP DATABASE {name}'))
+    return True
+
+
+def test_32_group_digest_scheduler():
+    """Дайджест по слотам МСК: метка слота в базе (один раз на все процессы), догон после простоя, повтор при ошибке."""
+    import asyncio
+    import os
+    import tempfile
+    from datetime import datetime, time as dtime
+    from group_digest import MSK, DigestScheduler, last_slot, next_slot, parse_slot, run_due_digest
+    from robokassa_integration import PaymentsDB
+
+    slots = [dtime(9, 0), dtime(21, 30)]
+
+    def at(day, hour, minute, second=0):
+        return datetime(2026, 3, day, hour, minute, second, tzinfo=MSK)
+
+    assert parse_slot('9:05') == dtime(9, 5) and parse_slot('09:05:00') == dtime(9, 5)
+    assert parse_slot('25:00') is None and parse_slot('') is None
+    assert last_slot(at(2, 8, 0), slots) == at(1, 21, 30) and last_slot(at(2, 9, 0), slots) == at(2, 9, 0)
+    assert next_slot(at(2, 21, 30), slots) == at(3, 9, 0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = PaymentsDB(os.path.join(tmp, 'payments.sqlite3'))
+        inv, token = db.create_order(user_id=1, chat_id=10, product_code='group_vip', amount='10.00', description='x')
+        assert db.confirm_payment(inv, out_sum='10.00', order_token=token, raw_params={}).newly_paid
+        sent = []
+
+        def run(now, send=sent.append):
+            return run_due_digest(db, send, slots=slots, catchup_sec=6 * 3600, now=now)
+
+        assert run(at(2, 10, 0)) is None and sent == []  # первый запуск: только метка, без догона
+        assert run(at(2, 21, 29)) is None
+        assert run(at(2, 21, 31)) == 1 and len(sent) == 1 and 'group_vip' not in sent[0] and 'VIP' in sent[0]
+        assert run(at(2, 21, 40)) is None and len(sent) == 1  # слот уже отправлен
+
+        def down(text):
+            raise ConnectionError('telegram down')
+
+        inv, token = db.create_order(user_id=2, chat_id=20, product_code='group_standard', amount='10.00', description='x')
+        assert db.confirm_payment(inv, out_sum='10.00', order_token=token, raw_params={}).newly_paid
+        try:
+            run(at(3, 9, 1), send=down)
+            assert False, 'ожидалась ошибка отправки'
+        except ConnectionError:
+            pass
+        assert run(at(3, 9, 2)) == 1 and len(sent) == 2  # метка возвращена — слот повторён
+        assert run(at(4, 0, 0)) == 0 and len(sent) == 3 and 'нет' in sent[-1]  # слот 21:30 догнан после простоя
+        assert run(at(6, 12, 0)) == 0 and run(at(6, 12, 1)) is None and len(sent) == 4  # один за последний слот
+        assert run(at(7, 8, 0)) is None and len(sent) == 4  # 21:30 пропущен: простой дольше окна догона
+        assert db.job_mark('group_digest') == int(at(6, 21, 30).timestamp())
+
+        # Сравнение с обменом: из двух процессов метку ставит один.
+        assert db.set_job_mark('other', expected=None, mark=1) and not db.set_job_mark('other', expected=None, mark=2)
+        assert db.set_job_mark('other', expected=1, mark=3) and not db.set_job_mark('other', expected=1, mark=4)
+
+        async def scenario():
+            scheduler = DigestScheduler(
+                sent.append,
+                slots=slots,
+                db_factory=lambda: db,
+                clock=lambda: at(7, 9, 0, 5),
+            )
+            assert scheduler.seconds_until_next_slot() == 12 * 3600 + 30 * 60 - 5 + 1
+            scheduler.start()
+            for _ in range(200):
+                if scheduler.counters['sent']:
+                    break
+                await asyncio.sleep(0.01)
+            await scheduler.stop()
+            return scheduler.counters
+
+        assert asyncio.run(scenario()) == {'sent': 1, 'errors': 0} and len(sent) == 5
+        db.close()
+    return True
+
+
+def test_33_group_digest_watermark():
+    """Дайджест по водяному знаку: каждая оплата ровно один раз, анкета клиента, пачки, режим immediate."""
+    import os
+    import sqlite3
+    import tempfile
+    from datetime import datetime
+    from group_digest import MSK, send_new_orders
+    from robokassa_integration import PaymentsDB
+
+    now = datetime(2026, 3, 2, 12, 0, tzinfo=MSK)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'payments.sqlite3')
+        db = PaymentsDB(path)
+
+        def pay(user_id, product='group_vip'):
+            inv, token = db.create_order(user_id=user_id, chat_id=user_id * 10, product_code=product, amount='10.00', description='x')
+            assert db.confirm_payment(inv, out_sum='10.00', order_token=token, raw_params={}).newly_paid
+            return inv
+
+        db.upsert_client(user_id=1, username='ann<b>', contact_channel='phone', contact_value='+79990000000', preferred_group_start='май')
+        db.upsert_client(user_id=2, first_name='Борис', last_name='Б')
+        first = [pay(1), pay(2), pay(3, 'pro')]
+        sent = []
+        assert send_new_orders(db, sent.append, now=now) == 2 and len(sent) == 1
+        assert '@ann&lt;b&gt;' in sent[0] and 'phone: +79990000000' in sent[0] and 'май' in sent[0] and 'Борис Б' in sent[0]
+        assert all(db.get_order(i)['group_notified_at'] for i in first[:2]) and db.get_order(first[2])['group_notified_at'] is None
+
+        # Следующий дайджест — только новые оплаты; окно часов не влияет.
+        pay(4, 'group_standard')
+        assert send_new_orders(db, sent.append, now=now) == 1 and '40 | Стандарт' in sent[-1] and '10 | VIP' not in sent[-1]
+        assert send_new_orders(db, sent.append, now=now) == 0 and 'Новых оплат' in sent[-1]
+
+        # Пачки: ошибка на второй оставляет первую отмеченной, повтор шлёт только остаток.
+        for user_id in range(10, 17):
+            pay(user_id)
+        calls = []
+
+        def flaky(text):
+            calls.append(text)
+            if len(calls) == 2:
+                raise ConnectionError('telegram down')
+
+        try:
+            send_new_orders(db, flaky, now=now, batch=3)
+            assert False, 'ожидалась ошибка отправки'
+        except ConnectionError:
+            pass
+        assert len(db.unnotified_group_orders()) == 4
+        assert send_new_orders(db, calls.append, now=now, batch=3) == 4 and len(calls) == 4 and 'часть 2' in calls[-1]
+
+        # Длинные поля анкеты от модели: сообщения делятся по длине и не выходят за лимит Telegram.
+        for user_id in range(30, 55):
+            db.upsert_client(user_id=user_id, contact_value='позвоните ' * 200, preferred_group_start='<осенью> ' * 200)
+            pay(user_id)
+        long_msgs = []
+        assert send_new_orders(db, long_msgs.append, now=now) == 25
+        assert len(long_msgs) > 1 and all(len(m) <= 4096 for m in long_msgs) and '&lt;осенью&gt;' in long_msgs[0]
+
+        # Постоянная ошибка Telegram (400): оплаты сообщения отмечаются, следующий дайджест не блокируется.
+        from telegram_api import TelegramAPIError
+
+        def rejected(text):
+            raise TelegramAPIError('sendMessage', 400, "Bad Request: can't parse entities")
+
+        rejected_inv = pay(60)
+        assert send_new_orders(db, rejected, now=now) == 0 and db.get_order(rejected_inv)['group_notified_at']
+        pay(61)
+        assert send_new_orders(db, calls.append, now=now) == 1 and '610 | VIP' in calls[-1]
+
+        # --force во время отправки слота: второй процесс не берёт те же оплаты, пока первый их шлёт.
+        pay(62)
+        concurrent = []
+
+        def send_and_race(text):
+            concurrent.append(send_new_orders(db, calls.append, now=now))
+            calls.append(text)
+
+        sent_before = len(calls)
+        assert send_new_orders(db, send_and_race, now=now) == 1 and concurrent == [None]
+        assert len(calls) == sent_before + 1 and '620 | VIP' in calls[-1]
+        assert send_new_orders(db, calls.append, now=now) == 0  # захват отпущен
+
+        # GROUP_DIGEST_MODE=immediate: строка ушла через outbox при оплате, дайджест её не повторит.
+        saved = {k: os.environ.get(k) for k in ('GROUP_DIGEST_MODE', 'TELEGRAM_GROUP_NOTIFY_CHAT_ID')}
+        os.environ.update(GROUP_DIGEST_MODE='immediate', TELEGRAM_GROUP_NOTIFY_CHAT_ID='-100')
+        try:
+            immediate = pay(20)
+        finally:
+            for k, v in saved.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+        assert db.get_order(immediate)['group_notified_at'] and db.unnotified_group_orders() == []
+        db.close()
+
+        # Миграция 7: оплаты до последнего отправленного слота ушли в дайджесты по окну и считаются
+        # отправленными; оплата после метки ещё не отправлялась и уйдёт в следующий слот.
+        conn = sqlite3.connect(path)
+        conn.execute('DROP INDEX idx_orders_group_unnotified')
+        conn.execute('ALTER TABLE orders DROP COLUMN group_notified_at')
+        conn.execute('ALTER TABLE orders_archive DROP COLUMN group_notified_at')
+        conn.execute('UPDATE orders SET paid_at = 999000 WHERE inv_id != ?', (first[1],))
+        conn.execute('UPDATE orders SET paid_at = 1001000 WHERE inv_id = ?', (first[1],))
+        conn.execute("INSERT INTO job_marks (name, mark, updated_at) VALUES ('group_digest', 1000000, 0)")
+        conn.execute('PRAGMA user_version = 6')
+        conn.commit()
+        conn.close()
+        db = PaymentsDB(path)
+        assert db.schema_version() == 7
+        assert [o['inv_id'] for o in db.unnotified_group_orders()] == [first[1]]
+        assert db.get_order(first[0])['group_notified_at'] == 999000
+        db.close()
+    return True
+
+
 def test_ui_1_module_has_main():
     """Тестовый UI: модуль test_dialog_ui имеет функцию main()."""
     import test_dialog_ui
@@ -187,6 +1622,32 @@ if __name__ == '__main__':
         ('callback_data length and format', test_5_callback_length_and_format),
         ('New step buttons (insight_next, readiness, products, pay_choice, webinar_offer)', test_6_new_step_buttons),
         ('Load prompt file and content', test_7_load_prompt_file),
+        ('Prompt compiler: core + stage sections', test_8_prompt_compiler_stages),
+        ('Prompt routing by last step_id', test_9_prompt_routing_follows_last_step),
+        ('History token budget and rolling summary', test_10_history_token_budget_and_summary),
+        ('Incremental stream renderer', test_11_stream_renderer_matches_parse),
+        ('Edit scheduler: coalescing, RetryAfter, finalize', test_12_edit_scheduler_coalescing_and_retry_after),
+        ('Stream stop conditions: STEP, char budget, repetition', test_13_stream_stop_conditions),
+        ('SQLite conversation store: write-behind, LRU, reload', test_14_sqlite_conversation_store),
+        ('Tiered history: LRU, idle compaction, restore', test_15_tiered_history_idle_compaction),
+        ('Per-user ordered dispatch', test_16_user_dispatcher_orders_per_user),
+        ('Burst debouncing: merge, supersede, commit', test_17_reply_debouncer_merges_bursts),
+        ('PaymentsDB: shared instance, migrations, per-thread connection', test_18_payments_db_shared_and_migrated),
+        ('Async PaymentsDB facade: thread pool, slow query log', test_19_async_payments_db_offloads_queries),
+        ('confirm_payment: one transaction, duplicate retries', test_20_confirm_payment_single_transaction_under_retries),
+        ('Payment outbox: durable notifications with retries', test_21_payment_outbox_retries_until_delivered),
+        ('Telegram API client: pooled, RetryAfter, sync wrapper', test_22_telegram_api_client_pools_and_retries),
+        ('Log pipeline: background writer, redaction, rotation', test_23_log_pipeline_background_rotation_redaction),
+        ('Order queries: indexed, no full scans', test_24_order_queries_use_indexes),
+        ('Pro entitlement: access_until, cache invalidation, bot gate', test_25_pro_entitlement_cache_and_gate),
+        ('Client upsert: single statement, bulk chunks, backfill', test_26_bulk_upsert_clients),
+        ('Payment link prefetch: draft order, activation, discard', test_27_payment_link_prefetch),
+        ('Orders maintenance: expire, archive, restore, vacuum', test_28_orders_maintenance),
+        ('Reporting replica: snapshot watermark, read-only, refresh', test_29_reporting_replica),
+        ('Payments store contract on SQLite', test_30_payments_store_sqlite),
+        ('Payments store contract on PostgreSQL', test_31_payments_store_postgres),
+        ('Group digest scheduler: MSK slots, catch-up, shared mark', test_32_group_digest_scheduler),
+        ('Group digest watermark: exactly-once, client columns, batches', test_33_group_digest_watermark),
         ('UI: module has main()', test_ui_1_module_has_main),
         ('UI: __main__ entry point calls main()', test_ui_2_entry_point_when_run_as_script),
         ('UI: bot exports required by UI', test_ui_3_bot_exports_required_by_ui),
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Упорядоченная обработка update по пользователям (UserDispatcher).
+
+PTB с concurrent_updates обрабатывает update параллельно, и два быстрых сообщения одного
+пользователя перемешали бы свои записи в истории диалога. Диспетчер — ключевой async-замок
+с очередью FIFO: обработчики с одним ключом (user_id) выполняются строго по одному и в порядке
+поступления, обработчики разных пользователей — параллельно. Очередь пользователя удаляется,
+как только опустела, поэтому память не растёт с числом пользователей.
+"""
+from __future__ import annotations
+
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class UserDispatcher:
+    """Работает в текущем цикле asyncio; counters — для логов и нагрузочного теста."""
+
+    def __init__(self):
+        # ключ -> очередь «пропусков»; голова очереди — выполняющийся сейчас обработчик.
+        self._queues: dict[Hashable, deque[asyncio.Future]] = {}
+        self.counters = {"run": 0, "queued": 0, "cancelled": 0}
+
+    async def run(self, key: Hashable, func: Callable[..., Awaitable[Any]], *args: Any) -> Any:
+        """
+        Выполняет await func(*args), когда завершатся все ранее поставленные обработчики с тем же ключом.
+        Корутина создаётся только в свою очередь — отменённое ожидание не оставляет невыполненных корутин.
+        """
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+        turn = asyncio.get_running_loop().create_future()
+        queue.append(turn)
+        if len(queue) > 1:
+            self.counters["queued"] += 1
+            try:
+                await turn
+            except asyncio.CancelledError:
+                self.counters["cancelled"] += 1
+                if turn.done() and not turn.cancelled():
+                    # Очередь уже дошла до нас — передаём её следующему.
+                    self._release(key, queue)
+                elif turn in queue:
+                    queue.remove(turn)
+                raise
+        else:
+            turn.set_result(None)
+        self.counters["run"] += 1
+        try:
+            return await func(*args)
+        finally:
+            self._release(key, queue)
+
+    def _release(self, key: Hashable, queue: deque) -> None:
+        queue.popleft()
+        while queue:
+            nxt = queue[0]
+            if not nxt.done():
+                nxt.set_result(None)
+                return
+            # Ожидание отменено, но ещё не убрано из очереди — пропускаем.
+            queue.popleft()
+        if self._queues.get(key) is queue:
+            del self._queues[key]
+
+    def pending(self, key: Hashable) -> int:
+        """Сколько обработчиков с этим ключом выполняется и ждёт (0 — пользователь свободен)."""
+        queue = self._queues.get(key)
+        return len(queue) if queue else 0
+
+    def active_keys(self) -> int:
+        return len(self._queues)